@@ -1,199 +1,843 @@
 import os
 import io
 import math
-from flask import Flask, request, render_template_string, redirect, url_for, send_file, jsonify, session
-from pdf2image import convert_from_path
-import fitz  # PyMuPDF
-import pandas as pd
+import hashlib
+from flask import Flask, request, render_template, redirect, url_for, send_file, jsonify, session
+import numpy as np
 import tempfile
-import uuid
 import json
-from PIL import Image
 import logging
+from rendering import get_renderer, MIMETYPES, SUPPORTED_FORMATS
+from render_cache import RenderCache
+from page_geometry import GeometryStore, MIN_ZOOM, MAX_ZOOM, RENDER_ZOOMS, render_zoom_for
+from project_store import open_store
+from prerender import PrerenderPool, default_workers
+from snapping import SnapIndexStore
+from rooms import find_room_in_index, room_dimensions
+from doc_pool import DocumentPool
+from scale_detection import ScaleDetector
+from ocr import OcrEngine
+from measurements import (is_line_activity, is_shape, points_array, shape_array, bounds, outside_page,
+                          measure_annotations, row_dimensions, LINE_UNIT, AREA_UNIT)
+from scales import ScaleMap, normalize_rect
+from excel_export import write_measurements
+from pdf_export import PdfExporter
+from jobs import JobManager
+from artifacts import ArtifactStore
+from uploads import store_upload, ChunkedUploads, UploadError
+from werkzeug.http import parse_content_range_header
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['SESSION_TYPE'] = 'filesystem'
+# Large files are sent in resumable chunks; incomplete ones wait here
+app.config['CHUNKED_UPLOAD_DIR'] = os.path.join('uploads', 'partial')
+app.config['MAX_UPLOAD_MB'] = int(os.environ.get('MAX_UPLOAD_MB', 2048))
+app.config['UPLOAD_CHUNK_MB'] = int(os.environ.get('UPLOAD_CHUNK_MB', 8))
 app.config['SECRET_KEY'] = 'your_secret_key_here'
+# 'pymupdf' renders in-process, 'poppler' shells out to pdftoppm (kept for fidelity comparisons)
+app.config['RENDER_BACKEND'] = os.environ.get('RENDER_BACKEND', 'pymupdf')
+app.config['RENDER_FORMAT'] = os.environ.get('RENDER_FORMAT', 'png')
+app.config['RENDER_CACHE_DIR'] = os.environ.get('RENDER_CACHE_DIR', os.path.join('cache', 'renders'))
+app.config['RENDER_CACHE_MEMORY_MB'] = int(os.environ.get('RENDER_CACHE_MEMORY_MB', 128))
+app.config['RENDER_CACHE_DISK_MB'] = int(os.environ.get('RENDER_CACHE_DISK_MB', 2048))
+# Deep-zoom viewer: fixed-size tiles plus a low-res full-page preview shown first
+app.config['TILE_SIZE'] = int(os.environ.get('TILE_SIZE', 512))
+app.config['PREVIEW_ZOOM'] = 0.5
+# Processes rendering previews and tiles in the background after an upload
+app.config['PRERENDER_WORKERS'] = int(os.environ.get('PRERENDER_WORKERS', default_workers()))
+# Every page gets its preview, but only pages this close to the one on screen get their tiles
+app.config['PRERENDER_TILE_WINDOW'] = int(os.environ.get('PRERENDER_TILE_WINDOW', 3))
+app.config['GEOMETRY_DIR'] = os.environ.get('GEOMETRY_DIR', os.path.join('cache', 'geometry'))
+app.config['SNAP_DIR'] = os.environ.get('SNAP_DIR', os.path.join('cache', 'snap'))
+# Largest snap radius a client may ask for, in PDF points
+app.config['MAX_SNAP_RADIUS'] = 50.0
+# Wall segments closer than this (in points) count as touching when detecting rooms
+app.config['ROOM_TOLERANCE'] = 0.5
+# Most measurements /api/annotations/batch accepts per request
+app.config['MAX_BATCH_ANNOTATIONS'] = int(os.environ.get('MAX_BATCH_ANNOTATIONS', 10000))
+# Annotated PDFs, kept per project so re-exports only redraw changed pages
+app.config['EXPORT_DIR'] = os.environ.get('EXPORT_DIR', os.path.join('cache', 'exports'))
+# Processes doing the PDF export; a large document's first export is split across them
+app.config['EXPORT_WORKERS'] = int(os.environ.get('EXPORT_WORKERS', default_workers()))
+app.config['PROJECT_STORE_URL'] = os.environ.get('PROJECT_STORE_URL', 'sqlite:///' + os.path.join('data', 'projects.db'))
+# Background jobs: quick ones never wait behind exports in the bulk lane
+app.config['JOB_STORE_PATH'] = os.environ.get('JOB_STORE_PATH', os.path.join('data', 'jobs.db'))
+app.config['INTERACTIVE_JOB_WORKERS'] = int(os.environ.get('INTERACTIVE_JOB_WORKERS', 2))
+app.config['BULK_JOB_WORKERS'] = int(os.environ.get('BULK_JOB_WORKERS', 1))
+# Upload analysis (scale detection) gets its own lane so it never delays exports
+app.config['ANALYSIS_JOB_WORKERS'] = int(os.environ.get('ANALYSIS_JOB_WORKERS', 1))
+app.config['SCALE_DETECTION_WORKERS'] = int(os.environ.get('SCALE_DETECTION_WORKERS', default_workers()))
+# Detected scales less certain than this aren't offered to the user
+app.config['MIN_SCALE_CONFIDENCE'] = 0.5
+# Scanned pages (no text layer) get their title block OCR'd; results are cached by page content
+app.config['OCR_DIR'] = os.environ.get('OCR_DIR', os.path.join('cache', 'ocr'))
+app.config['OCR_WORKERS'] = int(os.environ.get('OCR_WORKERS', os.cpu_count() or 1))
+# Excel exports up to this many rows count as quick
+app.config['INTERACTIVE_EXCEL_ROWS'] = 5000
+# Uploads and exports are deleted once they expire, or LRU-first when over quota
+app.config['ARTIFACT_STORE_PATH'] = os.environ.get('ARTIFACT_STORE_PATH', os.path.join('data', 'artifacts.db'))
+app.config['ARTIFACT_QUOTA_MB'] = int(os.environ.get('ARTIFACT_QUOTA_MB', 4096))
+app.config['ARTIFACT_TTLS'] = {
+    'upload': 7 * 24 * 3600,
+    'pdf_export': 24 * 3600,
+    'excel_export': 3600,
+    'upload_part': 24 * 3600,
+}
+# How long a session keeps its upload alive after its last page view
+app.config['SESSION_REF_TTL'] = 12 * 3600
+# How long an unfinished chunked upload is safe from quota sweeps after its last chunk
+app.config['UPLOAD_REF_TTL'] = 24 * 3600
+# Documents kept open per worker between requests
+app.config['DOC_POOL_SIZE'] = int(os.environ.get('DOC_POOL_SIZE', 8))
+app.config['DOC_POOL_IDLE_SECONDS'] = 300
+
+documents = DocumentPool(max_open=app.config['DOC_POOL_SIZE'], idle_timeout=app.config['DOC_POOL_IDLE_SECONDS'])
+renderer = get_renderer(app.config['RENDER_BACKEND'], documents=documents)
+render_cache = RenderCache(
+    app.config['RENDER_CACHE_DIR'],
+    memory_bytes=app.config['RENDER_CACHE_MEMORY_MB'] * 1024 * 1024,
+    disk_bytes=app.config['RENDER_CACHE_DISK_MB'] * 1024 * 1024,
+)
+geometry_store = GeometryStore(app.config['GEOMETRY_DIR'])
+snap_store = SnapIndexStore(app.config['SNAP_DIR'], documents=documents)
+project_store = open_store(app.config['PROJECT_STORE_URL'])
+pdf_exporter = PdfExporter(app.config['EXPORT_DIR'], max_workers=app.config['EXPORT_WORKERS'])
+scale_detector = ScaleDetector(max_workers=app.config['SCALE_DETECTION_WORKERS'])
+ocr_engine = OcrEngine(app.config['OCR_DIR'], max_workers=app.config['OCR_WORKERS'])
+artifacts = ArtifactStore(
+    app.config['ARTIFACT_STORE_PATH'],
+    quota_bytes=app.config['ARTIFACT_QUOTA_MB'] * 1024 * 1024,
+    ttls=app.config['ARTIFACT_TTLS'],
+)
+artifacts.on_evict['pdf_export'] = pdf_exporter.discard
+artifacts.on_evict['upload'] = documents.discard
+jobs = JobManager(app.config['JOB_STORE_PATH'], lanes={
+    'interactive': app.config['INTERACTIVE_JOB_WORKERS'],
+    'bulk': app.config['BULK_JOB_WORKERS'],
+    'analysis': app.config['ANALYSIS_JOB_WORKERS'],
+})
+
+# Mirror background rendering progress into the jobs table
+def prerender_progress(doc_hash, status):
+    done, failed = len(status['ready']), len(status['failed'])
+    state = None
+    if not status['pending'] and not status['running']:
+        state = 'failed' if failed else ('done' if done >= status['total'] else 'cancelled')
+    jobs.update_tracked('prerender', doc_hash, done + failed, status['total'], state=state,
+                        error=f"{failed} pages failed to render" if failed else None)
+
+prerender_pool = PrerenderPool(
+    render_cache,
+    backend=renderer.name,
+    max_workers=app.config['PRERENDER_WORKERS'],
+    tile_size=app.config['TILE_SIZE'],
+    fmt=app.config['RENDER_FORMAT'],
+    preview_zoom=app.config['PREVIEW_ZOOM'],
+    snap_root=app.config['SNAP_DIR'],
+    on_update=prerender_progress,
+    tile_window=app.config['PRERENDER_TILE_WINDOW'],
+)
 
 # Create upload folder if it doesn't exist
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
 
+chunked_uploads = ChunkedUploads(app.config['CHUNKED_UPLOAD_DIR'], app.config['MAX_UPLOAD_MB'] * 1024 * 1024)
+# An abandoned upload's part file expires; its record goes with it
+artifacts.on_evict['upload_part'] = lambda path: chunked_uploads.discard(os.path.splitext(os.path.basename(path))[0])
+
+# Files written before the artifact store existed expire like the rest
+# Only stored PDFs: the folder also holds in-flight temp files (.upload)
+artifacts.adopt(app.config['UPLOAD_FOLDER'], 'upload', suffix='.pdf')
+artifacts.adopt(app.config['CHUNKED_UPLOAD_DIR'], 'upload_part', suffix='.part')
+artifacts.adopt(pdf_exporter.root, 'pdf_export', suffix='.pdf')
+artifacts.adopt(pdf_exporter.root, 'excel_export', suffix='.xlsx')
+
+@app.before_request
+def start_artifact_sweeper():
+    artifacts.start_sweeper()
+
+# Static assets are linked with their content hash, so browsers can keep them for good
+_asset_versions = {}
+
+def asset_url(filename):
+    path = os.path.join(app.static_folder, filename)
+    mtime = os.path.getmtime(path)
+    version = _asset_versions.get(filename)
+    if version is None or version[0] != mtime:
+        with open(path, 'rb') as f:
+            version = (mtime, hashlib.sha256(f.read()).hexdigest()[:12])
+        _asset_versions[filename] = version
+    return url_for('static', filename=filename, v=version[1])
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+@app.after_request
+def cache_headers(response):
+    if request.endpoint == 'static' and request.args.get('v'):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    elif request.method == 'GET' and response.status_code == 200 and response.mimetype == 'text/html':
+        # Pages depend on the session: browsers keep a copy but revalidate it, and get a 304 if unchanged
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+# The session only carries the project ID; everything else lives in the project store
+def current_project():
+    project_id = session.get('project_id')
+    if not project_id:
+        return None
+    project = project_store.get_project(project_id)
+    if project is None or not os.path.exists(project['pdf_path']):
+        # The upload expired; the session has to start over
+        return None
+    return project
+
+def session_holder(project):
+    return f"project:{project['id']}"
+
+def project_geometry(project):
+    return geometry_store.get(project['content_hash'], project['pdf_path'])
+
+# Page and viewport scales of the project (or of one page), falling back to the document's
+def project_scales(project, page_num=None):
+    return ScaleMap(project_store.list_scales(project['id'], page_num), default=project['scale'])
+
+# Mutating requests name the page they act on: the viewer switches pages
+# without waiting for the server, so its current page can lag behind.
+# Returns None for a page the document doesn't have.
+def requested_page(project, data):
+    try:
+        page_num = int(data.get('page_num', project['current_page']))
+    except (TypeError, ValueError):
+        return None
+    return page_num if 0 <= page_num < project['page_count'] else None
+
+# Measurements are kept in PDF points; re-derive their sizes when the scales of
+# their page change, so totals always follow the scale in force
+def rescale_measurements(project, page_nums=None):
+    project = project_store.get_project(project['id'])
+    if page_nums is None:
+        page_nums = project_store.measurement_pages(project['id'])
+    rescaled = 0
+    for page_num in page_nums:
+        rows = [row for row in project_store.page_measurements(project['id'], page_num)
+                if is_shape(row[1]) or len(row[2]) == 2]
+        if not rows:
+            continue
+        types = [annotation_type for _, annotation_type, _, _ in rows]
+        # Shapes are looked up by their bounding box, like the rectangles
+        extents = np.array([bounds(np.array(points, dtype=np.float64)) for _, _, points, _ in rows])
+        scales, _ = project_scales(project, page_num).lookup(np.full(len(rows), page_num), extents)
+        widths, heights, units = measure_annotations(
+            types, [points for _, _, points, _ in rows], [unit == LINE_UNIT for _, _, _, unit in rows],
+            np.nan_to_num(scales, nan=1.0)
+        )
+        project_store.update_dimensions(project['id'], [
+            (measurement_id, [width, height], *row_dimensions(annotation_type, width, height, unit))
+            for (measurement_id, annotation_type, _, _), width, height, unit
+            in zip(rows, widths.tolist(), heights.tolist(), units.tolist())
+        ])
+        rescaled += len(rows)
+    return rescaled
+
+# Queue the project's document for background rendering, current page first
+def prerender_project(project, page_num=0):
+    doc_hash = project['content_hash']
+    zoom = render_zoom_for(project['zoom_level'])
+    if prerender_pool.focus(doc_hash, page_num):
+        status = prerender_pool.status(doc_hash)
+        if status and status['zoom'] == zoom:
+            return
+    elif prerender_pool.status(doc_hash) is None and (
+            jobs.tracked_elsewhere('prerender', doc_hash) or prerendered(project, page_num, zoom)):
+        # Another worker is rendering it, or an earlier run (before a restart) already did
+        return
+    project_id = project['id']
+    jobs.track('prerender', doc_hash, project_id=project_id, total=project['page_count'],
+               on_cancel=lambda: prerender_pool.release(project_id))
+    prerender_pool.submit(doc_hash, project['pdf_path'], project['page_count'], zoom,
+                          owner=project_id, focus_page=page_num)
+
+# Whether pre-rendering has nothing left to do around ``page_num``: every page's
+# preview is there, and the ready marker (all tiles on disk) of the pages in the tile window
+def prerendered(project, page_num, zoom):
+    doc_hash, page_count, window = project['content_hash'], project['page_count'], app.config['PRERENDER_TILE_WINDOW']
+    fmt, tile_size = app.config['RENDER_FORMAT'], app.config['TILE_SIZE']
+    tiled = range(max(page_num - window, 0), min(page_num + window + 1, page_count))
+    return (
+        all(render_cache.contains(render_cache.ready_key(doc_hash, p, zoom, renderer.name, tile_size)) for p in tiled)
+        and all(render_cache.contains(render_cache.page_key(doc_hash, p, app.config['PREVIEW_ZOOM'], fmt, renderer.name))
+                for p in range(page_count))
+    )
+
 # Home page: upload PDF
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "POST":
         file = request.files.get("pdf_file")
         if file:
-            # Generate a unique filename to avoid conflicts
-            filename = f"{uuid.uuid4().hex}_{file.filename}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            
-            # Store file path in session
-            session['current_pdf_path'] = filepath
-            session['current_page_num'] = 0
-            session['annotations'] = {}
-            session['scale'] = None
-            session['data_for_excel'] = []
-            session['original_scale'] = None
-            session['zoom_level'] = 1.5
-            session['undo_stack'] = {}
-
+            # Stored once per content hash; a re-upload reuses the file and every cache keyed by it
+            content_hash, filepath, duplicate = store_upload(file.stream, app.config['UPLOAD_FOLDER'])
+            open_upload(content_hash, filepath, file.filename, duplicate)
             return redirect(url_for("view_page", page_num=0))
-    return render_template_string(HOME_TEMPLATE)
+    return render_template("home.html", chunk_size=app.config['UPLOAD_CHUNK_MB'] * 1024 * 1024)
+
+# Start a new project on a stored upload
+def open_upload(content_hash, filepath, filename, duplicate):
+    artifacts.register(filepath, 'upload')
+    if duplicate:
+        logging.info(f"Upload {filename} matches stored document {content_hash[:12]}")
+    
+    # Page rects, rotations and pixel sizes per zoom, so measurements never need a render
+    geometry = geometry_store.build(content_hash, filepath)
+    document_id = project_store.upsert_document(content_hash, filepath, filename, geometry.pages)
+    
+    # Stop pre-rendering whatever this session had open before
+    if session.get('project_id'):
+        prerender_pool.release(session['project_id'])
+    session.clear()
+    session['project_id'] = project_store.create_project(document_id, zoom_level=1.5)
+    project = current_project()
+    artifacts.ref(filepath, session_holder(project), app.config['SESSION_REF_TTL'])
+    prerender_project(project)
+    detect_scales(project, geometry)
+
+# Detect every page's scale in the background; results go into the page geometry.
+# Scans that weren't OCR'd (no engine then, or the OCR failed) are tried again
+# whenever the document is opened and the engine is there.
+def detect_scales(project, geometry):
+    detected = [geometry.page(page_num).get('detected_scale') for page_num in range(len(geometry))]
+    redetect = any(result is None for result in detected)
+    if not redetect and not (any(awaits_ocr(result) for result in detected) and ocr_engine.available()):
+        return None
+    content_hash, pdf_path, page_count = project['content_hash'], project['pdf_path'], len(geometry)
+    
+    def detect(job):
+        if redetect:
+            results = scale_detector.detect(pdf_path, page_count, progress=job.progress)
+            for result in results:
+                result['ocr'] = False
+        else:
+            results = [dict(result) for result in detected]
+        # Pages without a text layer are scans: read their title block instead
+        scanned = [page_num for page_num, result in enumerate(results) if awaits_ocr(result)]
+        ocr_pages = 0
+        if scanned and ocr_engine.available():
+            for page_num, ocr in ocr_engine.run(pdf_path, scanned, progress=job.progress).items():
+                results[page_num] = dict(ocr['scale'], has_text=False, ocr=True)
+                ocr_pages += 1
+        geometry_store.update_pages(content_hash, pdf_path, 'detected_scale', results)
+        detected_pages = sum(1 for result in results if result.get('scale'))
+        logging.info(f"Detected scales on {detected_pages} of {page_count} pages of {content_hash[:12]}")
+        return {"pages": page_count, "detected": detected_pages, "scanned": len(scanned), "ocr": ocr_pages}
+    
+    return jobs.submit('scale_detection', detect, lane='analysis', project_id=project['id'], total=page_count)
+
+def awaits_ocr(result):
+    return result.get('has_text') is False and not result.get('ocr')
+
+# Start a chunked upload: the client sends the file name and total size
+@app.route("/api/uploads", methods=["POST"])
+def create_upload():
+    data = request.json or {}
+    filename = os.path.basename(str(data.get('filename') or 'upload.pdf'))
+    try:
+        size = int(data.get('size'))
+        upload_id = chunked_uploads.create(filename, size)
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "Invalid file size"}), 400
+    except UploadError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    track_upload_part(upload_id)
+    
+    return jsonify({
+        "success": True,
+        "upload_id": upload_id,
+        "offset": 0,
+        "chunk_size": app.config['UPLOAD_CHUNK_MB'] * 1024 * 1024,
+        "upload_url": url_for('upload_chunk', upload_id=upload_id)
+    }), 201
+
+# A part file expires if its upload is abandoned, but is referenced until then so
+# a quota sweep can't delete it while chunks are still arriving
+def track_upload_part(upload_id):
+    part_path = chunked_uploads.part_path(upload_id)
+    artifacts.register(part_path, 'upload_part')
+    artifacts.ref(part_path, f"upload:{upload_id}", app.config['UPLOAD_REF_TTL'])
+
+# Where an upload stands; a client resuming after a disconnect continues from "offset"
+@app.route("/api/uploads/<upload_id>", methods=["GET"])
+def upload_status(upload_id):
+    status = chunked_uploads.status(upload_id)
+    if status is None:
+        return jsonify({"success": False, "error": "No such upload"}), 404
+    return jsonify({"success": True, **status, "complete": status['offset'] == status['size']})
+
+# One chunk, with a "Content-Range: bytes start-end/size" header; the body streams straight to disk
+@app.route("/api/uploads/<upload_id>", methods=["PUT"])
+def upload_chunk(upload_id):
+    content_range = parse_content_range_header(request.headers.get('Content-Range'))
+    if content_range is None or content_range.units != 'bytes' or content_range.start is None:
+        return jsonify({"success": False, "error": "Missing or invalid Content-Range header"}), 400
+    length = content_range.stop - content_range.start
+    if length > app.config['UPLOAD_CHUNK_MB'] * 1024 * 1024:
+        return jsonify({"success": False, "error": "Chunk too large"}), 413
+    if request.content_length is not None and request.content_length != length:
+        return jsonify({"success": False, "error": "Content-Length doesn't match Content-Range"}), 400
+    
+    try:
+        offset = chunked_uploads.write(upload_id, content_range.start, length, request.stream)
+    except UploadError as e:
+        if e.offset is None:
+            return jsonify({"success": False, "error": str(e)}), 404
+        return jsonify({"success": False, "error": str(e), "offset": e.offset}), 409
+    track_upload_part(upload_id)
+    
+    size = content_range.length or chunked_uploads.status(upload_id)['size']
+    return jsonify({"success": True, "offset": offset, "complete": offset == size})
+
+# All bytes are in: store the file under its hash (computed while the chunks arrived) and open it
+@app.route("/api/uploads/<upload_id>/complete", methods=["POST"])
+def complete_upload(upload_id):
+    part_path = chunked_uploads.part_path(upload_id)
+    try:
+        content_hash, filepath, duplicate, filename = chunked_uploads.finish(upload_id, app.config['UPLOAD_FOLDER'])
+    except UploadError as e:
+        if e.offset is None:
+            return jsonify({"success": False, "error": str(e)}), 404
+        return jsonify({"success": False, "error": str(e), "offset": e.offset}), 409
+    # Its reference goes with it
+    artifacts.discard(part_path)
+    
+    try:
+        open_upload(content_hash, filepath, filename, duplicate)
+    except Exception as e:
+        logging.error(f"Could not open upload {filename}: {e}")
+        return jsonify({"success": False, "error": f"Could not open PDF: {str(e)}"}), 400
+    return jsonify({"success": True, "redirect": url_for("view_page", page_num=0)})
 
 # View a specific PDF page with annotation controls
 @app.route("/page/<int:page_num>")
 def view_page(page_num):
-    if 'current_pdf_path' not in session:
+    project = current_project()
+    if project is None:
         return redirect(url_for('index'))
     
     try:
-        pdf_doc = fitz.open(session['current_pdf_path'])
-        total_pages = len(pdf_doc)
-        
-        if page_num >= total_pages:
-            page_num = total_pages - 1
-        if page_num < 0:
-            page_num = 0
-            
-        session['current_page_num'] = page_num
-        
-        return render_template_string(
-            VIEW_PAGE_TEMPLATE,
-            page_num=page_num,
-            total_pages=total_pages,
-            has_scale=session.get('scale') is not None,
-            annotations=session.get('annotations', {}).get(str(page_num), []),
-            zoom_level=session.get('zoom_level', 1.5)
+        state = page_state(project, page_num)
+        visit_page(project, state['pageNum'])
+        return render_template(
+            "view_page.html",
+            page_num=state['pageNum'],
+            total_pages=state['totalPages'],
+            has_scale=state['hasScale'],
+            page_config=state
         )
     except Exception as e:
         return f"Error loading PDF: {str(e)}", 500
 
+# Everything the viewer script needs to show a page (out-of-range pages are clamped)
+def page_state(project, page_num):
+    geometry = project_geometry(project)
+    total_pages = len(geometry)
+    page_num = min(max(page_num, 0), total_pages - 1)
+    scales = project_scales(project, page_num)
+    return {
+        "annotations": project_store.list_annotations(project['id'], page_num),
+        "scales": scales.viewports + list(scales.page_scales.values()),
+        "hasScale": scales.has_scale(page_num),
+        "docHash": project['content_hash'],
+        "pageNum": page_num,
+        "totalPages": total_pages,
+        "tileSize": app.config['TILE_SIZE'],
+        "pageSize": [geometry.page(page_num)['width'], geometry.page(page_num)['height']],
+        "renderZooms": list(RENDER_ZOOMS),
+        "zoomLevel": project['zoom_level'],
+        "previewUrl": url_for('get_page_image', page_num=page_num, zoom=app.config['PREVIEW_ZOOM']),
+        "url": url_for('view_page', page_num=page_num),
+        "detectedScale": offered_scale(geometry.page(page_num)),
+    }
+
+def offered_scale(page_geometry):
+    detected = page_geometry.get('detected_scale') or {}
+    if not detected.get('scale') or detected['confidence'] < app.config['MIN_SCALE_CONFIDENCE']:
+        return None
+    return {key: detected[key] for key in ('scale', 'ratio', 'label', 'source', 'confidence')}
+
+# Make a page the one annotations go to
+def visit_page(project, page_num):
+    project_store.update_project(project['id'], current_page=page_num)
+    prerender_project(project, page_num)
+    # An open session keeps its upload from expiring
+    artifacts.touch(project['pdf_path'])
+    artifacts.ref(project['pdf_path'], session_holder(project), app.config['SESSION_REF_TTL'])
+
+# Page state as JSON, so the viewer can switch pages without a reload.
+# With ?prefetch=1 the current page stays as it is.
+@app.route("/api/page_state/<int:page_num>", methods=["GET"])
+def get_page_state(page_num):
+    project = current_project()
+    if project is None:
+        return jsonify({"success": False, "error": "No PDF loaded"}), 400
+    
+    try:
+        state = page_state(project, page_num)
+        if not request.args.get('prefetch'):
+            visit_page(project, state['pageNum'])
+        return jsonify({"success": True, **state})
+    except Exception as e:
+        logging.error(f"Error loading page state: {str(e)}")
+        return jsonify({"success": False, "error": f"Error loading page: {str(e)}"}), 500
+
+# Render a PDF page of the current document (at the project zoom level unless given)
+def render_page_image(page_num, fmt=None, zoom=None):
+    project = current_project()
+    if project is None:
+        return None, "No PDF loaded"
+    
+    fmt = fmt or app.config['RENDER_FORMAT']
+    try:
+        zoom = zoom or project['zoom_level']
+        pdf_path = project['pdf_path']
+        key = render_cache.page_key(project['content_hash'], page_num, zoom, fmt, renderer.name)
+        data = render_cache.get_or_render(key, lambda: renderer.render(pdf_path, page_num, zoom, fmt))
+        return io.BytesIO(data), None
+    except Exception as e:
+        return None, f"Error converting page: {str(e)}"
+
 # Endpoint to return PDF page as image
 @app.route("/get_page_image/<int:page_num>")
 def get_page_image(page_num):
-    if 'current_pdf_path' not in session:
-        return None, "No PDF loaded"
+    fmt = request.args.get('format', app.config['RENDER_FORMAT']).lower()
+    if fmt not in SUPPORTED_FORMATS:
+        return f"Unsupported image format: {fmt}", 400
+    
+    zoom = request.args.get('zoom', type=float)
+    if zoom is not None and not MIN_ZOOM <= zoom <= MAX_ZOOM:
+        return f"Zoom must be between {MIN_ZOOM} and {MAX_ZOOM}", 400
+    
+    img_byte_arr, error = render_page_image(page_num, fmt, zoom)
+    if error:
+        return error, 404
+    
+    return send_file(img_byte_arr, mimetype=MIMETYPES[fmt])
+
+# Endpoint to return one fixed-size tile of a page. The document hash is part of
+# the URL, so tiles are immutable and the browser may cache them indefinitely.
+@app.route("/tile/<doc_hash>/<int:page_num>/<float:zoom>/<int:tile_x>/<int:tile_y>")
+def get_page_tile(doc_hash, page_num, zoom, tile_x, tile_y):
+    project = current_project()
+    if project is None or project['content_hash'] != doc_hash:
+        return "No such document", 404
+    
+    fmt = request.args.get('format', app.config['RENDER_FORMAT']).lower()
+    if fmt not in SUPPORTED_FORMATS:
+        return f"Unsupported image format: {fmt}", 400
+    if not MIN_ZOOM <= zoom <= MAX_ZOOM:
+        return f"Zoom must be between {MIN_ZOOM} and {MAX_ZOOM}", 400
+    
+    geometry = project_geometry(project)
+    if not 0 <= page_num < len(geometry):
+        return "No such page", 404
+    tile_size = app.config['TILE_SIZE']
+    width, height = geometry.pixel_size(page_num, zoom)
+    if not (0 <= tile_x < math.ceil(width / tile_size) and 0 <= tile_y < math.ceil(height / tile_size)):
+        return "No such tile", 404
     
     try:
-        zoom = session.get('zoom_level',1.5)  # Adjust zoom for better quality
-        pages = convert_from_path(session['current_pdf_path'], first_page=page_num+1, last_page=page_num+1, dpi=72*zoom)
-        if pages:
-            img = pages[0]
-            buf = io.BytesIO()
-            img.save(buf, format="PNG")
-            buf.seek(0)
-            return buf, None  # Returning image byte array and None as error
+        key = render_cache.tile_key(doc_hash, page_num, zoom, fmt, renderer.name, tile_size, tile_x, tile_y)
+        data = render_cache.get_or_render(key, lambda: renderer.render_tile(
+            project['pdf_path'], page_num, zoom, tile_x, tile_y, tile_size, fmt))
     except Exception as e:
-        return None, f"Error converting page: {str(e)}"
+        return f"Error rendering tile: {str(e)}", 500
+    
+    # max_age through send_file, which otherwise adds no-cache (and a BytesIO
+    # body has no validators, so every revalidation would resend the tile);
+    # it marks the response public, but tiles are per session
+    response = send_file(io.BytesIO(data), mimetype=MIMETYPES[fmt], max_age=365 * 24 * 3600)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+# Render cache counters (hits/misses/bytes per tier)
+@app.route("/api/render_cache/stats", methods=["GET"])
+def render_cache_stats():
+    return jsonify({"success": True, "stats": render_cache.stats()})
+
+@app.route("/api/doc_pool/stats", methods=["GET"])
+def doc_pool_stats():
+    return jsonify({"success": True, "stats": documents.stats()})
+
+# Pre-render progress for the current document: which pages have their preview
+# and tiles in the cache already
+@app.route("/api/prerender/status", methods=["GET"])
+def prerender_status():
+    project = current_project()
+    if project is None:
+        return jsonify({"success": False, "error": "No PDF loaded"}), 400
     
-    return None, "No image available"
+    status = prerender_pool.status(project['content_hash'])
+    if status is None:
+        # Not rendering in this worker; fall back to the markers left in the shared cache
+        zoom = render_zoom_for(project['zoom_level'])
+        ready = [
+            page_num for page_num in range(project['page_count'])
+            if render_cache.contains(render_cache.ready_key(
+                project['content_hash'], page_num, zoom, renderer.name, app.config['TILE_SIZE']))
+        ]
+        status = {'total': project['page_count'], 'zoom': zoom, 'ready': ready,
+                  'running': [], 'pending': 0, 'failed': {}}
+    
+    return jsonify({"success": True, **status})
 
-# Updated Adjust Zoom API
+# Snap a point (PDF points) to the nearest vertex or edge of the page's vector drawing
+@app.route("/api/snap", methods=["GET"])
+def snap_point():
+    project = current_project()
+    if project is None:
+        return jsonify({"success": False, "error": "No PDF loaded"}), 400
+    
+    page_num = request.args.get('page_num', default=project['current_page'], type=int)
+    x = request.args.get('x', type=float)
+    y = request.args.get('y', type=float)
+    radius = request.args.get('radius', default=8.0, type=float)
+    if x is None or y is None or radius <= 0:
+        return jsonify({"success": False, "error": "Invalid data"}), 400
+    if not 0 <= page_num < project['page_count']:
+        return jsonify({"success": False, "error": "No such page"}), 404
+    
+    try:
+        index = snap_store.get(project['content_hash'], project['pdf_path'], page_num)
+    except Exception as e:
+        return jsonify({"success": False, "error": f"Error reading page drawings: {str(e)}"}), 500
+    
+    snap = index.snap(x, y, min(radius, app.config['MAX_SNAP_RADIUS']))
+    return jsonify({"success": True, "snap": snap})
+
+# One-click room detection: the closed region of the page's drawing around a point
+@app.route("/api/detect_room", methods=["POST"])
+def detect_room():
+    project = current_project()
+    if project is None:
+        return jsonify({"success": False, "error": "No PDF loaded"}), 400
+    
+    data = request.json or {}
+    page_num = requested_page(project, data)
+    if page_num is None:
+        return jsonify({"success": False, "error": "No such page"}), 404
+    try:
+        x, y = (float(v) for v in data.get('point'))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "Invalid data"}), 400
+    
+    try:
+        index = snap_store.get(project['content_hash'], project['pdf_path'], page_num)
+    except Exception as e:
+        return jsonify({"success": False, "error": f"Error reading page drawings: {str(e)}"}), 500
+    
+    room = find_room_in_index(index, x, y, tolerance=app.config['ROOM_TOLERANCE'])
+    if room is None:
+        return jsonify({"success": True, "room": None, "message": "No closed room around this point"})
+    
+    scales, _ = project_scales(project, page_num).lookup([page_num], np.array([room['polygon']]))
+    area = perimeter = None
+    if not np.isnan(scales[0]):
+        area, perimeter = room_dimensions(room, float(scales[0]))
+    return jsonify({
+        "success": True,
+        "room": {
+            "polygon": room['polygon'],
+            "area_pt": room['area'],
+            "perimeter_pt": room['perimeter'],
+            "area": area,
+            "perimeter": perimeter,
+            "unit": AREA_UNIT,
+        },
+        "message": (f"Room: {area:.2f} {AREA_UNIT}, perimeter {perimeter:.2f}" if area is not None
+                    else f"Room: {room['area']:.0f} pt², set a scale to measure it")
+    })
+
+# Zoom is a view transform in the browser; this only remembers the preferred zoom
+# so the next page load starts there. Annotations and scale are in PDF points and
+# don't change with zoom.
 @app.route("/api/adjust_zoom", methods=["POST"])
 def adjust_zoom():
-    data = request.json
-    zoom_action = data.get('action')
-    
-    current_zoom = session.get('zoom_level', 1.5)
-    current_scale = session.get('scale')
-    original_scale = session.get('original_scale')
+    project = current_project()
+    if project is None:
+        return jsonify({"success": False, "error": "No PDF loaded"}), 400
     
-    if zoom_action == 'in':
-        new_zoom = min(current_zoom * 1.2, 3.0)  # Max zoom of 3x
+    data = request.json or {}
+    zoom_action = data.get('action')
+    current_zoom = project['zoom_level']
+    
+    if data.get('zoom') is not None:
+        try:
+            new_zoom = float(data['zoom'])
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "Invalid zoom level"}), 400
+        # NaN would slip through the clamp below
+        if not math.isfinite(new_zoom):
+            return jsonify({"success": False, "error": "Invalid zoom level"}), 400
+        new_zoom = min(max(new_zoom, MIN_ZOOM), MAX_ZOOM)
+    elif zoom_action == 'in':
+        new_zoom = min(current_zoom * 1.2, MAX_ZOOM)  # Max zoom of 3x
     elif zoom_action == 'out':
-        new_zoom = max(current_zoom / 1.2, 0.5)  # Min zoom of 0.5x
+        new_zoom = max(current_zoom / 1.2, MIN_ZOOM)  # Min zoom of 0.5x
     else:
         return jsonify({"success": False, "error": "Invalid zoom action"}), 400
     
-    # Preserve scale proportionality
-    if current_scale is not None:
-        # If no original scale stored, store the current scale
-        if original_scale is None:
-            session['original_scale'] = current_scale
-            original_zoom = session.get('zoom_level', 1.5)
-        else:
-            original_zoom = session.get('zoom_level', 1.5)
-        
-        # Adjust scale proportionally to zoom change
-        new_scale = original_scale * (original_zoom / new_zoom)
-        session['scale'] = new_scale
-    
-    session['zoom_level'] = new_zoom
+    project_store.update_project(project['id'], zoom_level=new_zoom)
     
     return jsonify({
         "success": True, 
         "zoom_level": new_zoom,
-        "scale": session.get('scale'),
         "message": f"Zoom set to {new_zoom:.2f}"
     })
 
 
-# API to set scale
+# API to set scale: for the current page, or for a named viewport on it (a
+# detail drawn at another scale) when ``viewport`` is given
 @app.route("/api/set_scale", methods=["POST"])
 def set_scale():
-    data = request.json
+    project = current_project()
+    if project is None:
+        return jsonify({"success": False, "error": "No PDF loaded"}), 400
+    
+    data = request.json or {}
     points = data.get('points', [])
     known_distance = data.get('known_distance')
     
     if len(points) != 2 or not known_distance:
         return jsonify({"success": False, "error": "Invalid data"}), 400
     
-    # Calculate pixel distance
+    rect, name = None, ''
+    viewport = data.get('viewport')
+    if viewport is not None:
+        try:
+            name = str(viewport.get('name') or '').strip()
+            rect = normalize_rect(np.asarray(viewport['rect'], dtype=np.float64).reshape(4))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return jsonify({"success": False, "error": "Invalid viewport"}), 400
+        if not name or rect[0] == rect[2] or rect[1] == rect[3]:
+            return jsonify({"success": False, "error": "A viewport needs a name and an area"}), 400
+    
+    # Calculate distance in PDF points (independent of zoom)
     point1, point2 = points
-    pixel_distance = math.sqrt((point2[0] - point1[0])**2 + (point2[1] - point1[1])**2)
-    
-    # Calculate scale (real-world units per pixel)
-    scale = known_distance / pixel_distance
-    session['scale'] = scale
-    
-    # Store scale reference as special annotation
-    page_num = str(session['current_page_num'])
-    annotations = session.get('annotations', {})
-    
-    if page_num not in annotations:
-        annotations[page_num] = []
-    
-    # Check if there's already a scale reference and replace it
-    for i, anno in enumerate(annotations.get(page_num, [])):
-        if anno.get('type') == 'scale_reference':
-            annotations[page_num].pop(i)
-            break
-    
-    annotations[page_num].append({
-        'type': 'scale_reference',
-        'points': points,
-        'label': f"Scale: {known_distance} units = {pixel_distance:.1f} pixels"
-    })
-    
-    session['annotations'] = annotations
+    point_distance = math.sqrt((point2[0] - point1[0])**2 + (point2[1] - point1[1])**2)
+    if point_distance == 0:
+        return jsonify({"success": False, "error": "Scale points must be distinct"}), 400
+    
+    # Calculate scale (real-world units per PDF point)
+    scale = known_distance / point_distance
+    page_num = requested_page(project, data)
+    if page_num is None:
+        return jsonify({"success": False, "error": "No such page"}), 404
+    label = f"Scale: {known_distance} units = {point_distance:.1f} pt"
+    if name:
+        label = f"{name} - {label}"
+    project_store.set_scale(project['id'], page_num, scale, rect=rect, name=name, source='reference',
+                            reference={'points': points, 'label': label})
+    if not name:
+        # References are drawn from the page's scales; drop the old annotation kind
+        project_store.replace_annotations(project['id'], page_num, 'scale_reference')
+    if data.get('default'):
+        # Also the scale of every page without one of its own
+        project_store.update_project(project['id'], scale=scale)
+        rescaled = rescale_measurements(project)
+    else:
+        rescaled = rescale_measurements(project, [page_num])
     
+    state = page_state(project_store.get_project(project['id']), page_num)
     return jsonify({
         "success": True, 
         "scale": scale,
-        "message": f"Scale set: 1 pixel = {scale:.5f} units"
+        "scales": state['scales'],
+        "hasScale": state['hasScale'],
+        "rescaled": rescaled,
+        "message": f"Scale set{f' for {name}' if name else ''}: 1 pt = {scale:.5f} units"
     })
 
-# API to reset scale
+# Use the scale detected on the current page instead of measuring a reference
+@app.route("/api/apply_detected_scale", methods=["POST"])
+def apply_detected_scale():
+    project = current_project()
+    if project is None:
+        return jsonify({"success": False, "error": "No PDF loaded"}), 400
+    
+    page_num = requested_page(project, request.get_json(silent=True) or {})
+    if page_num is None:
+        return jsonify({"success": False, "error": "No such page"}), 404
+    detected = offered_scale(project_geometry(project).page(page_num))
+    if detected is None:
+        return jsonify({"success": False, "error": "No scale detected on this page"}), 400
+    
+    project_store.set_scale(project['id'], page_num, detected['scale'], source=detected['source'],
+                            reference={'label': detected['label']})
+    rescaled = rescale_measurements(project, [page_num])
+    state = page_state(project, page_num)
+    return jsonify({
+        "success": True,
+        "scale": detected['scale'],
+        "scales": state['scales'],
+        "hasScale": state['hasScale'],
+        "rescaled": rescaled,
+        "message": f"Scale set from the drawing ({detected['label']}): 1 pt = {detected['scale']:.5f} units"
+    })
+
+# API to reset scale: one viewport's (``name``), or all of the current page's.
+# A page without scales of its own resets the document's.
 @app.route("/api/reset_scale", methods=["POST"])
 def reset_scale():
-    session['scale'] = None
+    project = current_project()
+    if project is None:
+        return jsonify({"success": False, "error": "No PDF loaded"}), 400
+    
+    # The body is optional here
+    data = request.get_json(silent=True) or {}
+    page_num = requested_page(project, data)
+    if page_num is None:
+        return jsonify({"success": False, "error": "No such page"}), 404
+    name = data.get('name')
+    removed = project_store.remove_scales(project['id'], page_num, name=name)
     
     # Remove scale reference annotation
-    page_num = str(session['current_page_num'])
-    annotations = session.get('annotations', {})
+    project_store.replace_annotations(project['id'], page_num, 'scale_reference')
     
-    if page_num in annotations:
-        annotations[page_num] = [a for a in annotations[page_num] if a.get('type') != 'scale_reference']
-        session['annotations'] = annotations
+    if name is None and not removed and project['scale'] is not None:
+        project_store.update_project(project['id'], scale=None)
+        rescaled = rescale_measurements(project)
+    else:
+        rescaled = rescale_measurements(project, [page_num])
     
-    return jsonify({"success": True, "message": "Scale has been reset"})
+    state = page_state(project_store.get_project(project['id']), page_num)
+    return jsonify({
+        "success": True,
+        "scales": state['scales'],
+        "hasScale": state['hasScale'],
+        "rescaled": rescaled,
+        "message": "Scale has been reset"
+    })
+
+# Text and count fields of an annotation go straight into the store, so
+# anything but plain values is turned away. Returns the problem or None.
+def invalid_fields(data):
+    for field in ('type', 'rect_name', 'label', 'parent_area', 'rect_type'):
+        if not isinstance(data.get(field) or '', str):
+            return f"Invalid {field}"
+    replicas = data.get('replicas', 1)
+    if isinstance(replicas, bool) or not isinstance(replicas, (int, float)) or not math.isfinite(replicas):
+        return "Invalid replicas"
+    return None
 
 @app.route("/api/create_annotation", methods=["POST"])
 def create_annotation():
@@ -202,237 +846,298 @@ def create_annotation():
     points = data.get('points', [])
     label = data.get('label', '')
 
-    if len(points) != 2 or not annotation_type:
+    field_error = invalid_fields(data)
+    if field_error:
+        return jsonify({"success": False, "error": field_error}), 400
+    # Polylines and polygons take any number of vertices, everything else two
+    if not annotation_type or not isinstance(points, list) or (not is_shape(annotation_type) and len(points) != 2):
         return jsonify({"success": False, "error": "Invalid data"}), 400
 
-    page_num = str(session.get('current_page_num', data.get("page_num")))
-
-    if "annotations" not in session:
-        session["annotations"] = {}
-
-    if page_num not in session["annotations"]:
-        session["annotations"][page_num] = []
-
-    # Track undo stack
-    if page_num not in session["undo_stack"]:
-        session["undo_stack"][page_num] = []
-
-    # Get the image size
-    img_byte_arr, error = get_page_image(int(page_num))
-    if error:
-        return jsonify({"success": False, "error": error}), 400
-
-    img = Image.open(img_byte_arr)
-    img_width, img_height = img.size  # Get actual image dimensions
-
-    # Get the PDF page size
-    pdf_path = session.get("current_pdf_path", "")
-    if not pdf_path:
+    project = current_project()
+    if project is None:
         return jsonify({"success": False, "error": "PDF not loaded"}), 400
 
-    with fitz.open(pdf_path) as doc:
-        pdf_page = doc[int(page_num)]
-        pdf_width = pdf_page.rect.width  # Actual PDF width
-        pdf_height = pdf_page.rect.height  # Actual PDF height
+    page_num = requested_page(project, data)
+    if page_num is None:
+        return jsonify({"success": False, "error": "No such page"}), 404
 
-    # Calculate scaling factors
-    scale_x = pdf_width / img_width
-    scale_y = pdf_height / img_height
+    # Points arrive in PDF points (the viewer divides out its zoom), so they only
+    # need checking against the page size from the geometry index
+    try:
+        page_geometry = project_geometry(project).page(page_num)
+        if is_shape(annotation_type):
+            points = shape_array(points, annotation_type).tolist()
+        else:
+            points = [[float(p[0]), float(p[1])] for p in points]
+    except (IndexError, RuntimeError, OSError, TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": f"Invalid points or page: {str(e)}"}), 400
 
-    # Scale the annotation points
-    scaled_points = [[p[0] * scale_x, p[1] * scale_y] for p in points]
+    pdf_width = page_geometry['width']  # Actual PDF width
+    pdf_height = page_geometry['height']  # Actual PDF height
+    if any(not (0 <= x <= pdf_width and 0 <= y <= pdf_height) for x, y in points):
+        return jsonify({"success": False, "error": "Points lie outside the page"}), 400
 
-    # Categorize activity type
-    rect_type = data.get("rect_type", "").lower()
-    line_activities = ['wall', 'door', 'window', 'panel']
-    area_activities = ['floor', 'ceiling', 'pillar']
-    
-    is_line_activity = rect_type in line_activities
-    is_area_activity = rect_type in area_activities
-
-    # Calculate dimensions
-    p1, p2 = points
-    width = abs(p2[0] - p1[0]) * session.get("scale", 1)
-    height = abs(p2[1] - p1[1]) * session.get("scale", 1)
-   
-    # For line activities, calculate total length
-    if is_line_activity:
-        length = math.sqrt((p2[0] - p1[0])**2 + (p2[1] - p1[1])**2) * session.get("scale", 1)
-        width = length  # Set width to total length
-        height = 0  # No height for line activities
-        plan_height=0
-        unit = "RMT"  # Running meter
-    else:
-        plan_height=0
-        unit = "Sqmt"  # Square meter
+    # Calculate dimensions with the scale of the viewport (or page) the measurement lies in;
+    # line activities (walls, doors, ...) measure their length, other polygons their area
+    scale_map = project_scales(project, page_num)
+    scales, scale_ids = scale_map.lookup([page_num], bounds(np.array(points))[None])
+    scale = float(np.nan_to_num(scales[0], nan=1.0))
+    widths, heights, units = measure_annotations(
+        [annotation_type], [points], [is_line_activity(data.get("rect_type"))], scale
+    )
+    width, height, unit = float(widths[0]), float(heights[0]), str(units[0])
+    length_column, width_column, area_column = row_dimensions(annotation_type, width, height, unit)
+    plan_height = 0
 
-    # Add to Excel data
-    excel_data = session.get("data_for_excel", [])
-    excel_data.append([
-        data.get("rect_name", f"Item {len(excel_data) + 1}"),
+    # Row for the Excel data
+    measurement = [
+        data.get("rect_name") or f"Item {project_store.count_measurements(project['id']) + 1}",
         data.get("parent_area", ""),
-        round(width,3),
-        round(height,3),
+        length_column,
+        width_column,
         plan_height,
+        area_column,
         data.get("replicas", 1),
         unit,
         data.get("rect_type", "Unknown")
-    ])
-    session["data_for_excel"] = excel_data
+    ]
 
     # Store annotation
     annotation = {
         "type": annotation_type,
-        "points": scaled_points,
+        "points": points,
         "label": label,
         "dimensions": [width, height]
     }
 
-    session["annotations"][page_num].append(annotation)
-    session["undo_stack"][page_num].append(annotation)
+    annotation_id = project_store.add_annotation(project['id'], page_num, annotation, measurement)
+
+    return jsonify({
+        "success": True,
+        "id": annotation_id,
+        "points": points,
+        "dimensions": [width, height],
+        "unit": unit,
+        "scale": scale,
+        "scaleSource": scale_map.describe(int(scale_ids[0])) if not np.isnan(scales[0]) else None,
+        "message": f"Added {annotation_type} annotation"
+    })
+# API to create many annotations at once (e.g. an imported takeoff), in one transaction
+@app.route("/api/annotations/batch", methods=["POST"])
+def create_annotations_batch():
+    project = current_project()
+    if project is None:
+        return jsonify({"success": False, "error": "PDF not loaded"}), 400
+
+    data = request.json or {}
+    items = data.get('annotations')
+    if not isinstance(items, list) or not items:
+        return jsonify({"success": False, "error": "Invalid data"}), 400
+    if len(items) > app.config['MAX_BATCH_ANNOTATIONS']:
+        return jsonify({
+            "success": False,
+            "error": f"At most {app.config['MAX_BATCH_ANNOTATIONS']} annotations per request"
+        }), 400
+
+    # Per-item checks that need Python objects; everything numeric is vectorized below
+    errors = {}
+    page_nums = np.full(len(items), -1, dtype=np.int64)
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('type'):
+            errors[i] = "Invalid data"
+            continue
+        field_error = invalid_fields(item)
+        if field_error:
+            errors[i] = field_error
+            continue
+        try:
+            page_nums[i] = int(item.get('page_num', project['current_page']))
+        except (TypeError, ValueError):
+            errors[i] = "Invalid page number"
+    # Polylines and polygons stand in for rectangles by their bounding box
+    # wherever only their extent matters
+    shapes = {}
+    for i, item in enumerate(items):
+        if i not in errors and is_shape(item['type']):
+            try:
+                shapes[i] = shape_array(item.get('points'), item['type'])
+            except ValueError as e:
+                errors[i] = str(e)
+    points, point_errors = points_array([bounds(shapes[i]) if i in shapes else item.get('points') if i not in errors
+                                         else None for i, item in enumerate(items)])
+    for i, error in point_errors.items():
+        errors.setdefault(i, error)
+
+    try:
+        geometry = project_geometry(project)
+    except (RuntimeError, OSError) as e:
+        return jsonify({"success": False, "error": f"Error reading page geometry: {str(e)}"}), 500
+    page_widths = np.array([page['width'] for page in geometry.pages])
+    page_heights = np.array([page['height'] for page in geometry.pages])
+    bad_page = (page_nums < 0) | (page_nums >= len(geometry))
+    safe_pages = np.where(bad_page, 0, page_nums)
+    off_page = outside_page(points, page_widths[safe_pages], page_heights[safe_pages])
+    for i in np.flatnonzero(bad_page):
+        errors.setdefault(int(i), "No such page")
+    for i in np.flatnonzero(off_page):
+        errors.setdefault(int(i), "Points lie outside the page")
+
+    # Each measurement gets the scale of the viewport or page it lies on
+    scales, _ = project_scales(project).lookup(safe_pages, points)
+    line_mask = np.array([i not in errors and is_line_activity(item.get('rect_type'))
+                          for i, item in enumerate(items)])
+    types = [items[i]['type'] if i in shapes else 'square' for i in range(len(items))]
+    widths, heights, units = measure_annotations(types, [shapes.get(i, points[i]) for i in range(len(items))],
+                                                 line_mask, np.nan_to_num(scales, nan=1.0))
+    widths, heights, units = widths.tolist(), heights.tolist(), units.tolist()
+
+    entries = []
+    valid = [i for i in range(len(items)) if i not in errors]
+    next_item = project_store.count_measurements(project['id']) + 1
+    for i in valid:
+        item = items[i]
+        name = item.get("rect_name")
+        if not name:
+            name = f"Item {next_item}"
+            next_item += 1
+        annotation = {
+            "type": item['type'],
+            "points": shapes[i].tolist() if i in shapes else points[i].tolist(),
+            "label": item.get('label', ''),
+            "dimensions": [widths[i], heights[i]]
+        }
+        length, width, area = row_dimensions(item['type'], widths[i], heights[i], units[i])
+        measurement = [
+            name,
+            item.get("parent_area", ""),
+            length,
+            width,
+            0,
+            area,
+            item.get("replicas", 1),
+            units[i],
+            item.get("rect_type", "Unknown")
+        ]
+        entries.append((int(page_nums[i]), annotation, measurement))
+
+    try:
+        annotation_ids = project_store.add_annotations(project['id'], entries)
+    except Exception as e:
+        return jsonify({"success": False, "error": f"Error saving annotations: {str(e)}"}), 500
+    created = dict(zip(valid, annotation_ids))
+    logging.info(f"Batch created {len(created)} annotations, rejected {len(errors)}")
+
+    results = []
+    for i in range(len(items)):
+        if i in errors:
+            results.append({"index": i, "success": False, "error": errors[i]})
+        else:
+            results.append({
+                "index": i,
+                "success": True,
+                "id": created[i],
+                "page_num": int(page_nums[i]),
+                "dimensions": [widths[i], heights[i]],
+                "unit": units[i]
+            })
+
+    return jsonify({
+        "success": True,
+        "created": len(created),
+        "failed": len(errors),
+        "results": results
+    })
 
-    return jsonify({"success": True, "message": f"Added {annotation_type} annotation"})
 # API to undo last annotation
 @app.route("/api/undo_annotation", methods=["POST"])
 def undo_annotation():
-    page_num = str(session.get('current_page_num'))
+    project = current_project()
+    if project is None:
+        return jsonify({"success": False, "message": "No PDF loaded"})
     
-    # Check if there are annotations to undo
-    annotations = session.get('annotations', {}).get(page_num, [])
-    undo_stack = session.get('undo_stack', {}).get(page_num, [])
-    excel_data = session.get('data_for_excel', [])
+    page_num = requested_page(project, request.get_json(silent=True) or {})
+    if page_num is None:
+        return jsonify({"success": False, "message": "No such page"}), 404
     
-    if not annotations or not undo_stack:
+    # Remove the last measurement on this page together with its Excel row
+    removed = project_store.pop_annotation(project['id'], page_num, skip_types=('scale_reference',))
+    if removed is None:
         return jsonify({"success": False, "message": "No annotations to undo"})
     
-    # Remove last annotation
-    last_annotation = annotations.pop()
-    
-    # Ensure the undo stack is updated
-    if undo_stack and undo_stack[-1] == last_annotation:
-        undo_stack.pop()
-    
-    # Remove the corresponding Excel data entry
-    # This assumes the Excel data is added in the same order as annotations
-    if excel_data:
-        excel_data.pop()
-    
-    # Update session
-    session['annotations'][page_num] = annotations
-    session['undo_stack'][page_num] = undo_stack
-    session['data_for_excel'] = excel_data
-    
     return jsonify({
         "success": True, 
         "message": "Last annotation removed",
-        "remaining_annotations": len(annotations),
-        "remaining_excel_entries": len(excel_data)
+        "removed_id": removed['id'],
+        "remaining_annotations": len(project_store.list_annotations(project['id'], page_num)),
+        "remaining_excel_entries": project_store.count_measurements(project['id'])
     })
 
 # API to clear annotations
 @app.route("/api/clear_annotations", methods=["POST"])
 def clear_annotations():
-    page_num = str(session['current_page_num'])
-    annotations = session.get('annotations', {})
+    project = current_project()
+    if project is None:
+        return jsonify({"success": False, "error": "No PDF loaded"}), 400
     
-    if page_num in annotations:
-        # Keep scale reference, remove others
-        scale_refs = [a for a in annotations[page_num] if a.get('type') == 'scale_reference']
-        annotations[page_num] = scale_refs
-        session['annotations'] = annotations
-        
+    page_num = requested_page(project, request.get_json(silent=True) or {})
+    if page_num is None:
+        return jsonify({"success": False, "error": "No such page"}), 404
+    # Keep scale reference, remove others
+    removed = project_store.clear_annotations(project['id'], page_num, keep_types=('scale_reference',))
+    
+    if removed:
         return jsonify({
             "success": True, 
-            "message": f"Annotations cleared from page {int(page_num) + 1}"
+            "message": f"Annotations cleared from page {page_num + 1}"
         })
     
     return jsonify({"success": True, "message": "No annotations to clear"})
 
 # Export annotations to PDF
-def adjust_coordinates(x, y, width, height, page_rotation, page_width, page_height):
-    if page_rotation == 90:
-        return y, page_width - x, width, height
-    elif page_rotation == 180:
-        return page_width - x, page_height - y, width, height
-    elif page_rotation == 270:
-        return page_height - y, x, width, height
-    return x, y, width, height
-
 @app.route("/api/save_pdf", methods=["POST"])
 def save_pdf():
     logging.info("Received request to save PDF annotations")
-    if 'current_pdf_path' not in session:
+    project = current_project()
+    if project is None:
         logging.warning("No PDF loaded in session")
         return jsonify({"success": False, "error": "No PDF loaded"}), 400
     
+    project_id = project['id']
     try:
-        doc = fitz.open(session['current_pdf_path'])
-        annotations = session.get('annotations', {})
-        
-        for page_num_str, page_annotations in annotations.items():
-            page_num = int(page_num_str)
-            page = doc[page_num]
-            page_rotation = page.rotation
-            page_width, page_height = page.rect.width, page.rect.height
-            
-            filtered_annotations = [
-                anno for anno in page_annotations 
-                if anno.get('type') != 'scale_reference'
-            ]
-            
-            for anno in filtered_annotations:
-                points = anno.get('points', [])
-                if len(points) != 2:
-                    logging.warning(f"Skipping annotation with invalid points: {anno}")
-                    continue
-                
-                if anno.get('type') == 'line':
-                    start, end = points
-                    start = adjust_coordinates(start[0], start[1], 0, 0, page_rotation, page_width, page_height)[:2]
-                    end = adjust_coordinates(end[0], end[1], 0, 0, page_rotation, page_width, page_height)[:2]
-                    page.draw_line(start, end, color=(1, 0, 0), width=2)
-                    page.insert_text((start[0], start[1] - 10), 
-                                   anno.get('label', ''), color=(0, 0, 1))
-                    logging.info(f"Drew line annotation: {anno}")
-                
-                elif anno.get('type') == 'square':
-                    p1, p2 = points
-                    x1, y1, _, _ = adjust_coordinates(p1[0], p1[1], 0, 0, page_rotation, page_width, page_height)
-                    x2, y2, _, _ = adjust_coordinates(p2[0], p2[1], 0, 0, page_rotation, page_width, page_height)
-                    
-                    page.draw_line((x1, y1), (x2, y1), color=(0, 1, 0), width=2)
-                    page.draw_line((x2, y1), (x2, y2), color=(0, 1, 0), width=2)
-                    page.draw_line((x2, y2), (x1, y2), color=(0, 1, 0), width=2)
-                    page.draw_line((x1, y2), (x1, y1), color=(0, 1, 0), width=2)
-                    page.insert_text((x1, y1 - 10), anno.get('label', ''), color=(0, 0, 1))
-                    logging.info(f"Drew square annotation: {anno}")
-        
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-        doc.save(temp_file.name)
-        temp_file.close()
-        
-        temp_filename = os.path.basename(temp_file.name)
-        session['temp_pdf'] = temp_file.name
-        
-        logging.info(f"Saved annotated PDF as {temp_filename}")
-        
-        return jsonify({
-            "success": True, 
-            "filename": temp_filename,
-            "download_url": url_for('download_pdf', filename=temp_filename)
-        })
-    
+        annotations = project_store.list_annotations(project_id)
+        geometry = project_geometry(project)
     except Exception as e:
-        logging.error(f"Error while saving PDF: {str(e)}")
+        logging.error(f"Error while starting PDF export: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
+    
+    # Runs in the background; only pages changed since the last export get redrawn
+    def export(job):
+        with artifacts.hold([project['pdf_path'], pdf_exporter.path(project_id)], f"job:{job.id}"):
+            path, stats = pdf_exporter.export(project_id, project['content_hash'], project['pdf_path'],
+                                              annotations, geometry, progress=job.progress)
+        artifacts.register(path, 'pdf_export')
+        project_store.update_project(project_id, export_pdf_path=path)
+        logging.info(f"Saved annotated PDF as {os.path.basename(path)} ({stats['mode']}: "
+                     f"{stats['pages_drawn']} pages drawn, {stats['pages_reused']} reused)")
+        return {"filename": os.path.basename(path), **stats}
+    
+    job_id = jobs.submit('pdf_export', export, lane='bulk', project_id=project_id)
+    return jsonify({
+        "success": True,
+        "job_id": job_id,
+        "status_url": url_for('job_status', job_id=job_id)
+    }), 202
+
 # Download the saved PDF
 @app.route("/download/pdf/<filename>")
 def download_pdf(filename):
-    if 'temp_pdf' not in session:
+    project = current_project()
+    if project is None or not project['export_pdf_path'] or not os.path.exists(project['export_pdf_path']):
         return "No PDF available", 404
     
+    artifacts.touch(project['export_pdf_path'])
     return send_file(
-        session['temp_pdf'],
+        project['export_pdf_path'],
         as_attachment=True,
         download_name="annotated_pdf.pdf",
         mimetype="application/pdf"
@@ -441,37 +1146,108 @@ def download_pdf(filename):
 # Export data to Excel
 @app.route("/api/save_excel", methods=["POST"])
 def save_excel():
-    excel_data = session.get('data_for_excel', [])
-    
-    if not excel_data:
+    project = current_project()
+    rows = project_store.count_measurements(project['id']) if project else 0
+    if not rows:
         return jsonify({"success": False, "error": "No data to export"}), 400
     
-    try:
-        # Create DataFrame
-        df = pd.DataFrame(excel_data, columns=['Name', 'Parent Area', 'Drawing Length', 'Drawing Width','Drawing Height','Drawing Number Of Replicas','Unit','Area Type'])
+    project_id = project['id']
+    
+    def export(job):
+        # Rows stream from the store into the workbook; memory stays flat for large projects
+        fd, path = tempfile.mkstemp(dir=pdf_exporter.root, suffix='.xlsx')
+        os.close(fd)
+        try:
+            written = write_measurements(path, project_store, project_id, progress=job.progress)
+        except BaseException:
+            os.remove(path)
+            raise
+        artifacts.register(path, 'excel_export')
+        logging.info(f"Exported {written} measurement rows to {path}")
         
-        # Save to temporary file
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx')
-        df.to_excel(temp_file.name, index=False)
-        temp_file.close()
-        
-        # Return temporary file path to client for download
-        temp_filename = os.path.basename(temp_file.name)
-        session['temp_excel'] = temp_file.name
-        
-        return jsonify({
-            "success": True, 
-            "filename": temp_filename,
-            "download_url": url_for('download_excel', filename=temp_filename)
-        })
-    
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+        # Only the latest export is kept per project
+        previous = project_store.get_project(project_id)['export_excel_path']
+        if previous and previous != path:
+            artifacts.discard(previous)
+        project_store.update_project(project_id, export_excel_path=path)
+        return {"filename": os.path.basename(path), "rows": written}
+    
+    lane = 'interactive' if rows <= app.config['INTERACTIVE_EXCEL_ROWS'] else 'bulk'
+    job_id = jobs.submit('excel_export', export, lane=lane, project_id=project_id, total=rows)
+    return jsonify({
+        "success": True,
+        "job_id": job_id,
+        "status_url": url_for('job_status', job_id=job_id)
+    }), 202
+
+# Where the file produced by a finished job can be downloaded
+JOB_DOWNLOADS = {
+    'pdf_export': 'download_pdf',
+    'excel_export': 'download_excel',
+}
+
+def project_job(job_id):
+    project = current_project()
+    job = jobs.get(job_id)
+    if project is None or job is None or job['project_id'] != project['id']:
+        return None
+    return job
+
+# Status and progress of a background job
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = project_job(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "No such job"}), 404
+    
+    status = {
+        "success": job['state'] not in ('failed', 'cancelled'),
+        "id": job['id'],
+        "kind": job['kind'],
+        "state": job['state'],
+        "done": job['done'],
+        "total": job['total'],
+        "result": job['result']
+    }
+    if job['state'] == 'done' and job['kind'] in JOB_DOWNLOADS:
+        status["download_url"] = url_for(JOB_DOWNLOADS[job['kind']], filename=job['result']['filename'])
+    elif job['state'] == 'failed':
+        status["error"] = job['error']
+    elif job['state'] == 'cancelled':
+        status["error"] = "Cancelled"
+    return jsonify(status)
+
+# Result of a finished job: the file for exports, JSON otherwise
+@app.route("/api/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    job = project_job(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "No such job"}), 404
+    if job['state'] != 'done':
+        return jsonify({"success": False, "state": job['state'], "error": job['error'] or "Job not finished"}), 409
+    if job['kind'] in JOB_DOWNLOADS:
+        return redirect(url_for(JOB_DOWNLOADS[job['kind']], filename=job['result']['filename']))
+    return jsonify({"success": True, "result": job['result']})
+
+@app.route("/api/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    job = project_job(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "No such job"}), 404
+    if not jobs.cancel(job_id):
+        return jsonify({"success": False, "error": f"Job already {job['state']}"}), 409
+    return jsonify({"success": True, "message": "Cancellation requested"})
+
+# Disk usage of uploads and exports, and how often files are being evicted
+@app.route("/api/artifacts/stats", methods=["GET"])
+def artifact_stats():
+    return jsonify({"success": True, **artifacts.stats()})
     
 # Add a new route to get data preview
 @app.route("/api/get_data_preview", methods=["GET"])
 def get_data_preview():
-    excel_data = session.get('data_for_excel', [])
+    project = current_project()
+    excel_data = project_store.list_measurements(project['id']) if project else []
     
     if not excel_data:
         return jsonify({"success": False, "message": "No data available"})
@@ -484,846 +1260,18 @@ def get_data_preview():
 # Download the saved Excel file
 @app.route("/download/excel/<filename>")
 def download_excel(filename):
-    if 'temp_excel' not in session:
+    project = current_project()
+    if project is None or not project['export_excel_path'] or not os.path.exists(project['export_excel_path']):
         return "No Excel file available", 404
     
+    artifacts.touch(project['export_excel_path'])
+    # send_file streams the workbook from disk in blocks
     return send_file(
-        session['temp_excel'],
+        project['export_excel_path'],
         as_attachment=True,
         download_name="annotated_data.xlsx",
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
 
-# HTML Templates
-HOME_TEMPLATE = """
-<!doctype html>
-<html>
-<head>
-  <title>PDF Measurement and Annotation Tool</title>
-  <style>
-    body { font-family: Arial, sans-serif; margin: 20px; background-color: #f5f5f5; }
-    .upload-container { 
-      width: 500px; margin: 50px auto; padding: 30px; 
-      border: 1px solid #ccc; background-color: white;
-      box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-      border-radius: 8px;
-    }
-    h1 { text-align: center; color: #333; }
-    .form-group { margin-bottom: 20px; }
-    label { display: block; margin-bottom: 5px; font-weight: bold; }
-    input[type="file"] { width: 100%; padding: 10px; border: 1px solid #ddd; border-radius: 4px; }
-    button { 
-      background-color: #4CAF50; color: white; padding: 12px 20px; 
-      border: none; cursor: pointer; width: 100%; font-size: 16px;
-      border-radius: 4px;
-    }
-    button:hover { background-color: #45a049; }
-  </style>
-</head>
-<body>
-  <div class="upload-container">
-    <h1>PDF Measurement Tool</h1>
-    <form method="post" enctype="multipart/form-data">
-      <div class="form-group">
-        <label for="pdf_file">Select a PDF file:</label>
-        <input type="file" name="pdf_file" id="pdf_file" accept="application/pdf" required>
-      </div>
-      <button type="submit">Upload and Open</button>
-    </form>
-  </div>
-</body>
-</html>
-"""
-
-VIEW_PAGE_TEMPLATE = """
-<!doctype html>
-<html>
-<head>
-  <title>PDF Measurement Annotation - Page {{ page_num+1 }}</title>
-  <style>
-    body { font-family: Arial, sans-serif; margin: 0; padding: 0; }
-    .container { display: flex; flex-direction: column; height: 100vh; }
-    #toolbar {
-      background-color: #f0f0f0; padding: 10px; display: flex;
-      justify-content: space-between; border-bottom: 1px solid #ccc;
-    }
-    .button-group { display: flex; gap: 10px; }
-    .btn {
-      padding: 8px 15px; border: none; border-radius: 4px; cursor: pointer;
-      font-size: 14px; font-weight: bold;
-    }
-    .btn-primary { background-color: #4CAF50; color: white; }
-    .btn-secondary { background-color: #f1f1f1; color: #333; border: 1px solid #ccc; }
-    .btn-danger { background-color: #f44336; color: white; }
-    .btn-warning { background-color: #ff9800; color: white; }
-    
-    #canvas-container {
-      flex-grow: 1; overflow: auto; position: relative;
-      background-color: #e0e0e0;
-    }
-    #pdfCanvas { display: block; margin: 20px auto; background-color: white; }
-    #status-bar {
-      background-color: #333; color: white; padding: 5px 10px;
-      font-size: 14px;
-    }
-    .modal {
-      display: none; position: fixed; z-index: 100; left: 0; top: 0;
-      width: 100%; height: 100%; background-color: rgba(0,0,0,0.4);
-    }
-    .modal-content {
-      background-color: white; margin: 15% auto; padding: 20px;
-      border: 1px solid #888; width: 50%; border-radius: 5px;
-    }
-    .input-group { margin-bottom: 15px; }
-    .input-group label { display: block; margin-bottom: 5px; }
-    .input-group input { width: 100%; padding: 8px; }
-    .modal-buttons { display: flex; justify-content: flex-end; gap: 10px; }
-     #data-preview-modal {
-      display: none;
-      position: fixed;
-      z-index: 100;
-      left: 0;
-      top: 0;
-      width: 100%;
-      height: 100%;
-      background-color: rgba(0,0,0,0.4);
-    }
-    #data-preview-content {
-      background-color: white;
-      margin: 10% auto;
-      padding: 20px;
-      border: 1px solid #888;
-      width: 80%;
-      max-height: 70%;
-      overflow-y: auto;
-    }
-    #data-table {
-      width: 100%;
-      border-collapse: collapse;
-    }
-    #data-table th, #data-table td {
-      border: 1px solid #ddd;
-      padding: 8px;
-      text-align: left;
-    }
-    #data-table th {
-      background-color: #f2f2f2;
-    }
-  </style>
-</head>
-<body>
-  <div class="container">
-    <div id="toolbar">
-      <div class="button-group">
-        <a href="{{ url_for('index') }}" class="btn btn-secondary">← Back to Home</a>
-        <span>Page {{ page_num+1 }} of {{ total_pages }}</span>
-        <button id="prev-btn" class="btn btn-secondary" {% if page_num == 0 %}disabled{% endif %}>
-          Previous Page
-        </button>
-        <button id="next-btn" class="btn btn-secondary" {% if page_num == total_pages - 1 %}disabled{% endif %}>
-          Next Page
-        </button>
-      </div>
-      <div class="button-group">
-        <button id="zoom-in-btn" class="btn btn-secondary">Zoom In</button>
-        <button id="zoom-out-btn" class="btn btn-secondary">Zoom Out</button>
-        <button id="undo-btn" class="btn btn-secondary">Undo Last</button>
-        <button id="set-scale-btn" class="btn btn-primary">Set Scale</button>
-        <button id="reset-scale-btn" class="btn btn-warning" {% if not has_scale %}disabled{% endif %}>Reset Scale</button>
-        <button id="measure-btn" class="btn btn-primary" {% if not has_scale %}disabled{% endif %}>Add Measurement</button>
-        <button id="clear-btn" class="btn btn-danger">Clear Annotations</button>
-      </div>
-      <div class="button-group">
-        <button id="preview-data-btn" class="btn btn-secondary">Preview Data</button>
-        <button id="save-pdf-btn" class="btn btn-primary">Save PDF</button>
-        <button id="save-excel-btn" class="btn btn-primary">Save Data to Excel</button>
-      </div>
-    </div>
-    
-    <div id="canvas-container">
-      <canvas id="pdfCanvas"></canvas>
-    </div>
-    
-    <div id="status-bar">Ready. First click two points to set scale.</div>
-  </div>
-  
-  <!-- Scale Setting Modal -->
-  <div id="scale-modal" class="modal">
-    <div class="modal-content">
-      <h3>Set Scale</h3>
-      <div class="input-group">
-        <label for="known-distance">Enter the real-world distance between the two points:</label>
-        <input type="number" id="known-distance" step="0.01" min="0.01" placeholder="e.g., 1.5 meters">
-      </div>
-      <div class="modal-buttons">
-        <button id="cancel-scale-btn" class="btn btn-secondary">Cancel</button>
-        <button id="confirm-scale-btn" class="btn btn-primary">Set Scale</button>
-      </div>
-    </div>
-  </div>
-
-  <!-- [Previous HTML remains the same] -->
-    
-    <!-- Data Preview Modal -->
-    <div id="data-preview-modal">
-      <div id="data-preview-content">
-        <h3>Current Measurement Data</h3>
-        <table id="data-table">
-          <thead>
-            <tr>
-              <th>Name</th>
-              <th>Parent Area</th>
-              <th>Drawing Length</th>
-              <th>Drawing Width</th>
-              <th>Drawing Height</th>
-              <th>Drawing Number Of Replicas</th>
-              <th>Unit</th>
-              <th>Area Type</th>
-            </tr>
-          </thead>
-          <tbody id="data-table-body">
-            <!-- Data rows will be dynamically populated -->
-          </tbody>
-        </table>
-        <div style="margin-top: 15px; text-align: right;">
-          <button id="close-preview-btn" class="btn btn-secondary">Close</button>
-        </div>
-      </div>
-    </div>
-
-  <!-- Measurement Modal -->
-  <div id="measure-modal" class="modal">
-    <div class="modal-content">
-      <h3>Add Measurement</h3>
-      <div class="input-group">
-        <label for="rect-type">Type (e.g., wall, door):</label>
-        <input type="text" id="rect-type" placeholder="Type">
-      </div>
-      <div class="input-group">
-        <label for="rect-name">Name:</label>
-        <input type="text" id="rect-name" placeholder="Name">
-      </div>
-      <!-- New section to display measurements -->
-      <div id="measurements-preview" class="input-group">
-        <label>Measurements:</label>
-        <p id="pixel-length-display"></p>
-        <p id="original-length-display"></p>
-      </div>
-      <div class="modal-buttons">
-        <button id="cancel-measure-btn" class="btn btn-secondary">Cancel</button>
-        <button id="confirm-measure-btn" class="btn btn-primary">Add</button>
-      </div>
-    </div>
-  </div>
-
-  <script>
-     // Global variables
-    const canvas = document.getElementById('pdfCanvas');
-    const ctx = canvas.getContext('2d');
-    let points = [];
-    let currentAction = null;
-    let imageObj = null;
-    let annotations = {{ annotations|tojson|safe }};
-    // Preview Data Button Handler
-    document.getElementById('preview-data-btn').addEventListener('click', async () => {
-      try {
-        const response = await fetch('/api/get_data_preview', {
-          method: 'GET',
-          headers: {'Content-Type': 'application/json'}
-        });
-        const result = await response.json();
-        
-        if (result.success) {
-          const tableBody = document.getElementById('data-table-body');
-          tableBody.innerHTML = ''; // Clear previous data
-          
-          result.data.forEach(row => {
-            const tr = document.createElement('tr');
-            row.forEach(cell => {
-              const td = document.createElement('td');
-              td.textContent = cell;
-              tr.appendChild(td);
-            });
-            tableBody.appendChild(tr);
-          });
-          
-          document.getElementById('data-preview-modal').style.display = 'block';
-        } else {
-          updateStatus('No data available');
-        }
-      } catch (error) {
-        console.error('Error previewing data:', error);
-        updateStatus('Error retrieving data');
-      }
-    });
-
-    // Close Preview Modal
-    document.getElementById('close-preview-btn').addEventListener('click', () => {
-      document.getElementById('data-preview-modal').style.display = 'none';
-    });
-
-    // Updated Zoom controls
-    document.getElementById('zoom-in-btn').addEventListener('click', async () => {
-       try {
-        const response = await fetch('/api/adjust_zoom', {
-         method: 'POST',
-         headers: {'Content-Type': 'application/json'},
-         body: JSON.stringify({ action: 'in' })
-        });
-        const result = await response.json();
-        if (result.success) {
-          updateStatus(`Zoomed in. Current zoom: ${result.zoom_level.toFixed(2)}`);
-          // Reload the page image with new zoom
-          location.reload();
-        }
-      } catch (error) {
-        console.error('Zoom in error:', error);
-        updateStatus('Error zooming in');
-      }
-    });
-
-    document.getElementById('zoom-out-btn').addEventListener('click', async () => {
-       try {
-        const response = await fetch('/api/adjust_zoom', {
-         method: 'POST',
-         headers: {'Content-Type': 'application/json'},
-         body: JSON.stringify({ action: 'out' })
-        });
-        const result = await response.json();
-        if (result.success) {
-          updateStatus(`Zoomed out. Current zoom: ${result.zoom_level.toFixed(2)}`);
-          // Reload the page image with new zoom
-          location.reload();
-        }
-      } catch (error) {
-        console.error('Zoom out error:', error);
-        updateStatus('Error zooming out');
-      }
-    });
-      // Adjust zoom handler to preserve state
-    async function adjustZoom(action) {
-      try {
-        const response = await fetch('/api/adjust_zoom', {
-          method: 'POST',
-          headers: {'Content-Type': 'application/json'},
-          body: JSON.stringify({ action: action })
-        });
-        const result = await response.json();
-        if (result.success) {
-          // Preserve important session variables
-          const currentScale = result.scale;
-          const currentZoom = result.zoom_level;
-          
-          updateStatus(`Zoomed ${action}. Current zoom: ${currentZoom.toFixed(2)}`);
-          
-          // Reload the page, ensuring state is preserved
-          window.location.reload();
-        }
-      } catch (error) {
-        console.error(`Zoom ${action} error:`, error);
-        updateStatus(`Error zooming ${action}`);
-      }
-    }
-
-    // Update zoom button event listeners
-    document.getElementById('zoom-in-btn').addEventListener('click', () => adjustZoom('in'));
-    document.getElementById('zoom-out-btn').addEventListener('click', () => adjustZoom('out'));
-
-     // Undo button handler
-     document.getElementById('undo-btn').addEventListener('click', async () => {
-       try {
-         const response = await fetch('/api/undo_annotation', {
-         method: 'POST',
-         headers: {'Content-Type': 'application/json'}
-        });
-         const result = await response.json();
-         if (result.success) {
-          updateStatus(result.message);
-          // Remove last annotation from local annotations array
-          if (annotations.length > 0) {
-            annotations.pop();
-          }
-          redrawCanvas();
-        } else {
-          updateStatus(result.message);
-        }
-      } catch (error) {
-        console.error('Undo error:', error);
-        updateStatus('Error undoing last annotation');
-      }
-    });
-
-    // Navigation buttons
-    document.getElementById('prev-btn').addEventListener('click', () => {
-      window.location.href = "{{ url_for('view_page', page_num=page_num-1) }}";
-    });
-    
-    document.getElementById('next-btn').addEventListener('click', () => {
-      window.location.href = "{{ url_for('view_page', page_num=page_num+1) }}";
-    });
-    
-    // Button handlers
-    document.getElementById('set-scale-btn').addEventListener('click', () => {
-      currentAction = 'setScale';
-      points = [];
-      updateStatus('Click two points on the image to set the scale.');
-    });
-    
-    document.getElementById('reset-scale-btn').addEventListener('click', async () => {
-      if (confirm('Are you sure you want to reset the scale? This will not remove existing annotations.')) {
-        try {
-          const response = await fetch('/api/reset_scale', {
-            method: 'POST',
-            headers: {'Content-Type': 'application/json'}
-          });
-          const result = await response.json();
-          if (result.success) {
-            updateStatus(result.message);
-            document.getElementById('reset-scale-btn').disabled = true;
-            document.getElementById('measure-btn').disabled = true;
-            // Remove scale reference from display
-            annotations = annotations.filter(a => a.type !== 'scale_reference');
-            redrawCanvas();
-          }
-        } catch (error) {
-          console.error('Error resetting scale:', error);
-        }
-      }
-    });
-    
-    document.getElementById('measure-btn').addEventListener('click', () => {
-      currentAction = 'measure';
-      points = [];
-      updateStatus('Click two points to create a measurement rectangle.');
-    });
-    
-    document.getElementById('clear-btn').addEventListener('click', async () => {
-      if (confirm('Clear all annotations on this page?')) {
-        try {
-          const response = await fetch('/api/clear_annotations', {
-            method: 'POST',
-            headers: {'Content-Type': 'application/json'}
-          });
-          const result = await response.json();
-          if (result.success) {
-            updateStatus(result.message);
-            // Keep only scale reference in annotations
-            annotations = annotations.filter(a => a.type === 'scale_reference');
-            redrawCanvas();
-          }
-        } catch (error) {
-          console.error('Error clearing annotations:', error);
-        }
-      }
-    });
-    
-    document.getElementById('save-pdf-btn').addEventListener('click', async () => {
-      updateStatus('Saving PDF...');
-      try {
-        const response = await fetch('/api/save_pdf', {
-          method: 'POST',
-          headers: {'Content-Type': 'application/json'}
-        });
-        const result = await response.json();
-        if (result.success) {
-          updateStatus('PDF saved. Downloading...');
-          // Trigger download
-          window.location.href = result.download_url;
-        } else {
-          updateStatus('Error saving PDF: ' + result.error);
-        }
-      } catch (error) {
-        console.error('Error saving PDF:', error);
-        updateStatus('Error saving PDF');
-      }
-    });
-    
-    document.getElementById('save-excel-btn').addEventListener('click', async () => {
-      updateStatus('Exporting data to Excel...');
-      try {
-        const response = await fetch('/api/save_excel', {
-          method: 'POST',
-          headers: {'Content-Type': 'application/json'}
-        });
-        const result = await response.json();
-        if (result.success) {
-          updateStatus('Data exported. Downloading Excel file...');
-          // Trigger download
-          window.location.href = result.download_url;
-        } else {
-          updateStatus('Error exporting data: ' + (result.error || 'No data to export'));
-        }
-      } catch (error) {
-        console.error('Error exporting data:', error);
-        updateStatus('Error exporting data');
-      }
-    });
-    
-    // Scale modal handlers
-    document.getElementById('confirm-scale-btn').addEventListener('click', async () => {
-      const knownDistance = parseFloat(document.getElementById('known-distance').value);
-      if (isNaN(knownDistance) || knownDistance <= 0) {
-        alert('Please enter a valid distance');
-        return;
-      }
-      
-      try {
-        const response = await fetch('/api/set_scale', {
-          method: 'POST',
-          headers: {'Content-Type': 'application/json'},
-          body: JSON.stringify({
-            points: points,
-            known_distance: knownDistance
-          })
-        });
-        const result = await response.json();
-        if (result.success) {
-          document.getElementById('reset-scale-btn').disabled = false;
-          document.getElementById('measure-btn').disabled = false;
-          updateStatus(result.message);
-          
-          // Add scale reference to annotations
-          const scaleIndex = annotations.findIndex(a => a.type === 'scale_reference');
-          if (scaleIndex !== -1) {
-            annotations.splice(scaleIndex, 1);
-          }
-          
-          annotations.push({
-            type: 'scale_reference',
-            points: points,
-            label: `Scale: ${knownDistance} units = ${
-              Math.sqrt(
-                Math.pow(points[1][0] - points[0][0], 2) + 
-                Math.pow(points[1][1] - points[0][1], 2)
-              ).toFixed(1)
-            } pixels`
-          });
-          
-          hideModal('scale-modal');
-          points = [];
-          currentAction = null;
-          redrawCanvas();
-        }
-      } catch (error) {
-        console.error('Error setting scale:', error);
-      }
-    });
-    
-    document.getElementById('cancel-scale-btn').addEventListener('click', () => {
-      hideModal('scale-modal');
-      points = [];
-      currentAction = null;
-      redrawCanvas();
-    });
-    
-    // Function to categorize activity type
-function categorizeActivityType(type) {
-  // Convert to lowercase for case-insensitive comparison
-  const lowercaseType = type.toLowerCase();
-  
-  // Line-based activities
-  const lineActivities = ['wall', 'door', 'window', 'panel'];
-  
-  // Area-based activities
-  const areaActivities = ['floor', 'ceiling', 'pillar'];
-  
-  if (lineActivities.includes(lowercaseType)) {
-    return 'line';
-  } else if (areaActivities.includes(lowercaseType)) {
-    return 'area';
-  }
-  
-  // Default to area if not recognized
-  return 'area';
-}
-
-// Modify the confirm measure button event listener
-document.getElementById('confirm-measure-btn').addEventListener('click', async () => {
-  const rectType = document.getElementById('rect-type').value || 'Unknown';
-  const rectName = document.getElementById('rect-name').value || `Item ${annotations.length + 1}`;
-  
-  // Categorize activity type
-  const activityCategory = categorizeActivityType(rectType);
-  
-  try {
-    const p1 = points[0];
-    const p2 = points[1];
-    const width = Math.abs(p2[0] - p1[0]);
-    const height = Math.abs(p2[1] - p1[1]);
-    
-    // Calculate length based on canvas points
-    const length = activityCategory === 'line' 
-      ? Math.sqrt(width * width + height * height)  // Diagonal length for line
-      : width;  // For area, use width as length
-    
-    const response = await fetch('/api/create_annotation', {
-      method: 'POST',
-      headers: {'Content-Type': 'application/json'},
-      body: JSON.stringify({
-        type: 'square',
-        points: points,
-        label: `${rectName} (${rectType})`,
-        rect_type: rectType,
-        rect_name: rectName,
-        rect_height: activityCategory === 'area' ? height : 0,
-        parent_area: '',
-        replicas: 1,
-        unit: activityCategory === 'line' ? 'running meter' : 'square meter'
-      })
-    });
-    
-    const result = await response.json();
-    if (result.success) {
-      updateStatus(result.message);
-      
-      // Modify label to show appropriate measurements
-      let annotationLabel = `${rectName} (${rectType})`;
-      if (activityCategory === 'line') {
-        annotationLabel += ` - Length: ${(length.toFixed(2))} running meters`;
-      } else {
-        annotationLabel += ` - ${(width.toFixed(2))} x ${(height.toFixed(2))} square meters`;
-      }
-      
-      // Add annotation locally
-      annotations.push({
-        type: 'square',
-        points: points,
-        label: annotationLabel
-      });
-      
-      hideModal('measure-modal');
-      points = [];
-      currentAction = null;
-      redrawCanvas();
-    }
-  } catch (error) {
-    console.error('Error creating annotation:', error);
-    updateStatus('Error creating annotation');
-  }
-});
-
-// Modify the measurements preview to show different info based on activity type
-document.getElementById('confirm-measure-btn').addEventListener('click', () => {
-  const rectType = document.getElementById('rect-type').value || 'Unknown';
-  const activityCategory = categorizeActivityType(rectType);
-  
-  const p1 = points[0];
-  const p2 = points[1];
-  const width = Math.abs(p2[0] - p1[0]);
-  const height = Math.abs(p2[1] - p1[1]);
-  
-  const pixelLengthDisplay = document.getElementById('pixel-length-display');
-  const originalLengthDisplay = document.getElementById('original-length-display');
-  
-  if (activityCategory === 'line') {
-    // For line, show total length
-    const length = Math.sqrt(width * width + height * height);
-    pixelLengthDisplay.textContent = `Total Length (Pixels): ${length.toFixed(2)} pixels`;
-    originalLengthDisplay.textContent = 'Length will be in running meters';
-  } else {
-    // For area, show width and height
-    pixelLengthDisplay.textContent = `Pixel Dimensions: ${width.toFixed(2)} x ${height.toFixed(2)} pixels`;
-    originalLengthDisplay.textContent = 'Dimensions will be in square meters';
-  }
-});
-    
-    document.getElementById('cancel-measure-btn').addEventListener('click', () => {
-      hideModal('measure-modal');
-      points = [];
-      currentAction = null;
-      redrawCanvas();
-    });
-    
-    // Update canvas click handler
-    canvas.addEventListener('click', (event) => {
-      if (!currentAction) return;
-      
-      const rect = canvas.getBoundingClientRect();
-      const x = event.clientX - rect.left;
-      const y = event.clientY - rect.top;
-      
-      // Add point
-      points.push([x, y]);
-      
-      // Draw point marker
-      ctx.beginPath();
-      ctx.arc(x, y, 5, 0, 2 * Math.PI);
-      ctx.fillStyle = 'orange';
-      ctx.fill();
-      
-      if (points.length === 2) {
-        // Two points collected, proceed based on current action
-        if (currentAction === 'setScale') {
-          showModal('scale-modal');
-        } else if (currentAction === 'measure') {
-          // Show measure modal and pre-populate dimensions
-          const p1 = points[0];
-          const p2 = points[1];
-          const width = Math.abs(p2[0] - p1[0]);
-          const height = Math.abs(p2[1] - p1[1]);
-          
-          // Update modal display
-          document.getElementById('pixel-length-display').textContent = 
-            `Pixel Dimensions: ${width.toFixed(2)} x ${height.toFixed(2)} pixels`;
-          
-          showModal('measure-modal');
-        }
-      }
-    });
-    
-    // Helper functions
-    function updateStatus(message) {
-      document.getElementById('status-bar').textContent = message;
-    }
-    
-    function showModal(modalId) {
-      document.getElementById(modalId).style.display = 'block';
-    }
-    
-    function hideModal(modalId) {
-      document.getElementById(modalId).style.display = 'none';
-    }
-    
-    function redrawCanvas() {
-      // Clear canvas and redraw image
-      ctx.clearRect(0, 0, canvas.width, canvas.height);
-      if (imageObj) {
-        ctx.drawImage(imageObj, 0, 0, canvas.width, canvas.height);
-        
-        // Draw all annotations
-        for (const anno of annotations) {
-          if (anno.type === 'line') {
-            drawLine(anno.points, anno.label);
-          } else if (anno.type === 'square') {
-            drawRect(anno.points, anno.label);
-          } else if (anno.type === 'scale_reference') {
-            drawScaleLine(anno.points, anno.label);
-          }
-        }
-        
-        // Draw current points if any
-        for (const point of points) {
-          ctx.beginPath();
-          ctx.arc(point[0], point[1], 5, 0, 2 * Math.PI);
-          ctx.fillStyle = 'orange';
-          ctx.fill();
-        }
-      }
-    }
-    
-    function drawLine(points, label) {
-      if (points.length !== 2) return;
-      
-      const [start, end] = points;
-      
-      // Draw line
-      ctx.beginPath();
-      ctx.moveTo(start[0], start[1]);
-      ctx.lineTo(end[0], end[1]);
-      ctx.strokeStyle = 'red';
-      ctx.lineWidth = 2;
-      ctx.stroke();
-      
-      // Draw label
-      if (label) {
-        ctx.font = '12px Arial';
-        ctx.fillStyle = 'blue';
-        ctx.fillText(label, start[0], start[1] - 5);
-      }
-    }
-    
-    function drawScaleLine(points, label) {
-      if (points.length !== 2) return;
-      
-      const [start, end] = points;
-      
-      // Draw dashed line
-      ctx.beginPath();
-      ctx.setLineDash([5, 3]);
-      ctx.moveTo(start[0], start[1]);
-      ctx.lineTo(end[0], end[1]);
-      ctx.strokeStyle = 'purple';
-      ctx.lineWidth = 2;
-      ctx.stroke();
-      ctx.setLineDash([]);
-      
-      // Draw endpoints
-      ctx.beginPath();
-      ctx.arc(start[0], start[1], 4, 0, 2 * Math.PI);
-      ctx.arc(end[0], end[1], 4, 0, 2 * Math.PI);
-      ctx.fillStyle = 'purple';
-      ctx.fill();
-      
-      // Draw label
-      if (label) {
-        ctx.font = '12px Arial';
-        ctx.fillStyle = 'purple';
-        ctx.fillText(label, (start[0] + end[0]) / 2, (start[1] + end[1]) / 2 - 8);
-      }
-    }
-    
-    function drawRect(points, label) {
-      if (points.length !== 2) return;
-      
-      const [p1, p2] = points;
-      
-      // Calculate dimensions
-      const x = Math.min(p1[0], p2[0]);
-      const y = Math.min(p1[1], p2[1]);
-      const width = Math.abs(p2[0] - p1[0]);
-      const height = Math.abs(p2[1] - p1[1]);
-      
-      // Draw rectangle
-      ctx.beginPath();
-      ctx.rect(x, y, width, height);
-      ctx.strokeStyle = 'green';
-      ctx.lineWidth = 2;
-      ctx.stroke();
-      
-      // Draw label
-      if (label) {
-        ctx.font = '12px Arial';
-        ctx.fillStyle = 'blue';
-        ctx.fillText(label, x, y - 5);
-      }
-    }
-    
-    // Load page image
-    function loadPageImage() {
-      const imgUrl = "/get_page_image/{{ page_num }}";
-      imageObj = new Image();
-      imageObj.onload = function() {
-        // Set canvas size based on image
-        canvas.width = this.width;
-        canvas.height = this.height;
-        redrawCanvas();
-      };
-      imageObj.src = imgUrl;
-      updateStatus("Page loaded. Ready for annotations.");
-    }
-    
-    // Keyboard shortcuts
-    document.addEventListener('keydown', (event) => {
-      if (event.key === 'Escape') {
-        // Cancel current action
-        if (currentAction) {
-          currentAction = null;
-          points = [];
-          redrawCanvas();
-          updateStatus('Action cancelled.');
-        }
-        // Close any open modal
-        hideModal('scale-modal');
-        hideModal('measure-modal');
-      }
-    });
-    
-    // Initialize
-    loadPageImage();
-  </script>
-</body>
-</html>
-"""
-
 if __name__ == "__main__":
     app.run(debug=True, port=5000)
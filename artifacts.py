@@ -0,0 +1,270 @@
+"""Lifecycle of the files the app writes: uploads and exports.
+
+Every managed file is registered with a kind and a time-to-live; each access
+pushes its expiry out again. Sessions and jobs hold *references* (each with
+its own expiry) on the files they still need, and referenced files are never
+removed. A background sweeper deletes expired files and, while the total is
+over the byte quota, the least recently used unreferenced ones. The state is
+kept in SQLite so every gunicorn worker sees the same picture.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    ttl REAL NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_artifacts_access ON artifacts(last_access);
+
+CREATE TABLE IF NOT EXISTS artifact_refs (
+    path TEXT NOT NULL REFERENCES artifacts(path) ON DELETE CASCADE,
+    holder TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (path, holder)
+);
+CREATE INDEX IF NOT EXISTS idx_artifact_refs_holder ON artifact_refs(holder);
+
+CREATE TABLE IF NOT EXISTS artifact_evictions (
+    at REAL NOT NULL,
+    kind TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_artifact_evictions_at ON artifact_evictions(at);
+"""
+
+# Eviction history kept for the rate metric
+EVICTION_HISTORY = 24 * 3600
+
+
+class ArtifactStore:
+
+    def __init__(self, path, quota_bytes, ttls, sweep_interval=60):
+        """``ttls`` maps each artifact kind to its time-to-live in seconds."""
+        self.path = path
+        self.quota_bytes = quota_bytes
+        self.ttls = ttls
+        self.sweep_interval = sweep_interval
+        self.on_evict = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self._stop = threading.Event()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(path)
+
+    # Registration and access
+
+    def register(self, path, kind, ttl=None):
+        """Start managing ``path`` (or refresh its size and expiry)."""
+        path = self._key(path)
+        ttl = ttl if ttl is not None else self.ttls[kind]
+        now = time.time()
+        size = os.path.getsize(path)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO artifacts (path, kind, size, ttl, created_at, last_access, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET size = excluded.size, ttl = excluded.ttl, "
+                "last_access = excluded.last_access, expires_at = excluded.expires_at",
+                (path, kind, size, ttl, now, now, now + ttl),
+            )
+
+    def touch(self, path):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE artifacts SET last_access = ?, expires_at = ? + ttl WHERE path = ?",
+                (now, now, self._key(path)),
+            )
+
+    def discard(self, path):
+        """Delete a file now (e.g. superseded by a newer export)."""
+        path = self._key(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        with self._connect() as conn:
+            conn.execute("DELETE FROM artifacts WHERE path = ?", (path,))
+
+    def adopt(self, directory, kind, suffix=''):
+        """Register files in ``directory`` written before they were managed,
+        aged from their modification time."""
+        if not os.path.isdir(directory):
+            return 0
+        known = {row['path'] for row in self._connect().execute("SELECT path FROM artifacts WHERE kind = ?", (kind,))}
+        ttl = self.ttls[kind]
+        rows = []
+        for entry in os.scandir(directory):
+            path = self._key(entry.path)
+            if entry.is_file() and entry.name.endswith(suffix) and path not in known:
+                stat = entry.stat()
+                rows.append((path, kind, stat.st_size, ttl, stat.st_mtime, stat.st_mtime, stat.st_mtime + ttl))
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO artifacts (path, kind, size, ttl, created_at, last_access, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    # References
+
+    def ref(self, path, holder, ttl):
+        """Keep ``path`` alive for ``holder`` for another ``ttl`` seconds."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO artifact_refs (path, holder, expires_at) SELECT path, ?, ? FROM artifacts WHERE path = ? "
+                "ON CONFLICT(path, holder) DO UPDATE SET expires_at = excluded.expires_at",
+                (holder, time.time() + ttl, self._key(path)),
+            )
+
+    def unref(self, path, holder):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM artifact_refs WHERE path = ? AND holder = ?", (self._key(path), holder))
+
+    def release(self, holder):
+        """Drop every reference ``holder`` has."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM artifact_refs WHERE holder = ?", (holder,))
+
+    @contextmanager
+    def hold(self, paths, holder, ttl=24 * 3600):
+        """Reference ``paths`` for the duration of a block (e.g. a job)."""
+        for path in paths:
+            self.ref(path, holder, ttl)
+        try:
+            yield
+        finally:
+            self.release(holder)
+
+    # Sweeping
+
+    def sweep(self):
+        """Delete expired files, then least recently used ones while over quota.
+        Referenced files are skipped. Returns the number of files removed."""
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM artifact_refs WHERE expires_at < ?", (now,))
+            conn.execute("DELETE FROM artifact_evictions WHERE at < ?", (now - EVICTION_HISTORY,))
+
+        unreferenced = "NOT EXISTS (SELECT 1 FROM artifact_refs r WHERE r.path = a.path)"
+        expired = conn.execute(
+            f"SELECT path, kind, size FROM artifacts a WHERE expires_at < ? AND {unreferenced}", (now,)
+        ).fetchall()
+        removed = sum(self._evict(row, 'expired') for row in expired)
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+        if total > self.quota_bytes:
+            for row in conn.execute(f"SELECT path, kind, size FROM artifacts a WHERE {unreferenced} "
+                                    "ORDER BY last_access").fetchall():
+                if total <= self.quota_bytes:
+                    break
+                if self._evict(row, 'quota'):
+                    removed += 1
+                total -= row['size']
+        return removed
+
+    def _evict(self, row, reason):
+        path = row['path']
+        try:
+            os.remove(path)
+            evicted = True
+        except FileNotFoundError:
+            # Gone already (another worker's sweep, or removed by hand)
+            evicted = False
+        except OSError as e:
+            logging.warning(f"Could not evict {path}: {e}")
+            return False
+        with self._connect() as conn:
+            conn.execute("DELETE FROM artifacts WHERE path = ?", (path,))
+            if evicted:
+                conn.execute("INSERT INTO artifact_evictions (at, kind, reason, size) VALUES (?, ?, ?, ?)",
+                             (time.time(), row['kind'], reason, row['size']))
+        if evicted:
+            callback = self.on_evict.get(row['kind'])
+            if callback is not None:
+                try:
+                    callback(path)
+                except Exception as e:
+                    logging.warning(f"Eviction callback for {path} failed: {e}")
+        return evicted
+
+    def start_sweeper(self):
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_loop, name='artifact-sweeper', daemon=True)
+                self._sweeper.start()
+
+    def _sweep_loop(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                removed = self.sweep()
+                if removed:
+                    logging.info(f"Artifact sweep removed {removed} files")
+            except Exception as e:
+                logging.error(f"Artifact sweep failed: {e}")
+
+    def shutdown(self):
+        self._stop.set()
+
+    # Metrics
+
+    def stats(self):
+        conn = self._connect()
+        now = time.time()
+        by_kind = {
+            row['kind']: {'files': row['files'], 'bytes': row['bytes']}
+            for row in conn.execute("SELECT kind, COUNT(*) AS files, SUM(size) AS bytes FROM artifacts GROUP BY kind")
+        }
+        referenced = conn.execute("SELECT COUNT(DISTINCT path) FROM artifact_refs WHERE expires_at >= ?",
+                                  (now,)).fetchone()[0]
+        evictions = {
+            row['reason']: {'files': row['files'], 'bytes': row['bytes']}
+            for row in conn.execute(
+                "SELECT reason, COUNT(*) AS files, SUM(size) AS bytes FROM artifact_evictions WHERE at >= ? "
+                "GROUP BY reason",
+                (now - 3600,),
+            )
+        }
+        bytes_in_use = sum(kind['bytes'] for kind in by_kind.values())
+        return {
+            'bytes_in_use': bytes_in_use,
+            'quota_bytes': self.quota_bytes,
+            'usage': bytes_in_use / self.quota_bytes if self.quota_bytes else 0.0,
+            'files': sum(kind['files'] for kind in by_kind.values()),
+            'referenced_files': referenced,
+            'by_kind': by_kind,
+            'evictions_last_hour': evictions,
+            'evictions_per_minute': sum(e['files'] for e in evictions.values()) / 60,
+        }
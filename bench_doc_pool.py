@@ -0,0 +1,107 @@
+"""Time cache-miss tile requests with and without the document pool.
+
+Usage:
+    python bench_doc_pool.py [drawing.pdf] [--pages 300] [--requests 200] [--threads 1] [--zoom 1.0]
+
+Every request renders one random tile through ``PyMuPDFRenderer.render_tile``,
+which is what /api/tile does when the tile isn't cached. Without the pool each
+request opens (and parses) the document first. Without a PDF, a synthetic
+drawing set of ``--pages`` A1 pages with some vector content is used.
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz  # PyMuPDF
+
+from doc_pool import DocumentPool
+from rendering import get_renderer
+
+
+def make_pdf(path, pages, rng):
+    with fitz.open() as doc:
+        for _ in range(pages):
+            page = doc.new_page(width=2384, height=1684)
+            shape = page.new_shape()
+            for _ in range(200):
+                x, y = rng.uniform(0, 2300), rng.uniform(0, 1600)
+                shape.draw_line((x, y), (x + rng.uniform(-80, 80), y + rng.uniform(-80, 80)))
+            shape.finish(color=(0, 0, 0), width=0.5)
+            shape.commit()
+        doc.save(path, garbage=1, deflate=True)
+
+
+def run(renderer, pdf_path, tiles, zoom, tile_size, threads):
+    def request(tile):
+        page_num, tile_x, tile_y = tile
+        start = time.perf_counter()
+        renderer.render_tile(pdf_path, page_num, zoom, tile_x, tile_y, tile_size)
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        timings = sorted(executor.map(request, tiles))
+    elapsed = time.perf_counter() - start
+    return {
+        'mean_ms': statistics.mean(timings),
+        'p50_ms': timings[len(timings) // 2],
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'requests_per_s': len(timings) / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pdf', nargs='?')
+    parser.add_argument('--pages', type=int, default=300)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--zoom', type=float, default=1.0)
+    parser.add_argument('--tile-size', type=int, default=512)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    pdf_path = args.pdf
+    if pdf_path is None:
+        fd, pdf_path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        make_pdf(pdf_path, args.pages, rng)
+
+    with fitz.open(pdf_path) as doc:
+        rects = [page.rect for page in doc]
+    tiles = []
+    for _ in range(args.requests):
+        page_num = rng.randrange(len(rects))
+        cols = max(1, int(rects[page_num].width * args.zoom // args.tile_size))
+        rows = max(1, int(rects[page_num].height * args.zoom // args.tile_size))
+        tiles.append((page_num, rng.randrange(cols), rng.randrange(rows)))
+
+    documents = DocumentPool()
+    methods = [
+        ('open per request', get_renderer('pymupdf')),
+        ('pooled', get_renderer('pymupdf', documents=documents)),
+    ]
+
+    print(f"{len(rects)} pages, {os.path.getsize(pdf_path) / 1024 / 1024:.1f} MB, "
+          f"{args.requests} requests on {args.threads} threads")
+    header = f"{'method':<18}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'req/s':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, renderer in methods:
+        result = run(renderer, pdf_path, tiles, args.zoom, args.tile_size, args.threads)
+        print(f"{name:<18}{result['mean_ms']:>10.1f}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+              f"{result['requests_per_s']:>10.1f}")
+    stats = documents.stats()
+    print(f"pool: {stats['hits']} hits, {stats['misses']} misses, hit rate {stats['hit_rate']:.1%}")
+
+    documents.close()
+    if args.pdf is None:
+        os.remove(pdf_path)
+
+
+if __name__ == "__main__":
+    main()
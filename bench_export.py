@@ -0,0 +1,108 @@
+"""Time drawing annotation layers for the PDF export.
+
+Usage:
+    python bench_export.py [drawing.pdf] [--pages 5] [--annotations 1000] [--repeat 3]
+
+Compares the old per-annotation drawing (four ``page.draw_line`` calls and an
+``insert_text`` per rectangle, each committing its own content stream) with
+``pdf_export.draw_annotations``, which batches a page into one Shape. Without
+a PDF, blank A1 pages are used. Times cover drawing plus a full save.
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import fitz  # PyMuPDF
+
+from page_geometry import PageGeometryIndex
+from pdf_export import draw_annotations
+
+
+def legacy_draw(page, annotations, page_geometry):
+    # What save_pdf did before the layer was batched into one Shape
+    for anno in annotations:
+        (x1, y1), (x2, y2) = anno['points']
+        if anno['type'] == 'line':
+            page.draw_line((x1, y1), (x2, y2), color=(1, 0, 0), width=2)
+        else:
+            page.draw_line((x1, y1), (x2, y1), color=(0, 1, 0), width=2)
+            page.draw_line((x2, y1), (x2, y2), color=(0, 1, 0), width=2)
+            page.draw_line((x2, y2), (x1, y2), color=(0, 1, 0), width=2)
+            page.draw_line((x1, y2), (x1, y1), color=(0, 1, 0), width=2)
+        page.insert_text((x1, y1 - 10), anno.get('label', ''), color=(0, 0, 1))
+
+
+def make_annotations(page_geometry, count, rng):
+    width, height = page_geometry['width'], page_geometry['height']
+    annotations = []
+    for i in range(count):
+        x, y = rng.uniform(0, width - 60), rng.uniform(20, height - 60)
+        annotations.append({
+            'type': 'line' if i % 4 == 0 else 'square',
+            'points': [[x, y], [x + rng.uniform(5, 60), y + rng.uniform(5, 60)]],
+            'label': f"R{i}",
+        })
+    return annotations
+
+
+def run(draw, pdf_path, geometry, annotations, repeat):
+    timings = []
+    size = 0
+    for _ in range(repeat):
+        fd, out_path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        start = time.perf_counter()
+        with fitz.open(pdf_path) as doc:
+            for page_num, page_annotations in annotations.items():
+                draw(doc[page_num], page_annotations, geometry.page(page_num))
+            doc.save(out_path, garbage=1, deflate=True)
+        timings.append(time.perf_counter() - start)
+        size = os.path.getsize(out_path)
+        os.remove(out_path)
+    return statistics.median(timings), size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pdf', nargs='?')
+    parser.add_argument('--pages', type=int, default=5)
+    parser.add_argument('--annotations', type=int, default=1000, help='annotations per page')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip-legacy', action='store_true')
+    args = parser.parse_args()
+
+    pdf_path = args.pdf
+    if pdf_path is None:
+        fd, pdf_path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        with fitz.open() as doc:
+            for _ in range(args.pages):
+                doc.new_page(width=2384, height=1684)
+            doc.save(pdf_path)
+
+    geometry = PageGeometryIndex.build(pdf_path)
+    rng = random.Random(0)
+    pages = min(args.pages, len(geometry))
+    annotations = {p: make_annotations(geometry.page(p), args.annotations, rng) for p in range(pages)}
+
+    methods = [('shape batch', draw_annotations)]
+    if not args.skip_legacy:
+        methods.insert(0, ('per call', legacy_draw))
+
+    header = f"{'method':<14}{'pages':>6}{'annots':>8}{'total s':>10}{'ms/page':>10}{'out KB':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, draw in methods:
+        seconds, size = run(draw, pdf_path, geometry, annotations, args.repeat)
+        print(f"{name:<14}{pages:>6}{args.annotations:>8}{seconds:>10.2f}{seconds / pages * 1000:>10.1f}"
+              f"{size / 1024:>10.1f}")
+
+    if args.pdf is None:
+        os.remove(pdf_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Compare page rendering backends on latency and peak RSS.
+
+Usage:
+    python bench_render.py drawing.pdf [--pages 10] [--zoom 1.5] [--format png] [--repeat 3]
+
+Each backend runs in its own child process so that peak RSS is not polluted by
+the other backend. For poppler the ``pdftoppm`` subprocesses are reported
+separately (RUSAGE_CHILDREN), since that is where its memory goes.
+"""
+import argparse
+import json
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+
+def run_backend(backend, pdf_path, pages, zoom, fmt, repeat):
+    import fitz
+    from rendering import get_renderer
+
+    with fitz.open(pdf_path) as doc:
+        page_count = min(len(doc), pages)
+
+    renderer = get_renderer(backend)
+    timings = []
+    out_bytes = 0
+    for _ in range(repeat):
+        for page_num in range(page_count):
+            start = time.perf_counter()
+            data = renderer.render(pdf_path, page_num, zoom, fmt)
+            timings.append((time.perf_counter() - start) * 1000)
+            out_bytes += len(data)
+
+    # ru_maxrss is in KiB on Linux
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    timings.sort()
+    return {
+        'backend': backend,
+        'renders': len(timings),
+        'mean_ms': statistics.mean(timings),
+        'p50_ms': timings[len(timings) // 2],
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'peak_rss_mb': self_rss / 1024,
+        'peak_child_rss_mb': child_rss / 1024,
+        'avg_image_kb': out_bytes / len(timings) / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pdf')
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--zoom', type=float, default=1.5)
+    parser.add_argument('--format', default='png')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--backends', default='pymupdf,poppler')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_backend(args.child, args.pdf, args.pages, args.zoom, args.format, args.repeat)
+        print(json.dumps(result))
+        return
+
+    results = []
+    for backend in args.backends.split(','):
+        cmd = [sys.executable, __file__, args.pdf, '--pages', str(args.pages), '--zoom', str(args.zoom),
+               '--format', args.format, '--repeat', str(args.repeat), '--child', backend]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"{backend}: failed\n{proc.stderr}", file=sys.stderr)
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    header = f"{'backend':<10}{'renders':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'rss MB':>10}{'child MB':>10}{'img KB':>10}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['backend']:<10}{r['renders']:>8}{r['mean_ms']:>10.1f}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}"
+              f"{r['peak_rss_mb']:>10.1f}{r['peak_child_rss_mb']:>10.1f}{r['avg_image_kb']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
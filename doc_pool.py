@@ -0,0 +1,162 @@
+"""Open PyMuPDF documents kept around between requests.
+
+Opening a large drawing set parses its xref table and page tree every time;
+for a few hundred pages that costs more than rendering a tile. A
+``DocumentPool`` keeps a bounded number of documents open per process (one
+per gunicorn worker, one per pre-render process), least recently used first
+out, and closes those nobody has touched for ``idle_timeout`` seconds.
+
+A MuPDF document must not be used from two threads at once, so a checkout
+is exclusive: a second thread wanting the same document waits for it.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import fitz  # PyMuPDF
+
+
+class _Entry:
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.lock = threading.Lock()
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.evicted = False
+
+
+class DocumentPool:
+
+    def __init__(self, max_open=8, idle_timeout=300):
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @contextmanager
+    def checkout(self, path, key=None):
+        """Yield the open document for ``path`` (opening it if needed). ``key``
+        defaults to the path; uploads are stored by content hash, so the path
+        already identifies the document."""
+        key = key or path
+        entry = self._acquire(key, path)
+        try:
+            with entry.lock:
+                yield entry.doc
+        finally:
+            self._release(entry)
+
+    def _acquire(self, key, path):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry.users += 1
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # Opened outside the pool lock, so other documents aren't held up
+        doc = fitz.open(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # Another thread opened it meanwhile; use theirs
+                doc.close()
+            else:
+                entry = _Entry(doc)
+                self._entries[key] = entry
+            entry.users += 1
+            self._entries.move_to_end(key)
+            victims = self._trim()
+        self._close(victims)
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+            close = entry.evicted and entry.users == 0
+            victims = self._trim()
+        if close:
+            entry.doc.close()
+        self._close(victims)
+
+    def _trim(self):
+        # Caller holds self._lock. Checked-out documents are closed when returned.
+        now = time.monotonic()
+        victims = []
+        for key, entry in list(self._entries.items()):
+            over = len(self._entries) > self.max_open
+            if not over and now - entry.last_used < self.idle_timeout:
+                break
+            del self._entries[key]
+            entry.evicted = True
+            self.evictions += 1
+            if entry.users == 0:
+                victims.append(entry)
+        return victims
+
+    @staticmethod
+    def _close(entries):
+        for entry in entries:
+            try:
+                entry.doc.close()
+            except Exception as e:
+                logging.warning(f"Closing a pooled document failed: {e}")
+
+    def close_idle(self):
+        """Close documents idle for longer than ``idle_timeout``."""
+        with self._lock:
+            victims = self._trim()
+        self._close(victims)
+        return len(victims)
+
+    def discard(self, path, key=None):
+        """Drop a document (e.g. its file was replaced or deleted)."""
+        with self._lock:
+            entry = self._entries.pop(key or path, None)
+            if entry is None:
+                return
+            entry.evicted = True
+            close = entry.users == 0
+        if close:
+            entry.doc.close()
+
+    def close(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            for entry in entries:
+                entry.evicted = True
+        self._close([entry for entry in entries if entry.users == 0])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'open': len(self._entries),
+                'checked_out': sum(1 for entry in self._entries.values() if entry.users),
+                'max_open': self.max_open,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+
+@contextmanager
+def open_document(path, documents=None):
+    """A pooled document if ``documents`` is given, else a fresh one closed afterwards."""
+    if documents is None:
+        with fitz.open(path) as doc:
+            yield doc
+    else:
+        with documents.checkout(path) as doc:
+            yield doc
@@ -0,0 +1,134 @@
+"""Excel export of a project's measurement rows.
+
+The workbook is written with XlsxWriter in ``constant_memory`` mode: rows go
+from the project store cursor straight into each sheet's temp file, so memory
+stays flat however large the project is. The "All" sheet and one sheet per
+page list the rows grouped by Area Type, each group closed by a subtotal row.
+"""
+import xlsxwriter
+from xlsxwriter.utility import xl_range
+
+from measurements import LINE_UNIT
+
+HEADERS = ['Name', 'Parent Area', 'Drawing Length', 'Drawing Width', 'Drawing Height', 'Drawing Area',
+           'Drawing Number Of Replicas', 'Unit', 'Area Type', 'Quantity', 'Page']
+COLUMN_WIDTHS = [24, 18, 14, 14, 14, 14, 14, 8, 16, 14, 8]
+QUANTITY_COL = HEADERS.index('Quantity')
+
+# Every constant_memory sheet keeps a temp file open until the workbook is
+# closed, so projects with more pages than this only get the "All" sheet
+MAX_PAGE_SHEETS = 250
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def quantity(length, width, area, replicas, unit):
+    """Running length for RMT rows, area for everything else, times replicas.
+    Rows from before the area column have length x width instead."""
+    length, width, area, replicas = _number(length), _number(width), _number(area), _number(replicas)
+    if replicas is None:
+        return None
+    if unit == LINE_UNIT:
+        return length * replicas if length is not None else None
+    if area is not None:
+        return area * replicas
+    if length is None or width is None:
+        return None
+    return length * width * replicas
+
+
+class _SheetWriter:
+
+    def __init__(self, workbook, name, formats, page_num=None):
+        self.sheet = workbook.add_worksheet(name)
+        self.page_num = page_num
+        self.formats = formats
+        for col, width in enumerate(COLUMN_WIDTHS):
+            self.sheet.set_column(col, col, width)
+        self.sheet.freeze_panes(1, 0)
+        self.sheet.write_row(0, 0, HEADERS, formats['header'])
+        self.row = 1
+        self.rows_written = 0
+        self._group = None
+
+    def write(self, page_num, measurement):
+        # measurement is a row in MEASUREMENT_COLUMNS order
+        name, parent_area, length, width, height, area, replicas, unit, area_type = measurement
+        if self._group is not None and self._group['area_type'] != area_type:
+            self._close_group()
+        if self._group is None:
+            self._group = {'area_type': area_type, 'start': self.row, 'units': set(), 'total': 0.0}
+
+        qty = quantity(length, width, area, replicas, unit)
+        sheet, row = self.sheet, self.row
+        sheet.write_row(row, 0, [name, parent_area, length, width, height, area, replicas, unit, area_type])
+        if qty is not None:
+            sheet.write_number(row, QUANTITY_COL, qty, self.formats['number'])
+            self._group['total'] += qty
+        sheet.write_number(row, QUANTITY_COL + 1, page_num + 1)
+        self._group['units'].add(unit)
+        self.row += 1
+        self.rows_written += 1
+
+    def _close_group(self):
+        group = self._group
+        self._group = None
+        bold = self.formats['subtotal']
+        units = group['units']
+        self.sheet.write_string(self.row, 0, f"Subtotal: {group['area_type'] or 'Unknown'}", bold)
+        self.sheet.write(self.row, HEADERS.index('Unit'), units.pop() if len(units) == 1 else '', bold)
+        # SUBTOTAL (not SUM) so Excel's own totals over the column skip these rows
+        cells = xl_range(group['start'], QUANTITY_COL, self.row - 1, QUANTITY_COL)
+        self.sheet.write_formula(self.row, QUANTITY_COL, f"=SUBTOTAL(9,{cells})", self.formats['subtotal_number'],
+                                 group['total'])
+        self.row += 1
+
+    def close(self):
+        if self._group is not None:
+            self._close_group()
+
+
+def write_measurements(path, store, project_id, page_sheets=True, max_page_sheets=MAX_PAGE_SHEETS, progress=None):
+    """Write the project's measurements to an .xlsx file at ``path``.
+    ``progress(done, total)`` is called as rows are written.
+    Returns the number of measurement rows written."""
+    page_sheets = page_sheets and len(store.measurement_pages(project_id)) <= max_page_sheets
+    total = store.count_measurements(project_id) * (2 if page_sheets else 1)
+    written = 0
+    with xlsxwriter.Workbook(path, {'constant_memory': True}) as workbook:
+        formats = {
+            'header': workbook.add_format({'bold': True, 'bottom': 1}),
+            'number': workbook.add_format({'num_format': '0.000'}),
+            'subtotal': workbook.add_format({'bold': True, 'top': 1}),
+            'subtotal_number': workbook.add_format({'bold': True, 'top': 1, 'num_format': '0.000'}),
+        }
+
+        all_rows = _SheetWriter(workbook, 'All', formats)
+        for page_num, *measurement in store.iter_measurements(project_id, order_by='area_type'):
+            all_rows.write(page_num, measurement)
+            written += 1
+            if progress:
+                progress(written, total)
+        all_rows.close()
+
+        if page_sheets:
+            # One pass in page order, starting a new sheet whenever the page changes
+            page_rows = None
+            for page_num, *measurement in store.iter_measurements(project_id, order_by='page'):
+                if page_rows is None or page_rows.page_num != page_num:
+                    if page_rows is not None:
+                        page_rows.close()
+                    page_rows = _SheetWriter(workbook, f"Page {page_num + 1}", formats, page_num)
+                page_rows.write(page_num, measurement)
+                written += 1
+                if progress:
+                    progress(written, total)
+            if page_rows is not None:
+                page_rows.close()
+
+    return all_rows.rows_written
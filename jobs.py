@@ -0,0 +1,327 @@
+"""Background jobs for the heavy endpoints.
+
+Jobs run on small thread pools ("lanes") inside the web process, so a long
+export never holds a request thread, and work in one lane never waits behind
+another: quick jobs go to ``interactive``, exports and renders to ``bulk``.
+Every job has a row in a SQLite table, so any gunicorn worker can report on
+it or cancel it; the worker running the job notices the cancel flag the next
+time the job reports progress.
+
+Work that already has its own pool (background page rendering) is *tracked*
+instead: ``track`` creates the row and the pool reports progress with
+``update_tracked``.
+"""
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    lane TEXT NOT NULL,
+    project_id TEXT,
+    job_key TEXT,
+    state TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    pid INTEGER,
+    process_token TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_key ON jobs(kind, job_key, state);
+CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs(finished_at);
+"""
+
+ACTIVE_STATES = ('queued', 'running')
+FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+# How often a running job writes its progress (and looks for a cancel request)
+PROGRESS_INTERVAL = 0.5
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """Handed to a job function: report progress and honour cancellation."""
+
+    def __init__(self, manager, job_id):
+        self.manager = manager
+        self.id = job_id
+        self._last_report = 0.0
+
+    def progress(self, done, total=None):
+        # Throttled, so tight loops can call this on every item
+        now = time.monotonic()
+        if now - self._last_report < PROGRESS_INTERVAL and not (total and done >= total):
+            return
+        self._last_report = now
+        if self.manager._report(self.id, done, total):
+            raise JobCancelled()
+
+    def check_cancelled(self):
+        if self.manager._cancel_requested(self.id):
+            raise JobCancelled()
+
+
+class JobManager:
+
+    def __init__(self, path, lanes=None, retention=7 * 24 * 3600):
+        self.path = path
+        self.lanes = lanes or {'interactive': 2, 'bulk': 1}
+        self.retention = retention
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._queues = {}
+        self._threads = []
+        self._lock = threading.Lock()
+        self._cancel_callbacks = {}
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            self._migrate(conn)
+        self._recover()
+
+    @staticmethod
+    def _migrate(conn):
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if 'process_token' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN process_token TEXT")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _recover(self):
+        # Jobs of processes that are gone will never finish; drop old history too
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT id, pid, process_token FROM jobs WHERE state IN ({', '.join('?' * len(ACTIVE_STATES))})",
+                ACTIVE_STATES,
+            ).fetchall()
+            dead = [row['id'] for row in rows if not _process_alive(row['pid'], row['process_token'])]
+            conn.executemany(
+                "UPDATE jobs SET state = 'failed', error = 'Interrupted', finished_at = ? WHERE id = ?",
+                [(now, job_id) for job_id in dead],
+            )
+            conn.execute("DELETE FROM jobs WHERE finished_at < ?", (now - self.retention,))
+        if dead:
+            logging.warning(f"Marked {len(dead)} interrupted jobs as failed")
+
+    def _start(self, lane):
+        with self._lock:
+            if lane in self._queues:
+                return self._queues[lane]
+            if lane not in self.lanes:
+                raise ValueError(f"Unknown job lane: {lane}")
+            # Threads start lazily, so importing the app doesn't spin them up
+            lane_queue = queue.Queue()
+            self._queues[lane] = lane_queue
+            for i in range(self.lanes[lane]):
+                thread = threading.Thread(target=self._work, args=(lane_queue,), name=f"jobs-{lane}-{i}",
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            return lane_queue
+
+    def _insert(self, kind, lane, project_id, key, state, total):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, lane, project_id, job_key, state, total, pid, process_token, "
+                "created_at, started_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, lane, project_id, key, state, total, os.getpid(), PROCESS_TOKEN, now,
+                 now if state == 'running' else None),
+            )
+        return job_id
+
+    def submit(self, kind, fn, lane='bulk', project_id=None, total=0):
+        """Queue ``fn(job)`` on ``lane``. Its return value (JSON-serialisable)
+        becomes the job's result. Returns the job ID."""
+        lane_queue = self._start(lane)
+        job_id = self._insert(kind, lane, project_id, None, 'queued', total)
+        lane_queue.put((job_id, fn))
+        return job_id
+
+    def _work(self, lane_queue):
+        while True:
+            job_id, fn = lane_queue.get()
+            if job_id is None:
+                return
+            self._run(job_id, fn)
+
+    def _run(self, job_id, fn):
+        with self._connect() as conn:
+            started = conn.execute(
+                "UPDATE jobs SET state = 'running', started_at = ? WHERE id = ? AND state = 'queued' "
+                "AND cancel_requested = 0",
+                (time.time(), job_id),
+            ).rowcount
+        if not started:
+            self._finish(job_id, 'cancelled')
+            return
+
+        try:
+            result = fn(Job(self, job_id))
+        except JobCancelled:
+            self._finish(job_id, 'cancelled')
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {e}")
+            self._finish(job_id, 'failed', error=str(e))
+        else:
+            self._finish(job_id, 'done', result=result)
+
+    def _finish(self, job_id, state, result=None, error=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = ?, result = ?, error = ?, finished_at = ? WHERE id = ? "
+                f"AND state IN ({', '.join('?' * len(ACTIVE_STATES))})",
+                (state, json.dumps(result) if result is not None else None, error, time.time(), job_id,
+                 *ACTIVE_STATES),
+            )
+        with self._lock:
+            self._cancel_callbacks.pop(job_id, None)
+
+    def _report(self, job_id, done, total=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET done = ?, total = COALESCE(?, total) WHERE id = ?", (done, total, job_id)
+            )
+        return self._cancel_requested(job_id)
+
+    def _cancel_requested(self, job_id):
+        row = self._connect().execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row['cancel_requested'])
+
+    # Tracked jobs
+
+    def track(self, kind, key, project_id=None, total=0, on_cancel=None):
+        """Record work driven elsewhere (keyed by ``key``); returns the job ID."""
+        job_id = self._insert(kind, 'tracked', project_id, key, 'running', total)
+        if on_cancel is not None:
+            with self._lock:
+                self._cancel_callbacks[job_id] = on_cancel
+        return job_id
+
+    def update_tracked(self, kind, key, done, total, state=None, error=None):
+        """Update every running tracked job of ``kind`` for ``key``; a
+        ``state`` from FINISHED_STATES finishes them."""
+        rows = self._connect().execute(
+            "SELECT id, cancel_requested FROM jobs WHERE kind = ? AND job_key = ? AND state = 'running'",
+            (kind, key),
+        ).fetchall()
+        for row in rows:
+            if row['cancel_requested']:
+                self._cancel_tracked(row['id'])
+                continue
+            self._report(row['id'], done, total)
+            if state in FINISHED_STATES:
+                self._finish(row['id'], state, error=error)
+
+    def _cancel_tracked(self, job_id):
+        with self._lock:
+            callback = self._cancel_callbacks.pop(job_id, None)
+        if callback is not None:
+            callback()
+        self._finish(job_id, 'cancelled')
+
+    # Queries
+
+    def get(self, job_id):
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        job['cancel_requested'] = bool(job['cancel_requested'])
+        return job
+
+    def tracked_elsewhere(self, kind, key):
+        """ID of a running tracked job of ``kind`` for ``key`` that another
+        live process (another gunicorn worker) is driving, or None."""
+        rows = self._connect().execute(
+            "SELECT id, pid, process_token FROM jobs WHERE kind = ? AND job_key = ? AND state = 'running' "
+            "AND pid != ?",
+            (kind, key, os.getpid()),
+        ).fetchall()
+        return next((row['id'] for row in rows if _process_alive(row['pid'], row['process_token'])), None)
+
+    def cancel(self, job_id):
+        """Ask a job to stop. Queued jobs never start; running ones stop at
+        their next progress report. Returns False if it already finished."""
+        with self._connect() as conn:
+            requested = conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? "
+                f"AND state IN ({', '.join('?' * len(ACTIVE_STATES))})",
+                (job_id, *ACTIVE_STATES),
+            ).rowcount
+        if requested:
+            with self._lock:
+                tracked_here = job_id in self._cancel_callbacks
+            if tracked_here:
+                self._cancel_tracked(job_id)
+        return bool(requested)
+
+    def shutdown(self):
+        with self._lock:
+            queues = dict(self._queues)
+        for lane, lane_queue in queues.items():
+            for _ in range(self.lanes[lane]):
+                lane_queue.put((None, None))
+
+
+def _process_token(pid):
+    # The boot and the process's start time (in clock ticks since boot) tell
+    # one run of a pid from another; None where there's no /proc to ask
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            boot_id = f.read().strip()
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # Fields follow the command name, which may itself contain spaces and parentheses
+    return f"{boot_id}:{stat.rsplit(')', 1)[1].split()[19]}"
+
+
+# Rows carry this next to their pid: pids get reused, notably by a restarted
+# container, whose processes are numbered from 1 again
+PROCESS_TOKEN = _process_token(os.getpid()) or uuid.uuid4().hex
+
+
+def _process_alive(pid, token):
+    """Whether the process that wrote a row with ``pid`` and ``token`` is
+    still running (and not just some later process with the same pid)."""
+    if not pid:
+        return False
+    if pid == os.getpid():
+        return token == PROCESS_TOKEN
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    current = _process_token(pid)
+    return token is None or current is None or token == current
@@ -0,0 +1,154 @@
+"""Measurement maths shared by the single and batch annotation APIs.
+
+Rectangles are given as two corner points in PDF points. Line activities
+(walls, doors, ...) measure the diagonal as a running length, everything else
+measures width x height. Polylines and polygons are lists of vertices: a
+polyline, or a polygon of a line activity, measures its running length; any
+other polygon measures its (shoelace) area. All the work is done on NumPy
+arrays so a batch of thousands of shapes costs about as much as one.
+
+Measurement rows keep lengths and areas in separate columns (see
+``row_dimensions``): the length column is always in metres, the area column
+in square metres.
+"""
+import numpy as np
+
+LINE_ACTIVITIES = ('wall', 'door', 'window', 'panel')
+AREA_ACTIVITIES = ('floor', 'ceiling', 'pillar')
+
+LINE_UNIT = "RMT"  # Running meter
+AREA_UNIT = "Sqmt"  # Square meter
+
+# Annotation types made of any number of vertices, and the fewest each needs
+MIN_SHAPE_POINTS = {'polyline': 2, 'polygon': 3}
+# Shapes are stored to a hundredth of a point
+SHAPE_DECIMALS = 2
+
+
+def is_line_activity(rect_type):
+    return (rect_type or '').lower() in LINE_ACTIVITIES
+
+
+def points_array(items):
+    """Parse a list of ``[[x1, y1], [x2, y2]]`` point pairs into an (N, 2, 2)
+    float array. Returns ``(array, errors)`` where ``errors`` maps the index of
+    every malformed entry to a message; those rows are left as NaN."""
+    points = np.full((len(items), 2, 2), np.nan)
+    errors = {}
+    for i, pair in enumerate(items):
+        try:
+            points[i] = np.asarray(pair, dtype=np.float64).reshape(2, 2)
+        except (TypeError, ValueError) as e:
+            errors[i] = f"Invalid points: {e}"
+    return points, errors
+
+
+def is_shape(annotation_type):
+    return annotation_type in MIN_SHAPE_POINTS
+
+
+def shape_array(points, annotation_type):
+    """Parse a polyline's or polygon's vertices into a (K, 2) float array,
+    rounded for storage. Raises ValueError if they are malformed or too few."""
+    try:
+        array = np.asarray(points, dtype=np.float64)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid points: {e}")
+    if array.ndim != 2 or array.shape[1] != 2 or not np.isfinite(array).all():
+        raise ValueError("Invalid points")
+    if len(array) < MIN_SHAPE_POINTS[annotation_type]:
+        raise ValueError(f"A {annotation_type} needs at least {MIN_SHAPE_POINTS[annotation_type]} points")
+    return np.round(array, SHAPE_DECIMALS)
+
+
+def bounds(points):
+    """(2, 2) bounding box corners of a (K, 2) array, to stand in for a shape
+    wherever only its extent matters (page checks, scale lookups)."""
+    return np.stack([points.min(axis=0), points.max(axis=0)])
+
+
+def outside_page(points, page_widths, page_heights):
+    """Boolean mask of rectangles with a corner off their page (or NaN)."""
+    x, y = points[:, :, 0], points[:, :, 1]
+    inside = (x >= 0) & (x <= page_widths[:, None]) & (y >= 0) & (y <= page_heights[:, None])
+    return ~inside.all(axis=1)
+
+
+def compute_dimensions(points, line_mask, scale):
+    """Width/height of each rectangle in drawing units.
+
+    ``points`` is (N, 2, 2) in PDF points, ``line_mask`` marks line activities
+    and ``scale`` (units per point) is a scalar or an (N,) array. Line
+    activities get their length as width and a height of 0.
+    """
+    delta = np.abs(points[:, 1] - points[:, 0])
+    length = np.hypot(delta[:, 0], delta[:, 1])
+    width = np.where(line_mask, length, delta[:, 0]) * scale
+    height = np.where(line_mask, 0.0, delta[:, 1] * scale)
+    units = np.where(line_mask, LINE_UNIT, AREA_UNIT)
+    return width, height, units
+
+
+def shape_measures(shapes, closed):
+    """Path length (perimeter when closed) and area of N polylines/polygons.
+
+    ``shapes`` is a list of (K, 2) arrays, ``closed`` an (N,) mask of polygons;
+    open shapes get an area of 0. All vertices are processed as one array."""
+    counts = np.array([len(shape) for shape in shapes])
+    starts = np.cumsum(counts) - counts
+    last = starts + counts - 1
+    vertices = np.concatenate(shapes).astype(np.float64)
+    # Each vertex's successor, the last one wrapping round to its shape's first
+    successor = np.arange(len(vertices)) + 1
+    successor[last] = starts
+    following = vertices[successor]
+    edges = np.hypot(*(following - vertices).T)
+    # Open polylines have no closing edge
+    edges[last[~closed]] = 0.0
+    lengths = np.add.reduceat(edges, starts)
+    cross = vertices[:, 0] * following[:, 1] - following[:, 0] * vertices[:, 1]
+    areas = np.where(closed, np.abs(np.add.reduceat(cross, starts)) / 2, 0.0)
+    return lengths, areas
+
+
+def measure_annotations(annotation_types, points, line_mask, scale):
+    """Dimensions of N annotations of any type, as ``compute_dimensions``.
+
+    ``points`` holds each annotation's vertices. Rectangles and running
+    lengths get ``(width, height)`` as there; area polygons get
+    ``(area, perimeter)``."""
+    n = len(annotation_types)
+    scale = np.broadcast_to(np.asarray(scale, dtype=np.float64), (n,))
+    line_mask = np.asarray(line_mask, dtype=bool)
+    widths, heights = np.zeros(n), np.zeros(n)
+    units = np.where(line_mask, LINE_UNIT, AREA_UNIT).astype(object)
+    shape_mask = np.array([is_shape(t) for t in annotation_types], dtype=bool)
+    rects = np.flatnonzero(~shape_mask)
+    if len(rects):
+        rect_points = np.array([points[i] for i in rects], dtype=np.float64).reshape(-1, 2, 2)
+        widths[rects], heights[rects], units[rects] = compute_dimensions(rect_points, line_mask[rects], scale[rects])
+    shapes = np.flatnonzero(shape_mask)
+    if len(shapes):
+        closed = np.array([annotation_types[i] == 'polygon' for i in shapes])
+        lengths, areas = shape_measures([np.asarray(points[i]) for i in shapes], closed)
+        # Only polygons of area activities measure an area
+        area = closed & ~line_mask[shapes]
+        s = scale[shapes]
+        widths[shapes] = np.where(area, areas * s * s, lengths * s)
+        heights[shapes] = np.where(area, lengths * s, 0.0)
+        units[shapes] = np.where(area, AREA_UNIT, LINE_UNIT)
+    return widths, heights, units.astype(str)
+
+
+def row_dimensions(annotation_type, width, height, unit):
+    """The (length, width, area) columns of a measurement row, from the
+    dimensions ``measure_annotations`` gives it.
+
+    Running lengths have a length, a width of 0 and no area. Rectangles have
+    a length, a width and their product as the area. Polygons have no
+    width: their length is the perimeter."""
+    if unit == LINE_UNIT:
+        return round(width, 3), round(height, 3), None
+    if annotation_type == 'polygon':
+        return round(height, 3), None, round(width, 3)
+    return round(width, 3), round(height, 3), round(width * height, 3)
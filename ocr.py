@@ -0,0 +1,297 @@
+"""OCR fallback for scanned drawings.
+
+Scanned sheets have no text layer, so scale detection finds nothing on them.
+For those pages the title-block region is rendered by the regular
+rasterizer, cleaned up with OpenCV (deskewed on the sheet's long horizontal
+lines, then binarized with an adaptive threshold to cope with uneven scan
+lighting) and read by Tesseract. The text lines go through the same scale
+note parser as real text; dimension strings are picked out as well.
+
+OCR is slow, so it runs on a process pool sized to the CPU count and every
+result is kept on disk, keyed by a hash of what the page actually shows (its
+content streams and images), not by document: re-uploading or re-visiting a
+drawing set, or the same sheet turning up in another set, never OCRs a page
+twice.
+
+``opencv-python`` and ``pytesseract`` (plus the ``tesseract`` binary) are
+optional; without them the fallback is switched off.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from doc_pool import DocumentPool, open_document
+from rendering import get_renderer
+from scale_detection import NOT_TO_SCALE, UNITS_M, _fraction, combine, parse_scale_notes
+
+# Bump whenever the pipeline changes, so cached results are redone
+OCR_VERSION = 1
+
+# Where title blocks sit, as fractions of the (rotated) page: along the
+# bottom right, or as a strip down the right-hand edge
+TITLE_BLOCK_REGIONS = ((0.5, 0.65, 1.0, 1.0), (0.8, 0.0, 1.0, 0.65))
+DPI = 300
+# Crops are rendered at a lower resolution rather than past this many pixels a side
+MAX_PIXELS = 8000
+# Skew beyond this is a rotated page (handled by the page rotation), not a crooked scan
+MAX_SKEW_DEGREES = 10.0
+# Words Tesseract is less sure of than this are dropped
+MIN_WORD_CONFIDENCE = 40
+# OCR misreads digits; OCR'd scales never count for quite as much as real text
+CONFIDENCE_FACTOR = 0.85
+
+METRIC_DIMENSION = re.compile(r'(?<![\d.])(\d+(?:[.,]\d+)?)\s*(mm|cm|m)\b', re.I)
+IMPERIAL_DIMENSION = re.compile(r'(?<![\d.])(\d+)\s*[\'’′]\s*-?\s*(\d+(?:\s+\d+/\d+)?|\d+/\d+)?\s*(?:"|”|″)?')
+
+
+def page_key(doc, page_num):
+    """Hash of everything that decides what a page looks like."""
+    page = doc[page_num]
+    digest = hashlib.sha256(f"{OCR_VERSION}:{DPI}:{page.rotation}:{tuple(page.rect)}".encode())
+    digest.update(page.read_contents())
+    for image in page.get_images(full=True):
+        digest.update(doc.xref_stream_raw(image[0]) or b'')
+    return digest.hexdigest()
+
+
+def find_dimensions(lines):
+    """Dimension strings (``3600 mm``, ``12'-6"``) in OCR'd lines, with their
+    length in metres."""
+    dimensions = []
+    for text, bbox in lines:
+        for match in METRIC_DIMENSION.finditer(text):
+            value = float(match.group(1).replace(',', '.')) * UNITS_M[match.group(2).lower()]
+            dimensions.append({'text': match.group(0).strip(), 'metres': value, 'bbox': list(bbox)})
+        for match in IMPERIAL_DIMENSION.finditer(text):
+            if match.group(2) is None and not match.group(0).rstrip().endswith(("'", '’', '′')):
+                continue
+            inches = int(match.group(1)) * 12 + _fraction(match.group(2))
+            dimensions.append({'text': match.group(0).strip(), 'metres': inches * 0.0254, 'bbox': list(bbox)})
+    return dimensions
+
+
+def deskew(gray):
+    """Straighten a crooked scan. Returns ``(image, matrix)``; ``matrix`` maps
+    pixels of the original image to the straightened one."""
+    import cv2
+
+    ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+    min_length = max(50, min(gray.shape) // 8)
+    lines = cv2.HoughLinesP(ink, 1, np.pi / 1800, threshold=200, minLineLength=min_length, maxLineGap=5)
+    identity = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+    if lines is None:
+        return gray, identity
+    x0, y0, x1, y1 = lines.reshape(-1, 4).T.astype(np.float64)
+    angles = np.degrees(np.arctan2(y1 - y0, x1 - x0))
+    # Borders and title-block rules are the long near-horizontal lines
+    angles = (angles + 90) % 180 - 90
+    angles = angles[np.abs(angles) <= MAX_SKEW_DEGREES]
+    if not len(angles):
+        return gray, identity
+    angle = float(np.median(angles))
+    if abs(angle) < 0.1:
+        return gray, identity
+    h, w = gray.shape
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    rotated = cv2.warpAffine(gray, matrix, (w, h), flags=cv2.INTER_LINEAR, borderValue=255)
+    return rotated, matrix
+
+
+def binarize(gray):
+    import cv2
+
+    gray = cv2.medianBlur(gray, 3)
+    return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15)
+
+
+def read_lines(image):
+    """Tesseract's text lines in ``image``: ``[(text, (x0, y0, x1, y1))]`` in pixels."""
+    import pytesseract
+
+    # Sparse text: title blocks are boxes of short labels, not paragraphs
+    data = pytesseract.image_to_data(image, config='--psm 11', output_type=pytesseract.Output.DICT)
+    grouped = {}
+    for i, text in enumerate(data['text']):
+        text = text.strip()
+        if not text or float(data['conf'][i]) < MIN_WORD_CONFIDENCE:
+            continue
+        x, y, w, h = data['left'][i], data['top'][i], data['width'][i], data['height'][i]
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        grouped.setdefault(key, []).append((x, text, (x, y, x + w, y + h)))
+    lines = []
+    for words in grouped.values():
+        words.sort()
+        boxes = np.array([box for _, _, box in words], dtype=np.float64)
+        bbox = (boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max())
+        lines.append((' '.join(text for _, text, _ in words), bbox))
+    return lines
+
+
+def _to_page(bbox, inverse, zoom, clip):
+    # Straightened-crop pixels -> crop pixels -> page points
+    x0, y0, x1, y1 = bbox
+    corners = np.array([[x0, y0, 1], [x1, y0, 1], [x1, y1, 1], [x0, y1, 1]], dtype=np.float64)
+    pts = corners @ inverse.T / zoom + (clip.x0, clip.y0)
+    return [float(pts[:, 0].min()), float(pts[:, 1].min()), float(pts[:, 0].max()), float(pts[:, 1].max())]
+
+
+# Each worker process keeps the documents it is reading open across pages
+_worker_documents = None
+
+
+def _documents():
+    global _worker_documents
+    if _worker_documents is None:
+        _worker_documents = DocumentPool(max_open=2, idle_timeout=60)
+    return _worker_documents
+
+
+def _init_worker():
+    # Tesseract would start a thread per core in every process; the pool already uses them all
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+
+
+def page_keys(pdf_path, page_nums):
+    """Worker entry point: ``{page_num: page_key}``."""
+    with open_document(pdf_path, _documents()) as doc:
+        return {page_num: page_key(doc, page_num) for page_num in page_nums}
+
+
+def ocr_page(pdf_path, page_num, dpi=DPI, regions=TITLE_BLOCK_REGIONS):
+    """Worker entry point: OCR the title-block regions of one page. Returns
+    ``{'lines', 'dimensions', 'scale'}``, boxes in page points."""
+    import cv2
+
+    renderer = get_renderer('pymupdf')
+    lines = []
+    with open_document(pdf_path, _documents()) as doc:
+        page = doc[page_num]
+        rect = page.rect
+        for fx0, fy0, fx1, fy1 in regions:
+            clip = fitz.Rect(rect.x0 + rect.width * fx0, rect.y0 + rect.height * fy0,
+                             rect.x0 + rect.width * fx1, rect.y0 + rect.height * fy1)
+            zoom = min(dpi / 72, MAX_PIXELS / max(clip.width, clip.height))
+            png = renderer.render_page(page, zoom, 'png', clip=clip)
+            gray = cv2.imdecode(np.frombuffer(png, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+            straight, matrix = deskew(gray)
+            inverse = cv2.invertAffineTransform(matrix)
+            for text, bbox in read_lines(binarize(straight)):
+                lines.append((text, _to_page(bbox, inverse, zoom, clip)))
+        width, height = rect.width, rect.height
+
+    notes = parse_scale_notes(lines, width, height)
+    for note in notes:
+        note['confidence'] *= CONFIDENCE_FACTOR
+    scale = combine(notes, [], width, height, any(NOT_TO_SCALE.search(text) for text, _ in lines))
+    if scale['source']:
+        scale['source'] = 'ocr'
+    return {
+        'lines': [[text, bbox] for text, bbox in lines],
+        'dimensions': find_dimensions(lines),
+        'scale': scale,
+    }
+
+
+class OcrEngine:
+    """OCRs pages on a process pool, remembering results on disk under
+    ``root`` by page content hash."""
+
+    def __init__(self, root, max_workers=None):
+        self.root = root
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = None
+        self._available = None
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def available(self):
+        """Whether OpenCV, pytesseract and the tesseract binary are all there."""
+        with self._lock:
+            if self._available is None:
+                try:
+                    import cv2  # noqa: F401
+                    import pytesseract
+                    pytesseract.get_tesseract_version()
+                    self._available = True
+                except Exception as e:
+                    logging.warning(f"OCR fallback disabled: {e}")
+                    self._available = False
+            return self._available
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn, not fork: forking a threaded Flask process can deadlock the child
+                ctx = multiprocessing.get_context('spawn')
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=ctx,
+                                                     initializer=_init_worker)
+            return self._executor
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def _load(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, key, result):
+        directory = os.path.dirname(self._path(key))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp_path, self._path(key))
+
+    def run(self, pdf_path, page_nums, progress=None):
+        """OCR results for ``page_nums``: ``{page_num: result}``. Pages that
+        fail are left out (and tried again next time)."""
+        # Even hashing opens the PDF, which the job thread this runs on mustn't do
+        keys = self._pool().submit(page_keys, pdf_path, list(page_nums)).result()
+        results = {}
+        for page_num, key in keys.items():
+            cached = self._load(key)
+            if cached is not None:
+                results[page_num] = cached
+        missing = [page_num for page_num in page_nums if page_num not in results]
+        total = len(keys)
+        if progress:
+            progress(len(results), total)
+        if not missing:
+            return results
+
+        futures = {self._pool().submit(ocr_page, pdf_path, page_num): page_num for page_num in missing}
+        done = len(results)
+        try:
+            for future in as_completed(futures):
+                page_num = futures[future]
+                done += 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.warning(f"OCR failed on page {page_num}: {e}")
+                else:
+                    self._save(keys[page_num], result)
+                    results[page_num] = result
+                if progress:
+                    progress(done, total)
+        finally:
+            for future in futures:
+                future.cancel()
+        logging.info(f"OCR'd {len(missing)} pages ({total - len(missing)} cached) of {pdf_path}")
+        return results
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
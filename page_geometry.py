@@ -0,0 +1,151 @@
+"""Per-document page geometry index.
+
+Built once per upload and stored next to the render cache as JSON, keyed by
+the document's content hash. For every page it records the page rect, the
+rotation and the rendered pixel size at each zoom level the viewer can reach,
+so mapping canvas pixels to PDF points never needs a render. Background
+analysis (e.g. scale detection) adds its per-page results to the same record.
+"""
+import json
+import math
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import fitz  # PyMuPDF
+
+from render_cache import format_zoom
+
+DEFAULT_ZOOM = 1.5
+ZOOM_STEP = 1.2
+MIN_ZOOM = 0.5
+MAX_ZOOM = 3.0
+# Zoom levels tiles are rendered at; the viewer stretches the next level up
+RENDER_ZOOMS = (0.5, 0.75, 1.0, 1.5, 2.0, 3.0)
+
+
+def zoom_levels(start=DEFAULT_ZOOM, step=ZOOM_STEP, lo=MIN_ZOOM, hi=MAX_ZOOM, limit=64):
+    # Every zoom adjust_zoom can reach from the default, including the ladders that
+    # start again from the clamped min/max
+    seen = {format_zoom(start): start}
+    frontier = [start]
+    while frontier and len(seen) < limit:
+        zoom = frontier.pop()
+        for nxt in (min(zoom * step, hi), max(zoom / step, lo)):
+            key = format_zoom(nxt)
+            if key not in seen:
+                seen[key] = nxt
+                frontier.append(nxt)
+    return sorted(seen.values())
+
+
+def render_zoom_for(zoom):
+    for level in RENDER_ZOOMS:
+        if level >= zoom - 1e-6:
+            return level
+    return RENDER_ZOOMS[-1]
+
+
+def pixel_size(width, height, zoom):
+    # Same rounding MuPDF applies when turning (rect * matrix) into a pixmap irect
+    return [math.ceil(width * zoom - 0.001), math.ceil(height * zoom - 0.001)]
+
+
+class PageGeometryIndex:
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    @classmethod
+    def build(cls, pdf_path, zooms=None):
+        zooms = zooms or sorted(set(zoom_levels()) | set(RENDER_ZOOMS))
+        pages = []
+        with fitz.open(pdf_path) as doc:
+            for page in doc:
+                # page.rect already has the /Rotate applied, i.e. it is what gets rendered
+                width, height = page.rect.width, page.rect.height
+                pages.append({
+                    'width': width,
+                    'height': height,
+                    'rotation': page.rotation,
+                    'pixels': {format_zoom(z): pixel_size(width, height, z) for z in zooms},
+                })
+        return cls(pages)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f)['pages'])
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'pages': self.pages}, f)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.pages)
+
+    def page(self, page_num):
+        return self.pages[page_num]
+
+    def pixel_size(self, page_num, zoom):
+        page = self.pages[page_num]
+        size = page['pixels'].get(format_zoom(zoom))
+        if size is None:
+            size = pixel_size(page['width'], page['height'], zoom)
+        return size
+
+
+class GeometryStore:
+    """Loads geometry indexes from disk, keeping a few recent ones in memory."""
+
+    def __init__(self, root, max_entries=32):
+        self.root = root
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, doc_hash):
+        return os.path.join(self.root, doc_hash[:2], f"{doc_hash}.json")
+
+    def build(self, doc_hash, pdf_path):
+        path = self._path(doc_hash)
+        if os.path.exists(path):
+            index = PageGeometryIndex.load(path)
+        else:
+            index = PageGeometryIndex.build(pdf_path)
+            index.save(path)
+        self._remember(doc_hash, index)
+        return index
+
+    def get(self, doc_hash, pdf_path):
+        with self._lock:
+            index = self._entries.get(doc_hash)
+            if index is not None:
+                self._entries.move_to_end(doc_hash)
+                return index
+        return self.build(doc_hash, pdf_path)
+
+    def update_pages(self, doc_hash, pdf_path, field, values):
+        """Store ``values[i]`` as ``field`` of page ``i`` and save the index."""
+        with self._lock:
+            index = self._entries.get(doc_hash)
+        if index is None:
+            index = self.build(doc_hash, pdf_path)
+        with self._lock:
+            for page, value in zip(index.pages, values):
+                page[field] = value
+            index.save(self._path(doc_hash))
+        self._remember(doc_hash, index)
+        return index
+
+    def _remember(self, doc_hash, index):
+        with self._lock:
+            self._entries[doc_hash] = index
+            self._entries.move_to_end(doc_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
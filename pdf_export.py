@@ -0,0 +1,394 @@
+"""Annotated-PDF export.
+
+Each project's export lives under ``root`` together with a small JSON record
+of what was baked into every page: a fingerprint of the page's annotations and
+the page's original /Contents. Re-exporting only touches pages whose
+fingerprint changed (their /Contents are put back to the original and the
+annotations drawn again) and appends those changes with an incremental save,
+so unchanged pages are neither redrawn nor rewritten. Once incremental
+updates have grown the file past ``compact_ratio`` times its last full size,
+it is rewritten in full (garbage collected and deflated).
+
+First exports of large documents are spread over a process pool instead:
+each worker draws the layers of a range of pages and hands back their content
+streams, which are then put into a copy of the source. Building on the source
+(rather than merging per-range PDFs) keeps its page labels, optional content,
+forms and names just as the serial path does.
+
+Re-exports and that last step run on the same process pool, so no PyMuPDF
+work happens on the web process's job threads: PyMuPDF isn't thread-safe,
+and request threads are using it at the same time.
+"""
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from measurements import MIN_SHAPE_POINTS
+
+# Bump whenever the drawing code changes, so old exports get redrawn
+LAYER_VERSION = 2
+# Annotation types drawn into the export
+DRAWN_TYPES = ('line', 'square', 'polyline', 'polygon')
+
+
+def page_fingerprint(annotations):
+    drawable = [
+        [anno.get('type'), anno.get('points'), anno.get('label', '')]
+        for anno in annotations
+        if anno.get('type') != 'scale_reference'
+    ]
+    if not drawable:
+        return None
+    payload = json.dumps([LAYER_VERSION, drawable], separators=(',', ':'))
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def adjust_coordinates(points, page_rotation, page_width, page_height):
+    """Map an (..., 2) array of points from the rotated page the viewer shows
+    back to unrotated page space, where drawing happens."""
+    x, y = points[..., 0], points[..., 1]
+    if page_rotation == 90:
+        return np.stack([y, page_width - x], axis=-1)
+    elif page_rotation == 180:
+        return np.stack([page_width - x, page_height - y], axis=-1)
+    elif page_rotation == 270:
+        return np.stack([page_height - y, x], axis=-1)
+    return points
+
+
+def _valid_points(anno):
+    points = anno.get('points', [])
+    if anno['type'] in MIN_SHAPE_POINTS:
+        return len(points) >= MIN_SHAPE_POINTS[anno['type']]
+    return len(points) == 2
+
+
+def draw_annotations(page, annotations, page_geometry):
+    """Draw a page's annotations as one Shape, committed once: all lines,
+    rectangles, polylines and polygons and their labels end up in a single
+    content stream."""
+    drawable = []
+    for anno in annotations:
+        if anno.get('type') not in DRAWN_TYPES:
+            continue
+        if not _valid_points(anno):
+            logging.warning(f"Skipping annotation with invalid points: {anno}")
+            continue
+        drawable.append(anno)
+    if not drawable:
+        return 0
+
+    # Every vertex is mapped in one go, then split back per annotation
+    counts = [len(anno['points']) for anno in drawable]
+    vertices = adjust_coordinates(
+        np.array([point for anno in drawable for point in anno['points']], dtype=np.float64),
+        page_geometry['rotation'], page_geometry['width'], page_geometry['height'],
+    )
+    points = [part.tolist() for part in np.split(vertices, np.cumsum(counts)[:-1])]
+
+    shape = page.new_shape()
+    # Paths sharing a style are finished together, one path object per style
+    for kinds, color in ((('line', 'polyline'), (1, 0, 0)), (('square', 'polygon'), (0, 1, 0))):
+        count = 0
+        for anno, vertices in zip(drawable, points):
+            if anno['type'] not in kinds:
+                continue
+            if anno['type'] == 'line':
+                shape.draw_line(*vertices)
+            elif anno['type'] == 'square':
+                shape.draw_rect(fitz.Rect(*vertices).normalize())
+            elif anno['type'] == 'polyline':
+                shape.draw_polyline(vertices)
+            else:
+                # finish() would only close the last path of the style, so polygons close themselves
+                shape.draw_polyline(vertices + vertices[:1])
+            count += 1
+        if count:
+            shape.finish(color=color, width=2, closePath=False)
+
+    for anno, vertices in zip(drawable, points):
+        label = anno.get('label', '')
+        if label:
+            # Labels sit above the first point: the line's start, the rectangle's first corner
+            shape.insert_text((vertices[0][0], vertices[0][1] - 10), label, color=(0, 0, 1))
+    shape.commit()
+    logging.debug(f"Drew {len(drawable)} annotations on page {page.number}")
+    return len(drawable)
+
+
+def _set_contents(doc, page, xrefs):
+    doc.xref_set_key(page.xref, 'Contents', '[' + ' '.join(f"{xref} 0 R" for xref in xrefs) + ']')
+
+
+def _new_object(doc, source, stream=None):
+    xref = doc.get_new_xref()
+    doc.update_object(xref, source)
+    if stream is not None:
+        doc.update_stream(xref, stream)
+    return xref
+
+
+def _add_font(doc, page, name, source):
+    # Resources and their /Font dict may each be inline or indirect; a path
+    # through an indirect object has to be set on that object itself
+    kind, value = doc.xref_get_key(page.xref, 'Resources')
+    holder, path = (int(value.split()[0]), '') if kind == 'xref' else (page.xref, 'Resources/')
+    kind, value = doc.xref_get_key(holder, path + 'Font')
+    holder, path = (int(value.split()[0]), name) if kind == 'xref' else (holder, f"{path}Font/{name}")
+    # A font of that name already there is reused, as insert_font would
+    if doc.xref_get_key(holder, path)[0] == 'null':
+        doc.xref_set_key(holder, path, f"{_new_object(doc, source)} 0 R")
+
+
+def redraw_pages(doc_path, path, state, changed, fingerprints, annotations, pages_geometry, compact_ratio):
+    """Worker entry point: redraw the ``changed`` pages of the document at
+    ``doc_path`` (the source for a first export, else the export itself) and
+    save it to ``path``, incrementally while that keeps the file small enough.
+    Returns the updated ``state`` and how the file was saved."""
+    with fitz.open(doc_path) as doc:
+        # Incremental updates only work on the file the document came from, unrepaired
+        incremental = doc_path == path and doc.can_save_incrementally()
+        for page_num in changed:
+            page = doc[page_num]
+            baked = state['pages'].pop(page_num, None)
+            if baked is not None:
+                # Unhook the old annotation layer; its streams become garbage
+                base = baked['base']
+                _set_contents(doc, page, base)
+            else:
+                base = page.get_contents()
+            if page_num in annotations:
+                draw_annotations(page, annotations[page_num], pages_geometry[page_num])
+                state['pages'][page_num] = {'fingerprint': fingerprints[page_num], 'base': base}
+
+        if not changed and incremental:
+            return state, 'unchanged'
+        if incremental and os.path.getsize(path) <= state['full_size'] * compact_ratio:
+            doc.save(path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+            return state, 'incremental'
+        state['full_size'] = _save_full(doc, path)
+        return state, 'full'
+
+
+def bake_page_range(source_path, annotations, pages_geometry):
+    """Worker entry point: draw the annotations of some pages and return each
+    page's layer, ``{page_num: {'contents', 'fonts'}}``.
+
+    ``contents`` is the page's /Contents afterwards: original streams by their
+    position in the original /Contents, added ones by their bytes. ``fonts``
+    are the font objects the labels added to the page's resources.
+    """
+    layers = {}
+    with fitz.open(source_path) as doc:
+        for page_num, page_annotations in annotations.items():
+            page = doc[page_num]
+            before = page.get_contents()
+            fonts = {font[4] for font in page.get_fonts()}
+            draw_annotations(page, page_annotations, pages_geometry[page_num])
+            layers[page_num] = {
+                'contents': [before.index(xref) if xref in before else doc.xref_stream(xref)
+                             for xref in page.get_contents()],
+                'fonts': {font[4]: doc.xref_object(font[0], compressed=True)
+                          for font in page.get_fonts() if font[4] not in fonts},
+            }
+    return layers
+
+
+def apply_layers(source_path, path, layers):
+    """Worker entry point: write a copy of the source with the baked ``layers``
+    put in. The copy keeps everything document-level (outline, page labels,
+    layers, forms, names) as it is. Returns ``(size, bases)``: the export's
+    size and each page's original /Contents."""
+    bases = {}
+    with fitz.open(source_path) as doc:
+        for page_num, layer in sorted(layers.items()):
+            page = doc[page_num]
+            base = page.get_contents()
+            _set_contents(doc, page, [
+                base[item] if isinstance(item, int) else _new_object(doc, '<<>>', item)
+                for item in layer['contents']
+            ])
+            for name, source in layer['fonts'].items():
+                _add_font(doc, page, name, source)
+            bases[page_num] = base
+        size = _save_full(doc, path)
+    return size, bases
+
+
+def _save_full(doc, path):
+    # garbage=1 drops unreferenced objects without renumbering,
+    # so the xrefs recorded in the state stay valid
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.pdf.tmp')
+    os.close(fd)
+    try:
+        doc.save(tmp_path, garbage=1, deflate=True)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return os.path.getsize(path)
+
+
+class PdfExporter:
+    """Keeps each project's annotated PDF up to date.
+
+    A first export of a large document is split into page ranges baked by a
+    process pool and put together on a copy of the source; later exports
+    only redraw changed pages, in one worker.
+    """
+
+    def __init__(self, root, compact_ratio=2.0, max_workers=2, parallel_min_pages=16, min_chunk_pages=8):
+        # Absolute, because send_file resolves relative paths against the app root
+        self.root = os.path.abspath(root)
+        self.compact_ratio = compact_ratio
+        self.max_workers = max_workers
+        self.parallel_min_pages = parallel_min_pages
+        self.min_chunk_pages = min_chunk_pages
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._executor = None
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, project_id):
+        return os.path.join(self.root, f"{project_id}.pdf")
+
+    def _state_path(self, project_id):
+        return os.path.join(self.root, f"{project_id}.json")
+
+    def discard(self, path):
+        """Forget what was baked into the export at ``path`` (it was deleted)."""
+        project_id = os.path.splitext(os.path.basename(path))[0]
+        with self._lock(project_id):
+            try:
+                os.remove(self._state_path(project_id))
+            except FileNotFoundError:
+                pass
+
+    def _lock(self, project_id):
+        with self._locks_guard:
+            return self._locks.setdefault(project_id, threading.Lock())
+
+    def _pool(self):
+        with self._locks_guard:
+            if self._executor is None:
+                # spawn, not fork: forking a threaded Flask process can deadlock the child
+                ctx = multiprocessing.get_context('spawn')
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=ctx)
+            return self._executor
+
+    def _load_state(self, project_id):
+        try:
+            with open(self._state_path(project_id)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        state['pages'] = {int(page_num): baked for page_num, baked in state['pages'].items()}
+        return state
+
+    def _save_state(self, project_id, state):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._state_path(project_id))
+
+    @staticmethod
+    def _fingerprints(annotations):
+        wanted = {}
+        for page_num, page_annotations in annotations.items():
+            fingerprint = page_fingerprint(page_annotations)
+            if fingerprint is not None:
+                wanted[page_num] = fingerprint
+        return wanted
+
+    def export(self, project_id, doc_hash, source_path, annotations, geometry, progress=None):
+        """Bring the project's export up to date with ``annotations`` (page ->
+        list). ``progress(done, total)`` is called as pages are finished.
+        Returns ``(path, stats)``."""
+        with self._lock(project_id):
+            path = self.path(project_id)
+            state = self._load_state(project_id)
+            fresh = state is None or state['doc_hash'] != doc_hash or not os.path.exists(path)
+            if fresh and self.max_workers > 1 and len(geometry) >= self.parallel_min_pages:
+                stats = self._export_parallel(project_id, doc_hash, source_path, annotations, geometry, progress)
+            else:
+                stats = self._export_serial(project_id, doc_hash, source_path, annotations, geometry, progress,
+                                            None if fresh else state)
+        return path, stats
+
+    def _export_serial(self, project_id, doc_hash, source_path, annotations, geometry, progress, state):
+        path = self.path(project_id)
+        fresh = state is None
+        if fresh:
+            state = {'doc_hash': doc_hash, 'full_size': 0, 'pages': {}}
+        wanted = self._fingerprints(annotations)
+        changed = sorted(
+            page_num for page_num in set(wanted) | set(state['pages'])
+            if wanted.get(page_num) != state['pages'].get(page_num, {}).get('fingerprint')
+        )
+        drawn = [page_num for page_num in changed if page_num in wanted]
+
+        if progress:
+            progress(0, len(changed))
+        state, mode = self._pool().submit(
+            redraw_pages, source_path if fresh else path, path, state, changed,
+            {page_num: wanted[page_num] for page_num in drawn},
+            {page_num: annotations[page_num] for page_num in drawn},
+            {page_num: geometry.page(page_num) for page_num in drawn},
+            self.compact_ratio,
+        ).result()
+        if mode != 'unchanged':
+            self._save_state(project_id, state)
+        if progress:
+            progress(len(changed), len(changed))
+        return {'pages_drawn': len(drawn), 'pages_reused': len(wanted.keys() - set(changed)), 'mode': mode}
+
+    def _export_parallel(self, project_id, doc_hash, source_path, annotations, geometry, progress):
+        wanted = self._fingerprints(annotations)
+        page_count = len(geometry)
+        # A few ranges per worker keeps them all busy when pages differ in cost
+        chunk = max(self.min_chunk_pages, math.ceil(page_count / (self.max_workers * 4)))
+        futures = {}
+        try:
+            pool = self._pool()
+            for first in range(0, page_count, chunk):
+                last = min(first + chunk, page_count) - 1
+                pages = [page_num for page_num in range(first, last + 1) if page_num in wanted]
+                future = pool.submit(
+                    bake_page_range, source_path,
+                    {page_num: annotations[page_num] for page_num in pages},
+                    {page_num: geometry.page(page_num) for page_num in pages},
+                )
+                futures[future] = (first, last)
+
+            layers = {}
+            done = 0
+            for future in as_completed(futures):
+                layers.update(future.result())
+                first, last = futures[future]
+                done += last - first + 1
+                if progress:
+                    progress(done, page_count)
+        finally:
+            for future in futures:
+                future.cancel()
+
+        size, bases = self._pool().submit(apply_layers, source_path, self.path(project_id), layers).result()
+        state = {'doc_hash': doc_hash, 'full_size': size, 'pages': {
+            page_num: {'fingerprint': wanted[page_num], 'base': base} for page_num, base in bases.items()
+        }}
+        self._save_state(project_id, state)
+        return {'pages_drawn': len(wanted), 'pages_reused': 0, 'mode': 'parallel',
+                'parts': len(futures)}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,281 @@
+"""Background pre-rendering of uploaded documents into the render cache.
+
+As soon as an upload lands, every page's low-res preview is rendered (and its
+vector segments extracted for snapping) by a small process pool (PyMuPDF is not
+thread-safe, so rendering happens in worker processes). Tiles at the viewer's
+render zoom are only pre-rendered for pages within ``tile_window`` of the one
+being viewed: a large set's tiles would overflow the render cache's disk tier,
+which would then evict the tiles near the current page. Moving the focus
+queues the tiles of the pages around it. Pages closest to the one being viewed
+go first, and work for a document is dropped once nobody has it open any more.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from doc_pool import DocumentPool
+from render_cache import RenderCache
+from rendering import get_renderer
+from snapping import SnapIndexStore
+
+
+# Each worker process keeps the documents it is rendering open across pages
+_worker_documents = None
+
+
+def _documents():
+    global _worker_documents
+    if _worker_documents is None:
+        _worker_documents = DocumentPool(max_open=2, idle_timeout=60)
+    return _worker_documents
+
+
+def render_page_assets(cache_root, backend, doc_hash, pdf_path, page_num, zoom, preview_zoom, tile_size, fmt,
+                       snap_root=None, tiles=True):
+    """Worker entry point: render one page's preview (and its tiles, if
+    ``tiles``) straight into the disk tier of the render cache, and extract its
+    snap segments if ``snap_root`` is given. Returns the number of render bytes
+    written."""
+    if snap_root:
+        try:
+            SnapIndexStore(snap_root, documents=_documents()).build(doc_hash, pdf_path, page_num)
+        except Exception as e:
+            # Snapping falls back to building on demand; don't lose the renders over it
+            logging.warning(f"Snap extraction of page {page_num} of {doc_hash[:12]} failed: {e}")
+
+    cache = RenderCache(cache_root, memory_bytes=0, scan_disk=False)
+    ready_key = cache.ready_key(doc_hash, page_num, zoom, backend, tile_size)
+    preview_key = cache.page_key(doc_hash, page_num, preview_zoom, fmt, backend)
+    if cache.contains(preview_key) and (not tiles or cache.contains(ready_key)):
+        return 0
+
+    renderer = get_renderer(backend, documents=_documents())
+    written = 0
+
+    if not cache.contains(preview_key):
+        data = renderer.render(pdf_path, page_num, preview_zoom, fmt)
+        cache.put(preview_key, data)
+        written += len(data)
+    if not tiles:
+        return written
+
+    def tile_key(tile_x, tile_y):
+        return cache.tile_key(doc_hash, page_num, zoom, fmt, backend, tile_size, tile_x, tile_y)
+
+    tiles = renderer.render_tiles(pdf_path, page_num, zoom, tile_size, fmt,
+                                  skip=lambda x, y: cache.contains(tile_key(x, y)))
+    for tile_x, tile_y, data in tiles:
+        cache.put(tile_key(tile_x, tile_y), data)
+        written += len(data)
+
+    cache.put(ready_key, b'')
+    return written
+
+
+class _DocumentJob:
+
+    def __init__(self, doc_hash, pdf_path, page_count, zoom):
+        self.doc_hash = doc_hash
+        self.pdf_path = pdf_path
+        self.page_count = page_count
+        self.zoom = zoom
+        self.owners = set()
+        self.focus = 0
+        self.pending = set(range(page_count))
+        self.running = set()
+        self.done = set()
+        # Done with their preview only, being outside the tile window then
+        self.untiled = set()
+        self.failed = {}
+
+    def next_page(self):
+        # Current page first, then outwards; on a tie the page after wins (Next Page is the common move)
+        return min(self.pending, key=lambda p: (abs(p - self.focus), p < self.focus))
+
+
+class PrerenderPool:
+
+    def __init__(self, render_cache, backend='pymupdf', max_workers=2, tile_size=512, fmt='png', preview_zoom=0.5,
+                 snap_root=None, on_update=None, tile_window=3):
+        self.render_cache = render_cache
+        self.snap_root = snap_root
+        # Called as on_update(doc_hash, status) after every page, outside the lock
+        self.on_update = on_update
+        self.backend = backend
+        self.max_workers = max_workers
+        self.tile_size = tile_size
+        self.fmt = fmt
+        self.preview_zoom = preview_zoom
+        # Pages either side of the focus whose tiles are pre-rendered
+        self.tile_window = tile_window
+        # doc_hash -> _DocumentJob, most recently focused last
+        self._jobs = OrderedDict()
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._executor = None
+        self._dispatcher = None
+        self._closed = False
+
+    def _start(self):
+        # Lazily, so importing the app (or gunicorn's preload) doesn't spawn processes
+        if self._executor is None:
+            # spawn, not fork: forking a threaded Flask process can deadlock the child
+            ctx = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=ctx)
+            self._dispatcher = threading.Thread(target=self._dispatch, name='prerender-dispatch', daemon=True)
+            self._dispatcher.start()
+
+    def submit(self, doc_hash, pdf_path, page_count, zoom, owner, focus_page=0):
+        """Queue every page of a document at render zoom ``zoom``. Calling it
+        again for a known document only adds the owner and moves the focus."""
+        with self._cond:
+            job = self._jobs.get(doc_hash)
+            if job is None or job.zoom != zoom:
+                job = _DocumentJob(doc_hash, pdf_path, page_count, zoom)
+                self._jobs[doc_hash] = job
+            elif not job.owners:
+                # Released but still finishing its last pages: queue the rest again
+                job.pending = set(range(page_count)) - job.done - job.running - set(job.failed)
+            job.owners.add(owner)
+            self._set_focus(job, focus_page)
+            self._jobs.move_to_end(doc_hash)
+            self._start()
+            self._cond.notify_all()
+
+    def focus(self, doc_hash, page_num):
+        with self._cond:
+            job = self._jobs.get(doc_hash)
+            if job is None or not job.owners:
+                return False
+            self._set_focus(job, page_num)
+            self._jobs.move_to_end(doc_hash)
+            self._cond.notify_all()
+            return True
+
+    def _set_focus(self, job, page_num):
+        # Caller holds self._cond. Pages that got only their preview get their tiles once near the focus.
+        job.focus = page_num
+        near = {p for p in job.untiled if abs(p - page_num) <= self.tile_window}
+        job.untiled -= near
+        job.pending |= near
+
+    def _tiles_wanted(self, job, page_num):
+        return abs(page_num - job.focus) <= self.tile_window
+
+    def release(self, owner):
+        """Drop an owner (a project); documents nobody owns stop rendering.
+        Pages already handed to a worker finish, everything else is cancelled."""
+        dropped = []
+        with self._cond:
+            for doc_hash, job in list(self._jobs.items()):
+                job.owners.discard(owner)
+                if not job.owners:
+                    job.pending.clear()
+                    if not job.running:
+                        del self._jobs[doc_hash]
+                        dropped.append((doc_hash, self._status(job)))
+        # Nothing of these will finish any more, so report them as they are
+        if self.on_update is not None:
+            for doc_hash, status in dropped:
+                self.on_update(doc_hash, status)
+
+    def status(self, doc_hash):
+        with self._cond:
+            job = self._jobs.get(doc_hash)
+            if job is None:
+                return None
+            return self._status(job)
+
+    @staticmethod
+    def _status(job):
+        return {
+            'total': job.page_count,
+            'zoom': job.zoom,
+            'ready': sorted(job.done),
+            'running': sorted(job.running),
+            'pending': len(job.pending),
+            'failed': {str(page): error for page, error in job.failed.items()},
+        }
+
+    def _next(self):
+        for job in reversed(self._jobs.values()):
+            if job.pending:
+                return job, job.next_page()
+        return None, None
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._in_flight < self.max_workers:
+                        job, page_num = self._next()
+                        if job is not None:
+                            break
+                    self._cond.wait()
+                if self._closed:
+                    return
+                job.pending.discard(page_num)
+                job.running.add(page_num)
+                tiles = self._tiles_wanted(job, page_num)
+                self._in_flight += 1
+
+            try:
+                future = self._executor.submit(
+                    render_page_assets, self.render_cache.root, self.backend, job.doc_hash, job.pdf_path,
+                    page_num, job.zoom, self.preview_zoom, self.tile_size, self.fmt, self.snap_root, tiles,
+                )
+            except RuntimeError as e:  # executor shut down underneath us
+                self._finish(job, page_num, error=str(e))
+                continue
+            future.add_done_callback(
+                lambda f, job=job, page_num=page_num, tiles=tiles: self._on_done(job, page_num, f, tiles))
+
+    def _on_done(self, job, page_num, future, tiles):
+        error = None
+        written = 0
+        try:
+            written = future.result()
+        except Exception as e:
+            error = str(e)
+            logging.warning(f"Pre-render of page {page_num} of {job.doc_hash[:12]} failed: {error}")
+        if written:
+            self.render_cache.record_external_writes(written)
+        self._finish(job, page_num, error, tiles)
+
+    def _finish(self, job, page_num, error=None, tiles=True):
+        with self._cond:
+            self._in_flight -= 1
+            job.running.discard(page_num)
+            if error is None:
+                job.done.add(page_num)
+                if not tiles:
+                    if self._tiles_wanted(job, page_num):
+                        # The focus came this way while it rendered
+                        job.pending.add(page_num)
+                    else:
+                        job.untiled.add(page_num)
+            else:
+                job.failed[page_num] = error
+            if not job.owners and not job.running and self._jobs.get(job.doc_hash) is job:
+                del self._jobs[job.doc_hash]
+            self._cond.notify_all()
+            status = self._status(job)
+        if self.on_update is not None:
+            try:
+                self.on_update(job.doc_hash, status)
+            except Exception as e:
+                logging.warning(f"Pre-render progress callback failed: {e}")
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def default_workers():
+    return max(1, min(4, (os.cpu_count() or 2) // 2))
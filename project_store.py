@@ -0,0 +1,530 @@
+"""Server-side project state.
+
+The Flask session only carries a project ID; documents, pages, annotations,
+measurement rows and drawing scales live here. ``ProjectStore`` is the
+interface the app talks to and ``SQLiteProjectStore`` the default backend.
+Use ``open_store`` with a URL such as ``sqlite:///data/projects.db`` to get
+one.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from measurements import AREA_UNIT
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    content_hash TEXT NOT NULL UNIQUE,
+    path TEXT NOT NULL,
+    filename TEXT,
+    page_count INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS pages (
+    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    page_num INTEGER NOT NULL,
+    width REAL NOT NULL,
+    height REAL NOT NULL,
+    rotation INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (document_id, page_num)
+);
+
+CREATE TABLE IF NOT EXISTS projects (
+    id TEXT PRIMARY KEY,
+    document_id INTEGER NOT NULL REFERENCES documents(id),
+    current_page INTEGER NOT NULL DEFAULT 0,
+    zoom_level REAL NOT NULL DEFAULT 1.5,
+    scale REAL,
+    export_pdf_path TEXT,
+    export_excel_path TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS annotations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_id TEXT NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+    page_num INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    points TEXT NOT NULL,
+    label TEXT NOT NULL DEFAULT '',
+    dimensions TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_annotations_page ON annotations(project_id, page_num, id);
+
+CREATE TABLE IF NOT EXISTS measurements (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_id TEXT NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+    annotation_id INTEGER REFERENCES annotations(id) ON DELETE SET NULL,
+    page_num INTEGER NOT NULL,
+    name TEXT,
+    parent_area TEXT,
+    length REAL,
+    width REAL,
+    height REAL,
+    area REAL,
+    replicas INTEGER,
+    unit TEXT,
+    area_type TEXT,
+    -- The measured annotation's type and points, kept here so the row can
+    -- be rescaled after its annotation is cleared from the page
+    type TEXT,
+    points TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_measurements_project ON measurements(project_id, id);
+CREATE INDEX IF NOT EXISTS idx_measurements_annotation ON measurements(annotation_id);
+
+CREATE TABLE IF NOT EXISTS scales (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_id TEXT NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+    page_num INTEGER NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    x0 REAL,
+    y0 REAL,
+    x1 REAL,
+    y1 REAL,
+    scale REAL NOT NULL,
+    source TEXT NOT NULL,
+    reference TEXT,
+    created_at REAL NOT NULL,
+    UNIQUE (project_id, page_num, name)
+);
+"""
+
+def _points_json(points):
+    # Polylines and polygons can have hundreds of vertices; no whitespace
+    return json.dumps(points, separators=(',', ':'))
+
+
+PROJECT_FIELDS = ('current_page', 'zoom_level', 'scale', 'export_pdf_path', 'export_excel_path')
+
+# Column order of a measurement row, as shown in the preview and the Excel export
+MEASUREMENT_COLUMNS = ('name', 'parent_area', 'length', 'width', 'height', 'area', 'replicas', 'unit', 'area_type')
+
+MEASUREMENT_INSERT = (
+    f"INSERT INTO measurements (project_id, annotation_id, page_num, type, points, {', '.join(MEASUREMENT_COLUMNS)}) "
+    f"VALUES (?, ?, ?, ?, ?, {', '.join('?' * len(MEASUREMENT_COLUMNS))})"
+)
+
+# Orderings iter_measurements understands
+MEASUREMENT_ORDERINGS = {
+    'id': 'id',
+    'area_type': 'area_type, id',
+    'page': 'page_num, area_type, id',
+}
+
+
+class ProjectStore:
+
+    def upsert_document(self, content_hash, path, filename, pages):
+        """Register a document and its page geometry; ``pages`` is a list of
+        dicts with width/height/rotation. Returns the document ID."""
+        raise NotImplementedError
+
+    def create_project(self, document_id, zoom_level=1.5):
+        raise NotImplementedError
+
+    def get_project(self, project_id):
+        """Return the project joined with its document, or None."""
+        raise NotImplementedError
+
+    def update_project(self, project_id, **fields):
+        raise NotImplementedError
+
+    def list_annotations(self, project_id, page_num=None):
+        raise NotImplementedError
+
+    def add_annotation(self, project_id, page_num, annotation, measurement=None):
+        raise NotImplementedError
+
+    def add_annotations(self, project_id, entries):
+        """Insert many ``(page_num, annotation, measurement)`` entries in one
+        transaction. Returns the annotation IDs in order."""
+        raise NotImplementedError
+
+    def replace_annotations(self, project_id, page_num, annotation_type, annotation=None):
+        raise NotImplementedError
+
+    def clear_annotations(self, project_id, page_num, keep_types=()):
+        raise NotImplementedError
+
+    def pop_annotation(self, project_id, page_num, skip_types=()):
+        raise NotImplementedError
+
+    def list_measurements(self, project_id):
+        raise NotImplementedError
+
+    def iter_measurements(self, project_id, order_by='id', batch_size=1000):
+        """Yield ``(page_num, *row)`` tuples without loading the whole set.
+        ``order_by`` is one of MEASUREMENT_ORDERINGS."""
+        raise NotImplementedError
+
+    def measurement_pages(self, project_id):
+        raise NotImplementedError
+
+    def count_measurements(self, project_id):
+        raise NotImplementedError
+
+    def page_measurements(self, project_id, page_num):
+        """``(measurement_id, type, points, unit)`` of every measurement row on
+        the page whose geometry is known, cleared annotations included."""
+        raise NotImplementedError
+
+    def update_dimensions(self, project_id, dimensions):
+        """Store ``(measurement_id, dimensions, length, width, area)``: the
+        row's length, width and area columns, and its annotation's dimensions."""
+        raise NotImplementedError
+
+    def list_scales(self, project_id, page_num=None):
+        raise NotImplementedError
+
+    def set_scale(self, project_id, page_num, scale, rect=None, name='', source='reference', reference=None):
+        """Set the page's scale, or that of its viewport ``name`` covering
+        ``rect`` (x0, y0, x1, y1 in PDF points). Returns the scale's ID."""
+        raise NotImplementedError
+
+    def remove_scales(self, project_id, page_num, name=None):
+        """Remove the viewport ``name``, or every scale on the page."""
+        raise NotImplementedError
+
+
+class SQLiteProjectStore(ProjectStore):
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # sqlite3 connections can't be shared across threads
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            self._migrate(conn)
+
+    @staticmethod
+    def _migrate(conn):
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(measurements)")}
+        if 'points' not in columns:
+            conn.execute("ALTER TABLE measurements ADD COLUMN type TEXT")
+            conn.execute("ALTER TABLE measurements ADD COLUMN points TEXT")
+            # Rows whose annotation was cleared before this have no geometry left
+            conn.execute(
+                "UPDATE measurements SET (type, points) = "
+                "(SELECT a.type, a.points FROM annotations a WHERE a.id = measurements.annotation_id) "
+                "WHERE annotation_id IS NOT NULL"
+            )
+        if 'area' not in columns:
+            conn.execute("ALTER TABLE measurements ADD COLUMN area REAL")
+            # Polygon rows kept their area in the length column; their perimeter is unknown
+            conn.execute("UPDATE measurements SET area = length, length = NULL "
+                         "WHERE type = 'polygon' AND width IS NULL AND unit = ?", (AREA_UNIT,))
+            conn.execute("UPDATE measurements SET area = ROUND(length * width, 3) "
+                         "WHERE width IS NOT NULL AND unit = ?", (AREA_UNIT,))
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            # WAL lets gunicorn workers read while another one writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    # Documents and projects
+
+    def upsert_document(self, content_hash, path, filename, pages):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO documents (content_hash, path, filename, page_count, created_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(content_hash) DO UPDATE SET path = excluded.path, filename = excluded.filename",
+                (content_hash, path, filename, len(pages), now),
+            )
+            document_id = conn.execute(
+                "SELECT id FROM documents WHERE content_hash = ?", (content_hash,)
+            ).fetchone()['id']
+            conn.executemany(
+                "INSERT OR REPLACE INTO pages (document_id, page_num, width, height, rotation) VALUES (?, ?, ?, ?, ?)",
+                [(document_id, i, p['width'], p['height'], p['rotation']) for i, p in enumerate(pages)],
+            )
+        return document_id
+
+    def create_project(self, document_id, zoom_level=1.5):
+        project_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO projects (id, document_id, zoom_level, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (project_id, document_id, zoom_level, now, now),
+            )
+        return project_id
+
+    def get_project(self, project_id):
+        row = self._connect().execute(
+            "SELECT p.*, d.content_hash, d.path AS pdf_path, d.filename, d.page_count "
+            "FROM projects p JOIN documents d ON d.id = p.document_id WHERE p.id = ?",
+            (project_id,),
+        ).fetchone()
+        return dict(row) if row else None
+
+    def update_project(self, project_id, **fields):
+        unknown = set(fields) - set(PROJECT_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown project fields: {', '.join(sorted(unknown))}")
+        if not fields:
+            return
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE projects SET {assignments}, updated_at = ? WHERE id = ?",
+                (*fields.values(), time.time(), project_id),
+            )
+
+    # Annotations
+
+    @staticmethod
+    def _annotation_from_row(row):
+        annotation = {
+            'id': row['id'],
+            'type': row['type'],
+            'points': json.loads(row['points']),
+            'label': row['label'],
+        }
+        if row['dimensions'] is not None:
+            annotation['dimensions'] = json.loads(row['dimensions'])
+        return annotation
+
+    def list_annotations(self, project_id, page_num=None):
+        conn = self._connect()
+        if page_num is not None:
+            rows = conn.execute(
+                "SELECT * FROM annotations WHERE project_id = ? AND page_num = ? ORDER BY id",
+                (project_id, page_num),
+            ).fetchall()
+            return [self._annotation_from_row(row) for row in rows]
+
+        rows = conn.execute(
+            "SELECT * FROM annotations WHERE project_id = ? ORDER BY page_num, id", (project_id,)
+        ).fetchall()
+        annotations = {}
+        for row in rows:
+            annotations.setdefault(row['page_num'], []).append(self._annotation_from_row(row))
+        return annotations
+
+    @staticmethod
+    def _insert_annotation(conn, project_id, page_num, annotation, measurement=None):
+        dimensions = annotation.get('dimensions')
+        cursor = conn.execute(
+            "INSERT INTO annotations (project_id, page_num, type, points, label, dimensions, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (project_id, page_num, annotation['type'], _points_json(annotation['points']),
+             annotation.get('label', ''), json.dumps(dimensions) if dimensions is not None else None, time.time()),
+        )
+        annotation_id = cursor.lastrowid
+        if measurement is not None:
+            conn.execute(
+                MEASUREMENT_INSERT,
+                (project_id, annotation_id, page_num, annotation['type'], _points_json(annotation['points']),
+                 *measurement),
+            )
+        return annotation_id
+
+    def add_annotation(self, project_id, page_num, annotation, measurement=None):
+        """Insert one annotation and, optionally, its measurement row (a
+        sequence in MEASUREMENT_COLUMNS order). Returns the annotation ID."""
+        with self._connect() as conn:
+            return self._insert_annotation(conn, project_id, page_num, annotation, measurement)
+
+    def add_annotations(self, project_id, entries):
+        if not entries:
+            return []
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO annotations (project_id, page_num, type, points, label, dimensions, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (project_id, page_num, annotation['type'], _points_json(annotation['points']),
+                     annotation.get('label', ''),
+                     json.dumps(annotation['dimensions']) if annotation.get('dimensions') is not None else None, now)
+                    for page_num, annotation, _ in entries
+                ],
+            )
+            # The transaction holds the write lock, so the AUTOINCREMENT IDs
+            # handed out above are consecutive and end at last_insert_rowid()
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            annotation_ids = list(range(last_id - len(entries) + 1, last_id + 1))
+            conn.executemany(
+                MEASUREMENT_INSERT,
+                [
+                    (project_id, annotation_id, page_num, annotation['type'], _points_json(annotation['points']),
+                     *measurement)
+                    for annotation_id, (page_num, annotation, measurement) in zip(annotation_ids, entries)
+                    if measurement is not None
+                ],
+            )
+        return annotation_ids
+
+    def replace_annotations(self, project_id, page_num, annotation_type, annotation=None):
+        """Drop every annotation of ``annotation_type`` on the page and store
+        ``annotation`` in its place (if given)."""
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM annotations WHERE project_id = ? AND page_num = ? AND type = ?",
+                (project_id, page_num, annotation_type),
+            )
+            if annotation is not None:
+                return self._insert_annotation(conn, project_id, page_num, annotation)
+
+    def clear_annotations(self, project_id, page_num, keep_types=()):
+        # Measurement rows stay in the data set; only the drawn annotations go
+        placeholders = ', '.join('?' * len(keep_types))
+        query = "DELETE FROM annotations WHERE project_id = ? AND page_num = ?"
+        if keep_types:
+            query += f" AND type NOT IN ({placeholders})"
+        with self._connect() as conn:
+            return conn.execute(query, (project_id, page_num, *keep_types)).rowcount
+
+    def pop_annotation(self, project_id, page_num, skip_types=()):
+        """Remove the most recent annotation on the page together with its
+        measurement row. Returns the removed annotation or None."""
+        query = "SELECT * FROM annotations WHERE project_id = ? AND page_num = ?"
+        if skip_types:
+            query += f" AND type NOT IN ({', '.join('?' * len(skip_types))})"
+        query += " ORDER BY id DESC LIMIT 1"
+        with self._connect() as conn:
+            row = conn.execute(query, (project_id, page_num, *skip_types)).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM measurements WHERE annotation_id = ?", (row['id'],))
+            conn.execute("DELETE FROM annotations WHERE id = ?", (row['id'],))
+        return self._annotation_from_row(row)
+
+    # Measurement rows
+
+    def list_measurements(self, project_id):
+        rows = self._connect().execute(
+            f"SELECT {', '.join(MEASUREMENT_COLUMNS)} FROM measurements WHERE project_id = ? ORDER BY id",
+            (project_id,),
+        ).fetchall()
+        return [list(row) for row in rows]
+
+    def iter_measurements(self, project_id, order_by='id', batch_size=1000):
+        try:
+            ordering = MEASUREMENT_ORDERINGS[order_by]
+        except KeyError:
+            raise ValueError(f"Unknown measurement ordering: {order_by}") from None
+        cursor = self._connect().execute(
+            f"SELECT page_num, {', '.join(MEASUREMENT_COLUMNS)} FROM measurements "
+            f"WHERE project_id = ? ORDER BY {ordering}",
+            (project_id,),
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield tuple(row)
+
+    def measurement_pages(self, project_id):
+        rows = self._connect().execute(
+            "SELECT DISTINCT page_num FROM measurements WHERE project_id = ? ORDER BY page_num", (project_id,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def count_measurements(self, project_id):
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM measurements WHERE project_id = ?", (project_id,)
+        ).fetchone()[0]
+
+    def page_measurements(self, project_id, page_num):
+        rows = self._connect().execute(
+            "SELECT id, type, points, unit FROM measurements "
+            "WHERE project_id = ? AND page_num = ? AND points IS NOT NULL ORDER BY id",
+            (project_id, page_num),
+        ).fetchall()
+        return [(row['id'], row['type'], json.loads(row['points']), row['unit']) for row in rows]
+
+    def update_dimensions(self, project_id, dimensions):
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE measurements SET length = ?, width = ?, area = ? WHERE id = ? AND project_id = ?",
+                [(length, width, area, measurement_id, project_id)
+                 for measurement_id, _, length, width, area in dimensions],
+            )
+            conn.executemany(
+                "UPDATE annotations SET dimensions = ? "
+                "WHERE id = (SELECT annotation_id FROM measurements WHERE id = ?) AND project_id = ?",
+                [(json.dumps(values), measurement_id, project_id)
+                 for measurement_id, values, _, _, _ in dimensions],
+            )
+
+    # Scales
+
+    @staticmethod
+    def _scale_from_row(row):
+        return {
+            'id': row['id'],
+            'page_num': row['page_num'],
+            'name': row['name'],
+            'rect': None if row['x0'] is None else [row['x0'], row['y0'], row['x1'], row['y1']],
+            'scale': row['scale'],
+            'source': row['source'],
+            'reference': json.loads(row['reference']) if row['reference'] is not None else None,
+        }
+
+    def list_scales(self, project_id, page_num=None):
+        query = "SELECT * FROM scales WHERE project_id = ?"
+        params = (project_id,)
+        if page_num is not None:
+            query += " AND page_num = ?"
+            params += (page_num,)
+        rows = self._connect().execute(query + " ORDER BY page_num, id", params).fetchall()
+        return [self._scale_from_row(row) for row in rows]
+
+    def set_scale(self, project_id, page_num, scale, rect=None, name='', source='reference', reference=None):
+        x0, y0, x1, y1 = rect if rect is not None else (None,) * 4
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO scales (project_id, page_num, name, x0, y0, x1, y1, scale, source, reference, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(project_id, page_num, name) DO UPDATE SET x0 = excluded.x0, y0 = excluded.y0, "
+                "x1 = excluded.x1, y1 = excluded.y1, scale = excluded.scale, source = excluded.source, "
+                "reference = excluded.reference",
+                (project_id, page_num, name, x0, y0, x1, y1, scale, source,
+                 json.dumps(reference) if reference is not None else None, time.time()),
+            )
+            return conn.execute(
+                "SELECT id FROM scales WHERE project_id = ? AND page_num = ? AND name = ?",
+                (project_id, page_num, name),
+            ).fetchone()['id']
+
+    def remove_scales(self, project_id, page_num, name=None):
+        query = "DELETE FROM scales WHERE project_id = ? AND page_num = ?"
+        params = (project_id, page_num)
+        if name is not None:
+            query += " AND name = ?"
+            params += (name,)
+        with self._connect() as conn:
+            return conn.execute(query, params).rowcount
+
+
+STORES = {
+    'sqlite': SQLiteProjectStore,
+}
+
+
+def open_store(url):
+    scheme, sep, location = url.partition(':///')
+    if not sep or scheme not in STORES:
+        raise ValueError(f"Unsupported project store URL: {url}")
+    return STORES[scheme](location)
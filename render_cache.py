@@ -0,0 +1,211 @@
+"""Content-addressed cache for rendered page images.
+
+Two tiers:
+
+* a byte-bounded, in-process LRU (per gunicorn worker)
+* a byte-bounded directory on disk, shared by every worker on the host
+
+Keys are derived from the upload's content hash, so the same drawing set maps
+to the same entries no matter who uploaded it or under which file name.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def format_zoom(zoom):
+    # Repeated *1.2 / /1.2 zoom steps drift in the last digits; don't let that miss the cache
+    return f"{float(zoom):.4f}"
+
+
+class RenderCache:
+
+    def __init__(self, root, memory_bytes=128 * 1024 * 1024, disk_bytes=2 * 1024 * 1024 * 1024, scan_disk=True):
+        self.root = root
+        self.memory_limit = memory_bytes
+        self.disk_limit = disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'memory_evictions': 0,
+            'disk_evictions': 0,
+            'bytes_written': 0,
+        }
+        os.makedirs(self.root, exist_ok=True)
+        # Short-lived writers (pre-render workers) skip the walk and report their writes instead
+        self._disk_bytes = sum(size for _, size, _ in self._scan_disk()) if scan_disk else 0
+
+    @staticmethod
+    def make_key(doc_hash, page_num, zoom, fmt, variant=''):
+        # variant distinguishes renderer backends, tiles, etc. for the same page/zoom
+        suffix = f"_{variant}" if variant else ''
+        return f"{doc_hash}/{page_num}_{format_zoom(zoom)}{suffix}.{fmt}"
+
+    @classmethod
+    def page_key(cls, doc_hash, page_num, zoom, fmt, backend):
+        return cls.make_key(doc_hash, page_num, zoom, fmt, variant=backend)
+
+    @classmethod
+    def tile_key(cls, doc_hash, page_num, zoom, fmt, backend, tile_size, tile_x, tile_y):
+        return cls.make_key(doc_hash, page_num, zoom, fmt, variant=f"{backend}_t{tile_size}_{tile_x}_{tile_y}")
+
+    @classmethod
+    def ready_key(cls, doc_hash, page_num, zoom, backend, tile_size):
+        # Empty marker written once every tile of a page at this zoom is on disk
+        return cls.make_key(doc_hash, page_num, zoom, 'ready', variant=f"{backend}_t{tile_size}")
+
+    def _path(self, key):
+        doc_hash, name = key.split('/', 1)
+        return os.path.join(self.root, doc_hash[:2], doc_hash, name)
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._counters['memory_hits'] += 1
+                return data
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self._counters['misses'] += 1
+            return None
+
+        # Bump mtime so disk eviction approximates LRU (atime is often disabled)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self._counters['disk_hits'] += 1
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        self._remember(key, data)
+
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write-then-rename so concurrent workers never read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self._counters['bytes_written'] += len(data)
+            self._disk_bytes += len(data)
+            over_budget = self._disk_bytes > self.disk_limit
+        if over_budget:
+            self._evict_disk()
+
+    def record_external_writes(self, nbytes):
+        # Bytes another process put under our root; keeps the disk budget honest
+        with self._lock:
+            self._disk_bytes += nbytes
+            over_budget = self._disk_bytes > self.disk_limit
+        if over_budget:
+            self._evict_disk()
+
+    def contains(self, key):
+        with self._lock:
+            if key in self._memory:
+                return True
+        return os.path.exists(self._path(key))
+
+    def get_or_render(self, key, render):
+        data = self.get(key)
+        if data is None:
+            data = render()
+            self.put(key, data)
+        return data
+
+    def _remember(self, key, data):
+        size = len(data)
+        # A single huge render shouldn't flush the whole memory tier
+        if size > self.memory_limit // 4:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous)
+            self._memory[key] = data
+            self._memory_bytes += size
+            while self._memory_bytes > self.memory_limit and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+                self._counters['memory_evictions'] += 1
+
+    def _scan_disk(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict_disk(self):
+        # Other workers write to the same directory, so re-scan rather than trust our own tally.
+        # The walk happens outside self._lock to keep memory-tier hits unblocked.
+        with self._evict_lock:
+            entries = sorted(self._scan_disk())
+            total = sum(size for _, size, _ in entries)
+            target = int(self.disk_limit * 0.9)
+            evicted = 0
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                total -= size
+                evicted += 1
+            with self._lock:
+                self._disk_bytes = total
+                self._counters['disk_evictions'] += evicted
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({
+                'memory_bytes': self._memory_bytes,
+                'memory_entries': len(self._memory),
+                'memory_limit': self.memory_limit,
+                'disk_bytes': self._disk_bytes,
+                'disk_limit': self.disk_limit,
+            })
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
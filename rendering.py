@@ -0,0 +1,157 @@
+"""Page rasterizers used by the viewer.
+
+Two backends are available:
+
+* ``pymupdf`` renders in-process with ``Page.get_pixmap`` and encodes straight
+  from the pixmap buffer. This is the default.
+* ``poppler`` goes through pdf2image / ``pdftoppm``. It is slower (one
+  subprocess and a temp PPM per call) and only kept for fidelity comparisons.
+"""
+import io
+import math
+
+import fitz  # PyMuPDF
+
+from doc_pool import open_document
+
+SUPPORTED_FORMATS = ('png', 'webp')
+
+MIMETYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
+
+def tile_clip(page_rect, zoom, tile_x, tile_y, tile_size):
+    """Page-space rectangle covered by pixel tile (tile_x, tile_y) at ``zoom``."""
+    step = tile_size / zoom
+    clip = fitz.Rect(
+        page_rect.x0 + tile_x * step,
+        page_rect.y0 + tile_y * step,
+        page_rect.x0 + (tile_x + 1) * step,
+        page_rect.y0 + (tile_y + 1) * step,
+    )
+    return clip & page_rect
+
+
+class PageRenderer:
+    name = None
+
+    def __init__(self, documents=None):
+        # Optional doc_pool.DocumentPool; without one every call opens the file
+        self.documents = documents
+
+    def render(self, pdf_path, page_num, zoom, fmt='png'):
+        """Return the encoded image bytes of one page at the given zoom."""
+        raise NotImplementedError
+
+    def render_tile(self, pdf_path, page_num, zoom, tile_x, tile_y, tile_size, fmt='png'):
+        """Return the encoded bytes of one ``tile_size`` pixel tile of a page.
+        Tiles on the right/bottom edge are cut to the page."""
+        raise NotImplementedError
+
+    def render_tiles(self, pdf_path, page_num, zoom, tile_size, fmt='png', skip=None):
+        """Yield ``(tile_x, tile_y, bytes)`` for every tile of a page, leaving out
+        tiles for which ``skip(tile_x, tile_y)`` is true."""
+        raise NotImplementedError
+
+
+class PyMuPDFRenderer(PageRenderer):
+    name = 'pymupdf'
+
+    def __init__(self, webp_quality=85, documents=None):
+        super().__init__(documents)
+        self.webp_quality = webp_quality
+
+    def render(self, pdf_path, page_num, zoom, fmt='png'):
+        with open_document(pdf_path, self.documents) as doc:
+            return self.render_page(doc[page_num], zoom, fmt)
+
+    def render_tile(self, pdf_path, page_num, zoom, tile_x, tile_y, tile_size, fmt='png'):
+        with open_document(pdf_path, self.documents) as doc:
+            page = doc[page_num]
+            clip = tile_clip(page.rect, zoom, tile_x, tile_y, tile_size)
+            if clip.is_empty:
+                raise ValueError(f"Tile {tile_x},{tile_y} is outside page {page_num}")
+            return self.render_page(page, zoom, fmt, clip=clip)
+
+    def render_tiles(self, pdf_path, page_num, zoom, tile_size, fmt='png', skip=None):
+        # One document open for the whole page instead of one per tile
+        with open_document(pdf_path, self.documents) as doc:
+            page = doc[page_num]
+            cols = math.ceil(page.rect.width * zoom / tile_size)
+            rows = math.ceil(page.rect.height * zoom / tile_size)
+            for tile_y in range(rows):
+                for tile_x in range(cols):
+                    if skip and skip(tile_x, tile_y):
+                        continue
+                    clip = tile_clip(page.rect, zoom, tile_x, tile_y, tile_size)
+                    if not clip.is_empty:
+                        yield tile_x, tile_y, self.render_page(page, zoom, fmt, clip=clip)
+
+    def render_page(self, page, zoom, fmt='png', clip=None):
+        # 72 dpi is zoom 1.0, so the matrix is the zoom level on both axes
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+        return self.encode(pix, fmt)
+
+    def encode(self, pix, fmt):
+        if fmt == 'png':
+            return pix.tobytes('png')
+        if fmt == 'webp':
+            # MuPDF has no WebP writer; hand the raw samples to Pillow
+            return pix.pil_tobytes(format='WEBP', quality=self.webp_quality)
+        raise ValueError(f"Unsupported image format: {fmt}")
+
+
+class PopplerRenderer(PageRenderer):
+    name = 'poppler'
+
+    def render(self, pdf_path, page_num, zoom, fmt='png'):
+        return self.encode(self._render_image(pdf_path, page_num, zoom), fmt)
+
+    def render_tile(self, pdf_path, page_num, zoom, tile_x, tile_y, tile_size, fmt='png'):
+        # pdftoppm can't clip through pdf2image, so crop the full render
+        img = self._render_image(pdf_path, page_num, zoom)
+        box = (tile_x * tile_size, tile_y * tile_size,
+               min((tile_x + 1) * tile_size, img.width), min((tile_y + 1) * tile_size, img.height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            raise ValueError(f"Tile {tile_x},{tile_y} is outside page {page_num}")
+        return self.encode(img.crop(box), fmt)
+
+    def render_tiles(self, pdf_path, page_num, zoom, tile_size, fmt='png', skip=None):
+        img = self._render_image(pdf_path, page_num, zoom)
+        for tile_y in range(math.ceil(img.height / tile_size)):
+            for tile_x in range(math.ceil(img.width / tile_size)):
+                if skip and skip(tile_x, tile_y):
+                    continue
+                box = (tile_x * tile_size, tile_y * tile_size,
+                       min((tile_x + 1) * tile_size, img.width), min((tile_y + 1) * tile_size, img.height))
+                yield tile_x, tile_y, self.encode(img.crop(box), fmt)
+
+    def _render_image(self, pdf_path, page_num, zoom):
+        from pdf2image import convert_from_path
+
+        pages = convert_from_path(pdf_path, first_page=page_num + 1, last_page=page_num + 1, dpi=72 * zoom)
+        if not pages:
+            raise ValueError(f"Page {page_num} could not be rendered")
+        return pages[0]
+
+    def encode(self, img, fmt):
+        if fmt not in SUPPORTED_FORMATS:
+            raise ValueError(f"Unsupported image format: {fmt}")
+        buf = io.BytesIO()
+        img.save(buf, format=fmt.upper())
+        return buf.getvalue()
+
+
+RENDERERS = {
+    PyMuPDFRenderer.name: PyMuPDFRenderer,
+    PopplerRenderer.name: PopplerRenderer,
+}
+
+
+def get_renderer(name='pymupdf', **kwargs):
+    try:
+        return RENDERERS[name](**kwargs)
+    except KeyError:
+        raise ValueError(f"Unknown render backend: {name}") from None
@@ -0,0 +1,357 @@
+"""One-click room detection on vector floor plans.
+
+The walls of a room are line segments in the page's drawings (the same
+segments the snap index holds). Around the click, those segments are split
+where they cross or touch, endpoints closer than ``tolerance`` are merged
+(union-find), and dangling edges (dimension lines, hatching ends, door
+leaves) are pruned, which leaves a planar graph. The room is the face of
+that graph containing the click: a ray cast to the right finds the nearest
+wall, and the face is traced from there by always turning as far right as
+possible at each vertex.
+
+Only segments within a window around the click are used. The window's own
+border is added as walls; a face that runs along it isn't closed yet, so the
+window grows until the room closes or the whole plan is covered. Furniture
+and other islands inside the room don't count against its area.
+"""
+import numpy as np
+
+# Segments touching or crossing closer than this (in points) are joined
+DEFAULT_TOLERANCE = 0.5
+# First window half-size around the click, in points; doubled until the room closes
+START_RADIUS = 150.0
+# Consecutive room vertices this close to a straight line are merged
+COLLINEAR_TOLERANCE = 1e-3
+
+
+def polygon_area(points):
+    """Signed shoelace area of (..., K, 2) polygons (positive when counter-clockwise in y-up coordinates)."""
+    x, y = points[..., 0], points[..., 1]
+    return 0.5 * (np.sum(x * np.roll(y, -1, axis=-1), axis=-1) - np.sum(y * np.roll(x, -1, axis=-1), axis=-1))
+
+
+def polygon_perimeter(points):
+    d = np.roll(points, -1, axis=-2) - points
+    return np.sum(np.hypot(d[..., 0], d[..., 1]), axis=-1)
+
+
+def _candidate_pairs(segments, tolerance):
+    """Pairs ``(i, j)``, i < j, whose bounding boxes (grown by ``tolerance``)
+    overlap: a sweep along x over the boxes sorted by their left edge."""
+    lo = np.minimum(segments[:, :2], segments[:, 2:]) - tolerance
+    hi = np.maximum(segments[:, :2], segments[:, 2:]) + tolerance
+    order = np.argsort(lo[:, 0], kind='stable')
+    lo, hi = lo[order], hi[order]
+    # Boxes starting before this one ends are the ones it can overlap along x
+    ends = np.searchsorted(lo[:, 0], hi[:, 0], side='right')
+    counts = ends - np.arange(len(order)) - 1
+    a = np.repeat(np.arange(len(order)), counts)
+    b = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + a + 1
+    keep = (lo[b, 1] <= hi[a, 1]) & (lo[a, 1] <= hi[b, 1])
+    return order[a[keep]], order[b[keep]]
+
+
+def _split_params(segments, tolerance):
+    """Where each segment has to be split: ``(owner, t)`` arrays of positions
+    along segments (0..1), including both ends."""
+    n = len(segments)
+    owners = [np.arange(n), np.arange(n)]
+    params = [np.zeros(n), np.ones(n)]
+    i, j = _candidate_pairs(segments, tolerance)
+    if len(i):
+        p, r = segments[i, :2], segments[i, 2:] - segments[i, :2]
+        q, s = segments[j, :2], segments[j, 2:] - segments[j, :2]
+        # Proper crossings
+        denom = r[:, 0] * s[:, 1] - r[:, 1] * s[:, 0]
+        qp = q - p
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (qp[:, 0] * s[:, 1] - qp[:, 1] * s[:, 0]) / denom
+            u = (qp[:, 0] * r[:, 1] - qp[:, 1] * r[:, 0]) / denom
+        crossing = (np.abs(denom) > 1e-12) & (t > 0) & (t < 1) & (u > 0) & (u < 1)
+        owners += [i[crossing], j[crossing]]
+        params += [t[crossing], u[crossing]]
+
+        # Endpoints touching the other segment: T-junctions, small overshoots
+        # and gaps, and collinear overlaps
+        for a, b in ((i, j), (j, i)):
+            start, d = segments[a, :2], segments[a, 2:] - segments[a, :2]
+            length_sq = np.maximum(np.einsum('ij,ij->i', d, d), 1e-12)
+            for end in (segments[b, :2], segments[b, 2:]):
+                t = np.einsum('ij,ij->i', end - start, d) / length_sq
+                near = start + d * np.clip(t, 0, 1)[:, None]
+                touching = (np.hypot(*(end - near).T) <= tolerance) & (t > 0) & (t < 1)
+                owners.append(a[touching])
+                params.append(t[touching])
+    return np.concatenate(owners), np.concatenate(params)
+
+
+class _UnionFind:
+
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, k):
+        parent = self.parent
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+    def roots(self):
+        return np.array([self.find(k) for k in range(len(self.parent))], dtype=np.int64)
+
+
+def _link(count, a, b):
+    """Component labels of ``count`` items joined by the pairs ``a[k]``-``b[k]``
+    (the smallest item of each component)."""
+    labels = np.arange(count)
+    while len(a):
+        low = np.minimum(labels[a], labels[b])
+        before = labels.copy()
+        np.minimum.at(labels, a, low)
+        np.minimum.at(labels, b, low)
+        labels = labels[labels]
+        if np.array_equal(before, labels):
+            break
+    return labels
+
+
+def _merge_points(points, tolerance, weights):
+    """Vertex IDs and positions for ``points``, merging points closer than
+    ``tolerance``: points are bucketed into grid cells of that size, and
+    neighbouring cells whose points are that close are joined. A vertex sits
+    at the ``weights``-weighted mean of its points."""
+    cells = np.floor(points / tolerance).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    rows = int(cells[:, 1].max()) + 2
+    keys, cell_of = np.unique(cells[:, 0] * rows + cells[:, 1], return_inverse=True)
+    cell_of = cell_of.reshape(-1)
+    counts = np.bincount(cell_of)
+    centres = np.column_stack([np.bincount(cell_of, points[:, 0]), np.bincount(cell_of, points[:, 1])])
+    centres /= counts[:, None]
+
+    pairs_a, pairs_b = [], []
+    for dx, dy in ((1, 0), (0, 1), (1, 1), (1, -1)):
+        wanted = keys + dx * rows + dy
+        found = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+        a = np.flatnonzero(keys[found] == wanted)
+        b = found[a]
+        close = np.hypot(*(centres[a] - centres[b]).T) <= tolerance
+        pairs_a.append(a[close])
+        pairs_b.append(b[close])
+    roots = _link(len(keys), np.concatenate(pairs_a), np.concatenate(pairs_b))
+    _, vertex_of_cell = np.unique(roots, return_inverse=True)
+    vertex_ids = vertex_of_cell.reshape(-1)[cell_of]
+    total = np.bincount(vertex_ids, weights)
+    vertices = np.column_stack([np.bincount(vertex_ids, points[:, 0] * weights),
+                                np.bincount(vertex_ids, points[:, 1] * weights)])
+    return vertex_ids, vertices / total[:, None]
+
+
+class PlanarGraph:
+    """Segments turned into a planar graph: ``vertices`` (V, 2) and undirected
+    ``edges`` (E, 2) with ``border`` marking edges from the window border."""
+
+    def __init__(self, segments, border_count=0, tolerance=DEFAULT_TOLERANCE):
+        segments = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+        # The last ``border_count`` segments are the window border
+        is_border = np.zeros(len(segments), dtype=bool)
+        if border_count:
+            is_border[-border_count:] = True
+
+        owner, t = _split_params(segments, tolerance)
+        order = np.lexsort((t, owner))
+        owner, t = owner[order], t[order]
+        points = segments[owner, :2] + (segments[owner, 2:] - segments[owner, :2]) * t[:, None]
+        # Points where a segment is split lie on it; a loose end next to them doesn't move them
+        weights = np.where((t > 0) & (t < 1), 1000.0, 1.0)
+        vertex_ids, self.vertices = _merge_points(points, tolerance, weights)
+
+        # Consecutive split points along the same segment make the edges
+        same = owner[1:] == owner[:-1]
+        u, v = vertex_ids[:-1][same], vertex_ids[1:][same]
+        border = is_border[owner[:-1][same]]
+        keep = u != v
+        u, v, border = u[keep], v[keep], border[keep]
+        pairs = np.column_stack([np.minimum(u, v), np.maximum(u, v)])
+        pairs, first = np.unique(pairs, axis=0, return_index=True)
+        border = border[first]
+        self.edges, self.border = self._prune(pairs.reshape(-1, 2), border, len(self.vertices))
+        self._build_half_edges()
+
+    @staticmethod
+    def _prune(edges, border, vertex_count):
+        # Dead ends can't bound a face; drop them until none are left
+        while len(edges):
+            degree = np.bincount(edges.ravel(), minlength=vertex_count)
+            keep = (degree[edges[:, 0]] > 1) & (degree[edges[:, 1]] > 1)
+            if keep.all():
+                break
+            edges, border = edges[keep], border[keep]
+        return edges, border
+
+    def _build_half_edges(self):
+        # Half-edge h and h ^ 1 are twins; outgoing half-edges of each vertex sorted by angle
+        e = len(self.edges)
+        self.src = np.empty(2 * e, dtype=np.int64)
+        self.src[0::2], self.src[1::2] = self.edges[:, 0], self.edges[:, 1]
+        self.dst = self.src.reshape(-1, 2)[:, ::-1].ravel().copy()
+        d = self.vertices[self.dst] - self.vertices[self.src]
+        angle = np.arctan2(d[:, 1], d[:, 0])
+        self.by_vertex = np.lexsort((angle, self.src))
+        self.rank = np.empty(2 * e, dtype=np.int64)
+        self.rank[self.by_vertex] = np.arange(2 * e)
+        self.first = np.searchsorted(self.src[self.by_vertex], np.arange(len(self.vertices) + 1))
+
+    def next_half_edge(self, h):
+        """The half-edge after ``h`` around the face on its left."""
+        twin = h ^ 1
+        v = self.src[twin]
+        start, count = self.first[v], self.first[v + 1] - self.first[v]
+        # Turn as far as possible: the outgoing edge just before the twin in angular order
+        return self.by_vertex[start + (self.rank[twin] - start - 1) % count]
+
+    def face(self, h):
+        """Half-edges of the face ``h`` belongs to, in order."""
+        cycle = [h]
+        limit = len(self.src)
+        h = self.next_half_edge(h)
+        while h != cycle[0]:
+            cycle.append(h)
+            if len(cycle) > limit:
+                raise RuntimeError("Face walk did not close")
+            h = self.next_half_edge(h)
+        return np.array(cycle)
+
+    def face_at(self, x, y, exclude=None):
+        """The half-edge cycle of the face around ``(x, y)``, found by casting a
+        ray to the right, or None when nothing is hit. Half-edges in ``exclude``
+        are ignored by the ray."""
+        a, b = self.vertices[self.edges[:, 0]], self.vertices[self.edges[:, 1]]
+        # Edges straddling the ray's line (half-open, so shared vertices count once)
+        straddle = (a[:, 1] > y) != (b[:, 1] > y)
+        if exclude is not None:
+            straddle &= ~exclude
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cross_x = a[:, 0] + (y - a[:, 1]) * (b[:, 0] - a[:, 0]) / (b[:, 1] - a[:, 1])
+        hits = np.flatnonzero(straddle & (cross_x > x))
+        if not len(hits):
+            return None
+        edge = hits[np.argmin(cross_x[hits])]
+        # Of the edge's two half-edges, take the one with the point on its left
+        h = 2 * edge
+        src, dst = self.vertices[self.src[h]], self.vertices[self.dst[h]]
+        side = (dst[0] - src[0]) * (y - src[1]) - (dst[1] - src[1]) * (x - src[0])
+        return self.face(h if side > 0 else h + 1)
+
+
+def _simplify(polygon):
+    # Split points along a straight wall aren't corners
+    while len(polygon) > 3:
+        prev, nxt = np.roll(polygon, 1, axis=0), np.roll(polygon, -1, axis=0)
+        a, b = polygon - prev, nxt - polygon
+        cross = a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+        scale = np.hypot(*a.T) * np.hypot(*b.T)
+        straight = (np.abs(cross) <= COLLINEAR_TOLERANCE * np.maximum(scale, 1e-12)) & \
+                   (np.einsum('ij,ij->i', a, b) > 0)
+        if not straight.any():
+            break
+        # Drop one of each run at a time so a run never vanishes entirely
+        drop = np.flatnonzero(straight)[::2]
+        polygon = np.delete(polygon, drop, axis=0)
+    return polygon
+
+
+def _window(segments, x, y, radius):
+    lo = np.minimum(segments[:, :2], segments[:, 2:])
+    hi = np.maximum(segments[:, :2], segments[:, 2:])
+    inside = (hi[:, 0] >= x - radius) & (lo[:, 0] <= x + radius) & (hi[:, 1] >= y - radius) & (lo[:, 1] <= y + radius)
+    return np.flatnonzero(inside)
+
+
+def _border(x, y, radius):
+    x0, y0, x1, y1 = x - radius, y - radius, x + radius, y + radius
+    return np.array([[x0, y0, x1, y0], [x1, y0, x1, y1], [x1, y1, x0, y1], [x0, y1, x0, y0]])
+
+
+def find_room(segments, x, y, tolerance=DEFAULT_TOLERANCE, start_radius=START_RADIUS, candidates=None):
+    """The closed region of the (N, 4) ``segments`` around ``(x, y)``.
+
+    ``candidates(radius)`` may return the indices of the segments within
+    ``radius`` of the click (e.g. from a spatial index); otherwise all
+    segments are tested. Returns ``{'polygon', 'area', 'perimeter'}`` in PDF
+    points, or None when the click isn't inside a closed region.
+    """
+    segments = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+    if not len(segments):
+        return None
+    lo, hi = segments.reshape(-1, 2).min(axis=0), segments.reshape(-1, 2).max(axis=0)
+    if not (lo[0] <= x <= hi[0] and lo[1] <= y <= hi[1]):
+        return None
+    # Beyond this the window covers every segment
+    max_radius = max(x - lo[0], hi[0] - x, y - lo[1], hi[1] - y) + 1.0
+
+    radius = start_radius
+    while True:
+        radius = min(radius, max_radius)
+        near = candidates(radius) if candidates is not None else _window(segments, x, y, radius)
+        local = np.vstack([segments[near], _border(x, y, radius)])
+        graph = PlanarGraph(local, border_count=4, tolerance=tolerance)
+        room = _room_in(graph, x, y)
+        if room is not None or radius >= max_radius:
+            return room
+        radius *= 2
+
+
+def _room_in(graph, x, y):
+    # None when there's no face around the point that is closed within the window
+    if not len(graph.edges):
+        return None
+    exclude = np.zeros(len(graph.edges), dtype=bool)
+    component = None
+    while True:
+        cycle = graph.face_at(x, y, exclude)
+        if cycle is None:
+            return None
+        edges = cycle // 2
+        if graph.border[edges].any():
+            return None
+        polygon = graph.vertices[graph.src[cycle]]
+        # The page is y-down, so a face with the point on its left runs clockwise on screen
+        if polygon_area(polygon) > 0:
+            polygon = _simplify(polygon)
+            return {
+                'polygon': polygon.tolist(),
+                'area': float(abs(polygon_area(polygon))),
+                'perimeter': float(polygon_perimeter(polygon)),
+            }
+        # The outside of an island (furniture, a column) inside the room: look past it
+        if component is None:
+            component = _components(graph)
+        exclude |= component == component[edges[0]]
+
+
+def _components(graph):
+    """Connected-component label of every edge."""
+    connected = _UnionFind(len(graph.vertices))
+    for u, v in graph.edges.tolist():
+        connected.union(u, v)
+    return connected.roots()[graph.edges[:, 0]]
+
+
+def find_room_in_index(index, x, y, tolerance=DEFAULT_TOLERANCE, start_radius=START_RADIUS):
+    """``find_room`` over a snapping ``SegmentIndex``, using its grid to pick
+    the segments near the click."""
+    return find_room(index.segments, x, y, tolerance, start_radius,
+                     candidates=lambda radius: index.near(x, y, radius))
+
+
+def room_dimensions(room, scale):
+    """Area and perimeter of ``room`` in drawing units for ``scale`` units per point."""
+    return room['area'] * scale * scale, room['perimeter'] * scale
+
@@ -0,0 +1,364 @@
+"""Automatic drawing-scale detection.
+
+Every page is checked for two kinds of evidence:
+
+* scale notes in the text layer (``get_text("words")``): ratios such as
+  "1:100" or "1:50 @ A1", and imperial notes such as
+  ``SCALE 1/4" = 1'-0"`` or ``1" = 20'``;
+* graphic scale bars: numeric labels (0, 5, 10, ...) on one baseline, spaced
+  linearly and sitting on a horizontal bar drawn in the vector layer.
+
+A bar is trusted over a note when they disagree, since a bar stays right when
+a sheet is printed at another size. A "1:100 @ A1" note on an A3 page is
+corrected for the reduction.
+
+Scales are in metres per PDF point, like the scale ``set_scale`` stores, so
+they don't depend on the zoom.
+"""
+import logging
+import math
+import multiprocessing
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from doc_pool import open_document
+from snapping import extract_segments
+
+# One PDF point on paper, in metres
+POINT_M = 0.0254 / 72
+
+UNITS_M = {
+    'mm': 0.001, 'cm': 0.01, 'm': 1.0, 'km': 1000.0,
+    'metre': 1.0, 'metres': 1.0, 'meter': 1.0, 'meters': 1.0,
+    'ft': 0.3048, 'feet': 0.3048, 'foot': 0.3048, "'": 0.3048, '’': 0.3048,
+}
+
+# Long side of ISO sheets in mm
+SHEET_LONG_MM = {'A0': 1189, 'A1': 841, 'A2': 594, 'A3': 420, 'A4': 297}
+
+# Ratios seen on drawings; others only count next to the word SCALE
+COMMON_RATIOS = {1, 2, 5, 10, 20, 25, 50, 75, 100, 125, 200, 250, 500, 750, 1000, 1250, 2000, 2500, 5000,
+                 10000}
+
+RATIO = re.compile(r'(?<![\d.:/])1\s*:\s*(\d{1,6}(?:[.,]\d+)?)(?![\d:])')
+SLASH_RATIO = re.compile(r'SCALE\s*:?\s*1\s*/\s*(\d{2,6})(?!\d)', re.I)
+SHEET = re.compile(r'(?:@|\bAT)\s*(A[0-4])\b', re.I)
+_FRACTION = r'(\d+(?:[ -]\d+/\d+)?|\d+/\d+|\d*\.\d+)'
+_INCH = r'(?:"|”|″|\s*in(?:ch(?:es)?)?\b)'
+_FOOT = r'(?:\'|’|′|\s*f(?:ee|oo)?t\b)'
+IMPERIAL = re.compile(rf'{_FRACTION}\s*{_INCH}\s*=\s*(\d+(?:\.\d+)?)\s*{_FOOT}(?:\s*-?\s*{_FRACTION}\s*{_INCH})?',
+                      re.I)
+NOT_TO_SCALE = re.compile(r'\bN\.?T\.?S\.?\b|NOT\s+TO\s+SCALE', re.I)
+BAR_LABEL = re.compile(r'^(\d+(?:\.\d+)?)\s*(mm|cm|km|m|ft|\'|’)?$', re.I)
+UNIT_WORD = re.compile(r'^\(?(mm|cm|km|m|metres?|meters?|ft|feet|foot)\)?\.?$', re.I)
+
+# A scale note and the word SCALE this close (in points) belong together
+KEYWORD_DISTANCE = 60.0
+# Bars and notes agreeing within this fraction confirm each other
+AGREEMENT = 0.02
+
+
+def _fraction(text):
+    if text is None:
+        return 0.0
+    text = text.strip()
+    whole, _, rest = text.replace('-', ' ').partition(' ')
+    if '/' in whole:
+        whole, rest = '0', whole
+    value = float(whole) if whole else 0.0
+    if rest:
+        num, _, den = rest.partition('/')
+        if den and float(den):
+            value += float(num) / float(den)
+    return value
+
+
+def ratio_scale(ratio):
+    """Metres per PDF point of a 1:``ratio`` drawing."""
+    return POINT_M * ratio
+
+
+def _page_long_mm(width, height):
+    return max(width, height) / 72 * 25.4
+
+
+def _rotated_boxes(page, boxes):
+    # Text comes in unrotated page space; the viewer (and the segments) use the rotated one
+    if not page.rotation or not len(boxes):
+        return boxes
+    m = page.rotation_matrix
+    corners = boxes[:, [0, 1, 2, 3, 0, 3, 2, 1]].reshape(-1, 4, 2)
+    x = corners[..., 0] * m.a + corners[..., 1] * m.c + m.e
+    y = corners[..., 0] * m.b + corners[..., 1] * m.d + m.f
+    return np.column_stack([x.min(axis=1), y.min(axis=1), x.max(axis=1), y.max(axis=1)])
+
+
+def _words(page):
+    words = page.get_text('words')
+    if not words:
+        return np.zeros((0, 4)), [], []
+    boxes = _rotated_boxes(page, np.array([w[:4] for w in words], dtype=np.float64))
+    return boxes, [w[4] for w in words], [(w[5], w[6]) for w in words]
+
+
+def _lines(boxes, texts, line_ids):
+    """Join words into text lines: ``[(text, bbox)]``."""
+    grouped = {}
+    for box, text, line_id in zip(boxes, texts, line_ids):
+        grouped.setdefault(line_id, []).append((box, text))
+    lines = []
+    for items in grouped.values():
+        line_boxes = np.array([box for box, _ in items])
+        bbox = (line_boxes[:, 0].min(), line_boxes[:, 1].min(), line_boxes[:, 2].max(), line_boxes[:, 3].max())
+        lines.append((' '.join(text for _, text in items), bbox))
+    return lines
+
+
+def _box_distance(a, b):
+    dx = max(a[0] - b[2], b[0] - a[2], 0.0)
+    dy = max(a[1] - b[3], b[1] - a[3], 0.0)
+    return math.hypot(dx, dy)
+
+
+def parse_scale_notes(lines, page_width, page_height):
+    """Scale candidates from text lines (``[(text, bbox)]``): dicts with the
+    ratio, scale, label, bbox and confidence. Also used for OCR'd text."""
+    keyword_boxes = [bbox for text, bbox in lines if 'SCALE' in text.upper()]
+    candidates = []
+    for text, bbox in lines:
+        near_keyword = any(_box_distance(bbox, kb) <= KEYWORD_DISTANCE for kb in keyword_boxes)
+        found = []
+        for match in RATIO.finditer(text):
+            ratio = float(match.group(1).replace(',', '.'))
+            if ratio <= 0 or (not near_keyword and ratio not in COMMON_RATIOS):
+                continue
+            found.append((ratio, match, 0.85 if near_keyword else 0.5))
+        for match in SLASH_RATIO.finditer(text):
+            found.append((float(match.group(1)), match, 0.85))
+        for match in IMPERIAL.finditer(text):
+            paper_in = _fraction(match.group(1))
+            real_in = float(match.group(2)) * 12 + _fraction(match.group(3))
+            if paper_in > 0 and real_in > 0:
+                found.append((real_in / paper_in, match, 0.85 if near_keyword else 0.7))
+
+        for ratio, match, confidence in found:
+            label = match.group(0).strip()
+            sheet = SHEET.search(text, match.end())
+            if sheet:
+                # "1:100 @ A1" printed on another sheet size: the ratio shrinks with the paper
+                sheet_mm = SHEET_LONG_MM[sheet.group(1).upper()]
+                factor = sheet_mm / _page_long_mm(page_width, page_height)
+                if abs(factor - 1) > 0.03:
+                    ratio *= factor
+                label = f"{label} @ {sheet.group(1).upper()}"
+            candidates.append({
+                'ratio': ratio,
+                'scale': ratio_scale(ratio),
+                'label': label,
+                'bbox': [float(v) for v in bbox],
+                'confidence': confidence,
+            })
+    return candidates
+
+
+def find_scale_bars(boxes, texts, segments):
+    """Graphic scale bars: numeric labels on one baseline, starting at 0,
+    spaced linearly along a drawn horizontal bar."""
+    labels = []
+    for box, text in zip(boxes, texts):
+        match = BAR_LABEL.match(text)
+        if match:
+            labels.append(((box[0] + box[2]) / 2, (box[1] + box[3]) / 2, box[3] - box[1],
+                           float(match.group(1)), (match.group(2) or '').lower()))
+    if len(labels) < 3:
+        return []
+
+    if len(segments):
+        horizontal = segments[np.abs(segments[:, 1] - segments[:, 3]) < 0.5]
+    else:
+        horizontal = np.zeros((0, 4))
+
+    labels.sort(key=lambda label: label[1])
+    bands = []
+    for label in labels:
+        if bands and abs(label[1] - bands[-1][-1][1]) <= 0.5 * max(label[2], bands[-1][-1][2]):
+            bands[-1].append(label)
+        else:
+            bands.append([label])
+
+    bars = []
+    for band in bands:
+        band.sort(key=lambda label: label[0])
+        for start, label in enumerate(band):
+            if label[3] != 0:
+                continue
+            run = [label]
+            for nxt in band[start + 1:]:
+                if nxt[3] > run[-1][3] and nxt[0] > run[-1][0]:
+                    run.append(nxt)
+                elif nxt[3] <= run[-1][3]:
+                    break
+            if len(run) < 3:
+                continue
+            bar = _fit_bar(run, band, boxes, texts, horizontal)
+            if bar is not None:
+                bars.append(bar)
+    return bars
+
+
+def _fit_bar(run, band, boxes, texts, horizontal):
+    xs = np.array([label[0] for label in run])
+    values = np.array([label[3] for label in run])
+    slope, intercept = np.polyfit(values, xs, 1)
+    span = xs[-1] - xs[0]
+    if slope <= 0 or np.abs(xs - (intercept + slope * values)).max() > 0.02 * span + 1.0:
+        return None
+
+    # The labels have to sit on (or just under) a drawn bar covering most of their span
+    height = max(label[2] for label in run)
+    y = np.mean([label[1] for label in run])
+    near = horizontal[np.abs(horizontal[:, 1] - y) <= 6 * height]
+    lo, hi = xs[0] - 2, xs[-1] + 2
+    intervals = sorted(
+        (max(min(s[0], s[2]), lo), min(max(s[0], s[2]), hi)) for s in near
+        if max(s[0], s[2]) > lo and min(s[0], s[2]) < hi
+    )
+    covered, reach = 0.0, lo
+    for a, b in intervals:
+        if b > reach:
+            covered += b - max(a, reach)
+            reach = b
+    if covered < 0.8 * span:
+        return None
+
+    unit = next((label[4] for label in run if label[4]), None)
+    if unit is None:
+        last = run[-1]
+        for box, text in zip(boxes, texts):
+            cx, cy = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+            if (abs(cy - last[1]) <= 3 * height and 0 < cx - last[0] <= 8 * height
+                    and UNIT_WORD.match(text)):
+                unit = UNIT_WORD.match(text).group(1).lower()
+                break
+    confidence = 0.9 if unit else 0.6
+    unit_m = UNITS_M.get(unit or 'm', 1.0)
+    scale = unit_m / slope
+    if not 1e-4 <= scale <= 50:
+        return None
+    return {
+        'ratio': scale / POINT_M,
+        'scale': scale,
+        'label': f"bar 0-{run[-1][3]:g} {unit or 'm?'}",
+        'bbox': [float(xs[0]), float(y - height), float(xs[-1]), float(y + height)],
+        'confidence': confidence,
+    }
+
+
+def _agree(a, b):
+    return abs(a['scale'] - b['scale']) <= AGREEMENT * max(a['scale'], b['scale'])
+
+
+def _best(candidates, page_width, page_height):
+    # Most confident first; ties go to the one nearest the title block (bottom right)
+    def key(candidate):
+        x0, y0, x1, y1 = candidate['bbox']
+        corner = math.hypot(page_width - x1, page_height - y1)
+        return (-candidate['confidence'], corner)
+    return min(candidates, key=key) if candidates else None
+
+
+def combine(notes, bars, page_width, page_height, nts=False):
+    """Pick a page's scale from note and bar candidates."""
+    result = {'scale': None, 'ratio': None, 'source': None, 'label': None, 'confidence': 0.0,
+              'nts': nts, 'candidates': len(notes) + len(bars)}
+    note = _best(notes, page_width, page_height)
+    bar = _best(bars, page_width, page_height)
+    if note is None and bar is None:
+        return result
+
+    if note is not None and bar is not None:
+        if _agree(note, bar):
+            chosen, source, confidence = note, 'text+bar', 0.97
+        else:
+            chosen, source, confidence = bar, 'bar', min(bar['confidence'], 0.6)
+    elif bar is not None:
+        chosen, source, confidence = bar, 'bar', bar['confidence']
+    else:
+        chosen, source, confidence = note, 'text', note['confidence']
+        if len({round(c['ratio'], 3) for c in notes}) > 1:
+            # Several scales on one sheet (details): less sure which one is the sheet's
+            confidence = min(confidence, 0.5)
+    if nts:
+        confidence = min(confidence, 0.3)
+    result.update(scale=chosen['scale'], ratio=chosen['ratio'], source=source, label=chosen['label'],
+                  confidence=confidence, bbox=chosen['bbox'])
+    return result
+
+
+def detect_page_scale(page):
+    width, height = page.rect.width, page.rect.height
+    boxes, texts, line_ids = _words(page)
+    lines = _lines(boxes, texts, line_ids)
+    notes = parse_scale_notes(lines, width, height)
+    nts = any(NOT_TO_SCALE.search(text) for text, _ in lines)
+    bars = find_scale_bars(boxes, texts, extract_segments(page)) if len(texts) >= 3 else []
+    result = combine(notes, bars, width, height, nts)
+    result['has_text'] = bool(texts)
+    return result
+
+
+def detect_range(pdf_path, first, last):
+    """Worker entry point: ``{page_num: result}`` for pages ``first``..``last``."""
+    results = {}
+    with open_document(pdf_path) as doc:
+        for page_num in range(first, last + 1):
+            try:
+                results[page_num] = detect_page_scale(doc[page_num])
+            except Exception as e:
+                logging.warning(f"Scale detection failed on page {page_num}: {e}")
+                results[page_num] = {'scale': None, 'error': str(e)}
+    return results
+
+
+class ScaleDetector:
+    """Runs detection over a whole document, split into page ranges on a
+    process pool. Even a single range goes to the pool: detection runs on a
+    job thread, and PyMuPDF isn't safe to use next to the request threads."""
+
+    def __init__(self, max_workers=2, chunk_pages=16):
+        self.max_workers = max_workers
+        self.chunk_pages = chunk_pages
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn, not fork: forking a threaded Flask process can deadlock the child
+                ctx = multiprocessing.get_context('spawn')
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=ctx)
+            return self._executor
+
+    def detect(self, pdf_path, page_count, progress=None):
+        """Results for every page, in page order."""
+        ranges = [(first, min(first + self.chunk_pages, page_count) - 1)
+                  for first in range(0, page_count, self.chunk_pages)]
+        results = {}
+        futures = {self._pool().submit(detect_range, pdf_path, first, last): (first, last)
+                   for first, last in ranges}
+        try:
+            for future in as_completed(futures):
+                results.update(future.result())
+                if progress:
+                    progress(len(results), page_count)
+        finally:
+            for future in futures:
+                future.cancel()
+        return [results[page_num] for page_num in range(page_count)]
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
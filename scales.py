@@ -0,0 +1,76 @@
+"""Which drawing scale applies to a measurement.
+
+A sheet often mixes a plan at 1:100 with details at 1:20, so scales belong
+to a page, and optionally to a named viewport on it: a rectangle in PDF
+points. Scales are real-world units per PDF point, so the zoom never enters
+into a measurement. A measurement takes the scale of the smallest viewport
+that contains all of its points, else its page's scale, else the document's
+default (the project's ``scale``).
+"""
+import numpy as np
+
+
+def normalize_rect(rect):
+    x0, y0, x1, y1 = (float(v) for v in rect)
+    return [min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)]
+
+
+class ScaleMap:
+    """Scales as returned by ``ProjectStore.list_scales``, for lookups."""
+
+    def __init__(self, scales, default=None):
+        self.default = default
+        self.page_scales = {}
+        viewports = []
+        for scale in scales:
+            if scale['rect'] is None:
+                self.page_scales[scale['page_num']] = scale
+            else:
+                viewports.append(scale)
+        # Smallest first, so a detail wins over the plan it sits in
+        rects = np.array([normalize_rect(scale['rect']) for scale in viewports], dtype=np.float64).reshape(-1, 4)
+        order = np.argsort((rects[:, 2] - rects[:, 0]) * (rects[:, 3] - rects[:, 1]), kind='stable')
+        self.viewports = [viewports[i] for i in order]
+        self._rects = rects[order]
+        self._pages = np.array([scale['page_num'] for scale in self.viewports], dtype=np.int64)
+        self._values = np.array([scale['scale'] for scale in self.viewports], dtype=np.float64)
+        self._ids = np.array([scale['id'] for scale in self.viewports], dtype=np.int64)
+
+    def has_scale(self, page_num):
+        return (self.default is not None or page_num in self.page_scales
+                or bool((self._pages == page_num).any()))
+
+    def lookup(self, page_nums, points):
+        """Scales for N measurements: ``page_nums`` is (N,), ``points`` is
+        (N, K, 2) in PDF points. Returns ``(scales, scale_ids)``; the scale is
+        NaN where none applies and the ID is -1 for the document default."""
+        page_nums = np.asarray(page_nums, dtype=np.int64)
+        scales = np.full(len(page_nums), np.nan)
+        scale_ids = np.full(len(page_nums), -1, dtype=np.int64)
+        if len(self.viewports) and len(page_nums):
+            # NaN points (rejected batch entries) fall outside every viewport
+            lo, hi = points.min(axis=1), points.max(axis=1)
+            # (N, V): the viewport is on the measurement's page and holds its bounding box
+            inside = ((self._pages[None, :] == page_nums[:, None])
+                      & (lo[:, None, 0] >= self._rects[None, :, 0]) & (lo[:, None, 1] >= self._rects[None, :, 1])
+                      & (hi[:, None, 0] <= self._rects[None, :, 2]) & (hi[:, None, 1] <= self._rects[None, :, 3]))
+            hit = inside.any(axis=1)
+            first = inside.argmax(axis=1)[hit]
+            scales[hit] = self._values[first]
+            scale_ids[hit] = self._ids[first]
+        for page_num, scale in self.page_scales.items():
+            mask = np.isnan(scales) & (page_nums == page_num)
+            scales[mask] = scale['scale']
+            scale_ids[mask] = scale['id']
+        if self.default is not None:
+            scales[np.isnan(scales)] = self.default
+        return scales, scale_ids
+
+    def describe(self, scale_id):
+        """Name of the scale with ``scale_id``: the viewport's name, 'page' or 'document'."""
+        if scale_id == -1:
+            return 'document'
+        for scale in self.viewports:
+            if scale['id'] == scale_id:
+                return scale['name']
+        return 'page'
@@ -0,0 +1,226 @@
+"""Snapping to the vector geometry of a page.
+
+The page's drawing primitives (``Page.get_drawings()``) are flattened into
+line segments and put into a uniform-grid spatial index stored as CSR arrays,
+so a snap query only looks at the handful of grid cells around the click.
+Indexes are built once per page and kept on disk (``.npz``) next to the
+render cache, keyed by document hash and page number.
+"""
+import math
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from doc_pool import open_document
+
+# Grids never get more cells than this per axis, however dense the page
+MAX_GRID_CELLS = 1024
+# Long segments are indexed as pieces of at most this many cells
+PIECE_CELLS = 4
+
+
+def extract_segments(page):
+    """Return an (N, 4) array of x0, y0, x1, y1 segments in page (rotated) coordinates."""
+    coords = []
+    for path in page.get_drawings():
+        for item in path['items']:
+            op = item[0]
+            if op == 'l':
+                p1, p2 = item[1], item[2]
+                coords.append((p1.x, p1.y, p2.x, p2.y))
+            elif op == 'c':
+                # Curves snap by their chord; the endpoints are what matters on plans
+                p1, p2 = item[1], item[4]
+                coords.append((p1.x, p1.y, p2.x, p2.y))
+            elif op in ('re', 'qu'):
+                quad = item[1].quad if op == 're' else item[1]
+                corners = (quad.ul, quad.ur, quad.lr, quad.ll)
+                for a, b in zip(corners, corners[1:] + corners[:1]):
+                    coords.append((a.x, a.y, b.x, b.y))
+
+    segments = np.asarray(coords, dtype=np.float64).reshape(-1, 4)
+    if page.rotation and len(segments):
+        # Drawings come in unrotated page space; the viewer works in the rotated one
+        m = page.rotation_matrix
+        pts = segments.reshape(-1, 2)
+        x = pts[:, 0] * m.a + pts[:, 1] * m.c + m.e
+        y = pts[:, 0] * m.b + pts[:, 1] * m.d + m.f
+        segments = np.column_stack([x, y]).reshape(-1, 4)
+    # Zero-length segments only add noise
+    keep = (segments[:, 0] != segments[:, 2]) | (segments[:, 1] != segments[:, 3])
+    return segments[keep]
+
+
+class _Grid:
+    """Items (boxes) bucketed into grid cells; cell ``c`` holds
+    ``items[starts[c]:starts[c + 1]]``."""
+
+    def __init__(self, origin, cell_size, shape, x0, y0, x1, y1):
+        self.origin = origin
+        self.cell_size = cell_size
+        self.nx, self.ny = shape
+        cx0, cy0 = self.cell(np.minimum(x0, x1), np.minimum(y0, y1))
+        cx1, cy1 = self.cell(np.maximum(x0, x1), np.maximum(y0, y1))
+
+        widths = cx1 - cx0 + 1
+        counts = widths * (cy1 - cy0 + 1)
+        owner = np.repeat(np.arange(len(counts)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = (cy0[owner] + offsets // widths[owner]) * self.nx + cx0[owner] + offsets % widths[owner]
+
+        order = np.argsort(cells, kind='stable')
+        self.items = owner[order].astype(np.int32)
+        self.starts = np.searchsorted(cells[order], np.arange(self.nx * self.ny + 1)).astype(np.int32)
+
+    def cell(self, x, y):
+        cx = np.clip(((x - self.origin[0]) // self.cell_size).astype(np.int64), 0, self.nx - 1)
+        cy = np.clip(((y - self.origin[1]) // self.cell_size).astype(np.int64), 0, self.ny - 1)
+        return cx, cy
+
+    def query(self, x, y, radius):
+        (cx0, cx1), (cy0, cy1) = self.cell(np.array([x - radius, x + radius]), np.array([y - radius, y + radius]))
+        # Cells of one grid row are contiguous in the CSR arrays
+        chunks = [
+            self.items[self.starts[row * self.nx + cx0]:self.starts[row * self.nx + cx1 + 1]]
+            for row in range(cy0, cy1 + 1)
+        ]
+        if not chunks:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate(chunks))
+
+
+class SegmentIndex:
+
+    def __init__(self, segments):
+        self.segments = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+        self.vertices = np.unique(self.segments.reshape(-1, 2), axis=0)
+        if not len(self.segments):
+            self.vertex_grid = self.piece_grid = None
+            return
+
+        pts = self.segments.reshape(-1, 2)
+        lo, hi = pts.min(axis=0), pts.max(axis=0)
+        extent = np.maximum(hi - lo, 1.0)
+        # Aim for a couple of segments per cell, but cap the number of cells
+        cell_size = max(math.sqrt(extent[0] * extent[1] / len(self.segments)) * 2,
+                        float(extent.max()) / MAX_GRID_CELLS, 0.5)
+        shape = (int(extent[0] // cell_size) + 1, int(extent[1] // cell_size) + 1)
+
+        vx, vy = self.vertices[:, 0], self.vertices[:, 1]
+        self.vertex_grid = _Grid(lo, cell_size, shape, vx, vy, vx, vy)
+
+        self.pieces, self.piece_owner = self._split(self.segments, cell_size * PIECE_CELLS)
+        p = self.pieces
+        self.piece_grid = _Grid(lo, cell_size, shape, p[:, 0], p[:, 1], p[:, 2], p[:, 3])
+
+    @staticmethod
+    def _split(segments, max_length):
+        # A long wall would otherwise be listed in every cell of its bounding box
+        d = segments[:, 2:] - segments[:, :2]
+        n = np.maximum(1, np.ceil(np.hypot(d[:, 0], d[:, 1]) / max_length)).astype(np.int64)
+        owner = np.repeat(np.arange(len(segments)), n)
+        k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        t0 = (k / n[owner])[:, None]
+        t1 = ((k + 1) / n[owner])[:, None]
+        start = segments[owner, :2]
+        return np.hstack([start + d[owner] * t0, start + d[owner] * t1]), owner
+
+    def __len__(self):
+        return len(self.segments)
+
+    def near(self, x, y, radius):
+        """Indices of the segments in the grid cells within ``radius`` of ``(x, y)``."""
+        if self.piece_grid is None:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(self.piece_owner[self.piece_grid.query(x, y, radius)])
+
+    def snap(self, x, y, radius):
+        """Nearest vertex within ``radius``, else nearest point on an edge, else None.
+
+        Returns ``{'kind', 'point', 'distance', 'segment'}``.
+        """
+        if self.vertex_grid is None:
+            return None
+
+        candidates = self.vertex_grid.query(x, y, radius)
+        if len(candidates):
+            v = self.vertices[candidates]
+            dist = np.hypot(v[:, 0] - x, v[:, 1] - y)
+            best = int(np.argmin(dist))
+            if dist[best] <= radius:
+                return {'kind': 'vertex', 'point': v[best].tolist(), 'distance': float(dist[best]), 'segment': None}
+
+        candidates = self.piece_grid.query(x, y, radius)
+        if not len(candidates):
+            return None
+        p = self.pieces[candidates]
+        a, d = p[:, :2], p[:, 2:] - p[:, :2]
+        t = np.clip(((x - a[:, 0]) * d[:, 0] + (y - a[:, 1]) * d[:, 1]) / np.einsum('ij,ij->i', d, d), 0.0, 1.0)
+        proj = a + d * t[:, None]
+        dist = np.hypot(proj[:, 0] - x, proj[:, 1] - y)
+        best = int(np.argmin(dist))
+        if dist[best] > radius:
+            return None
+        segment = self.segments[self.piece_owner[candidates[best]]]
+        return {'kind': 'edge', 'point': proj[best].tolist(), 'distance': float(dist[best]),
+                'segment': segment.tolist()}
+
+
+class SnapIndexStore:
+    """Per-page segment indexes: in-memory LRU over ``.npz`` files on disk."""
+
+    def __init__(self, root, max_entries=16, documents=None):
+        self.root = root
+        self.max_entries = max_entries
+        self.documents = documents
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, doc_hash, page_num):
+        return os.path.join(self.root, doc_hash[:2], doc_hash, f"{page_num}.npz")
+
+    def has(self, doc_hash, page_num):
+        return os.path.exists(self.path(doc_hash, page_num))
+
+    def build(self, doc_hash, pdf_path, page_num):
+        """Extract and persist one page's segments (no-op if already on disk)."""
+        path = self.path(doc_hash, page_num)
+        if os.path.exists(path):
+            return
+        with open_document(pdf_path, self.documents) as doc:
+            segments = extract_segments(doc[page_num])
+        self._save(path, segments)
+        return segments
+
+    @staticmethod
+    def _save(path, segments):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, segments=segments)
+        os.replace(tmp_path, path)
+
+    def get(self, doc_hash, pdf_path, page_num):
+        key = (doc_hash, page_num)
+        with self._lock:
+            index = self._entries.get(key)
+            if index is not None:
+                self._entries.move_to_end(key)
+                return index
+
+        path = self.path(doc_hash, page_num)
+        segments = self.build(doc_hash, pdf_path, page_num)
+        if segments is None:
+            with np.load(path) as data:
+                segments = data['segments']
+        index = SegmentIndex(segments)
+
+        with self._lock:
+            self._entries[key] = index
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return index
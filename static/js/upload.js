@@ -0,0 +1,90 @@
+// Files are sent in chunks; an interrupted upload resumes where the server says it stopped
+const CHUNK_SIZE = Number(document.getElementById('upload-form').dataset.chunkSize);
+const form = document.getElementById('upload-form');
+const button = document.getElementById('upload-button');
+const progressBar = document.getElementById('upload-progress');
+const statusText = document.getElementById('upload-status');
+
+function sleep(ms) {
+  return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+async function postJson(url, body) {
+  const response = await fetch(url, {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify(body || {})
+  });
+  return response.json();
+}
+
+// Reuse the upload started for this exact file, if the server still has it
+async function startUpload(file, key) {
+  const saved = JSON.parse(localStorage.getItem(key) || 'null');
+  if (saved) {
+    const response = await fetch(saved.url);
+    if (response.ok) {
+      const status = await response.json();
+      return {url: saved.url, offset: status.offset};
+    }
+  }
+  const created = await postJson('/api/uploads', {filename: file.name, size: file.size});
+  if (!created.success) throw new Error(created.error);
+  localStorage.setItem(key, JSON.stringify({url: created.upload_url}));
+  return {url: created.upload_url, offset: created.offset};
+}
+
+async function sendChunks(file, upload) {
+  let offset = upload.offset;
+  let failures = 0;
+  while (offset < file.size) {
+    const end = Math.min(offset + CHUNK_SIZE, file.size);
+    progressBar.value = offset / file.size;
+    statusText.textContent = `Uploading... ${Math.round(offset / file.size * 100)}%`;
+    try {
+      const response = await fetch(upload.url, {
+        method: 'PUT',
+        headers: {'Content-Range': `bytes ${offset}-${end - 1}/${file.size}`},
+        body: file.slice(offset, end)
+      });
+      const result = await response.json();
+      if (response.ok) {
+        offset = result.offset;
+        failures = 0;
+      } else if (response.status === 409 && result.offset !== undefined) {
+        offset = result.offset;
+      } else {
+        throw new Error(result.error);
+      }
+    } catch (err) {
+      // Dropped connection: back off, then ask the server how much it kept
+      if (++failures > 5) throw err;
+      statusText.textContent = `Connection lost, retrying (${failures}/5)...`;
+      await sleep(1000 * 2 ** failures);
+      const response = await fetch(upload.url);
+      if (response.ok) offset = (await response.json()).offset;
+    }
+  }
+  progressBar.value = 1;
+}
+
+form.addEventListener('submit', async (event) => {
+  const file = document.getElementById('pdf_file').files[0];
+  if (!file || !window.fetch || !file.slice) return;  // plain form post
+  event.preventDefault();
+  button.disabled = true;
+  progressBar.style.display = 'block';
+  const key = `upload:${file.name}:${file.size}:${file.lastModified}`;
+  try {
+    const upload = await startUpload(file, key);
+    await sendChunks(file, upload);
+    statusText.textContent = 'Opening document...';
+    const result = await postJson(upload.url + '/complete');
+    if (!result.success) throw new Error(result.error);
+    localStorage.removeItem(key);
+    window.location.href = result.redirect;
+  } catch (err) {
+    statusText.textContent = `Upload failed: ${err.message}. Submit again to resume.`;
+    button.disabled = false;
+  }
+});
@@ -0,0 +1,1093 @@
+// Page data rendered into the page by the server
+const PAGE = JSON.parse(document.getElementById('page-config').textContent);
+
+// Global variables
+const canvas = document.getElementById('pdfCanvas');
+const ctx = canvas.getContext('2d');
+let points = [];
+let currentAction = null;
+let annotations = PAGE.annotations;
+// The page's scales: page-wide and per viewport, with their reference lines
+let scales = PAGE.scales;
+// Viewport drawn but not calibrated yet: {name, rect}
+let pendingViewport = null;
+// Last room found by one-click detection: {polygon, area, perimeter, ...}
+let detectedRoom = null;
+// Tools that take any number of clicks, finished with Enter
+const SHAPE_ACTIONS = {polyline: 2, polygon: 3};
+// Buttons that need a scale to measure with
+const MEASURE_BUTTONS = ['measure-btn', 'polyline-btn', 'polygon-btn'];
+
+// Tiled page rendering: the canvas only covers the visible part of the page.
+// A low-res preview of the whole page is drawn first, then the visible tiles on top.
+// Annotations and clicks are in PDF points; zoom is only a canvas transform.
+const container = document.getElementById('canvas-container');
+const spacer = document.getElementById('page-spacer');
+const docHash = PAGE.docHash;
+const totalPages = PAGE.totalPages;
+const tileSize = PAGE.tileSize;
+// Pages are switched in place, so these change with the page shown
+let pageNum = PAGE.pageNum;
+let pageWidthPt = PAGE.pageSize[0];
+let pageHeightPt = PAGE.pageSize[1];
+const MIN_ZOOM = 0.5;
+const MAX_ZOOM = 3.0;
+// Zoom levels tiles are rendered at; the view zoom picks the next one up
+const RENDER_ZOOMS = PAGE.renderZooms;
+const MAX_CACHED_TILES = 256;
+const tileCache = new Map();
+// States (annotations, geometry) and preview images of visited and prefetched pages
+const MAX_CACHED_PAGES = 32;
+const pageStates = new Map([[PAGE.pageNum, PAGE]]);
+const previewImages = new Map();
+let viewZoom = PAGE.zoomLevel;
+let previewImage = null;
+let viewX = 0;
+let viewY = 0;
+let redrawPending = false;
+// Preview Data Button Handler
+document.getElementById('preview-data-btn').addEventListener('click', async () => {
+  try {
+    const response = await fetch('/api/get_data_preview', {
+      method: 'GET',
+      headers: {'Content-Type': 'application/json'}
+    });
+    const result = await response.json();
+    
+    if (result.success) {
+      const tableBody = document.getElementById('data-table-body');
+      tableBody.innerHTML = ''; // Clear previous data
+      
+      result.data.forEach(row => {
+        const tr = document.createElement('tr');
+        row.forEach(cell => {
+          const td = document.createElement('td');
+          td.textContent = cell ?? '';
+          tr.appendChild(td);
+        });
+        tableBody.appendChild(tr);
+      });
+      
+      document.getElementById('data-preview-modal').style.display = 'block';
+    } else {
+      updateStatus('No data available');
+    }
+  } catch (error) {
+    console.error('Error previewing data:', error);
+    updateStatus('Error retrieving data');
+  }
+});
+
+// Close Preview Modal
+document.getElementById('close-preview-btn').addEventListener('click', () => {
+  document.getElementById('data-preview-modal').style.display = 'none';
+});
+
+// Zoom controls: re-draw with a new transform, keeping the viewport centre fixed.
+// The server is only told the preferred zoom for the next page load.
+function setZoom(newZoom) {
+  newZoom = Math.min(Math.max(newZoom, MIN_ZOOM), MAX_ZOOM);
+  if (newZoom === viewZoom) return;
+  const centreX = (viewX + canvas.width / 2) / viewZoom;
+  const centreY = (viewY + canvas.height / 2) / viewZoom;
+  viewZoom = newZoom;
+  layoutCanvas();
+  container.scrollLeft = centreX * viewZoom - canvas.width / 2 + spacer.offsetLeft;
+  container.scrollTop = centreY * viewZoom - canvas.height / 2 + spacer.offsetTop;
+  redrawCanvas();
+  updateStatus(`Zoom: ${viewZoom.toFixed(2)}`);
+  fetch('/api/adjust_zoom', {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify({ zoom: viewZoom })
+  }).catch(error => console.error('Error saving zoom level:', error));
+}
+
+document.getElementById('zoom-in-btn').addEventListener('click', () => setZoom(viewZoom * 1.2));
+document.getElementById('zoom-out-btn').addEventListener('click', () => setZoom(viewZoom / 1.2));
+
+// Undo button handler
+document.getElementById('undo-btn').addEventListener('click', async () => {
+   try {
+     const response = await fetch('/api/undo_annotation', {
+     method: 'POST',
+     headers: {'Content-Type': 'application/json'},
+     body: JSON.stringify({page_num: pageNum})
+    });
+     const result = await response.json();
+     if (result.success) {
+      updateStatus(result.message);
+      // Remove the undone annotation from local annotations array
+      const index = annotations.findIndex(a => a.id === result.removed_id);
+      if (index !== -1) {
+        annotations.splice(index, 1);
+      }
+      redrawCanvas();
+    } else {
+      updateStatus(result.message);
+    }
+  } catch (error) {
+    console.error('Undo error:', error);
+    updateStatus('Error undoing last annotation');
+  }
+});
+
+// Navigation buttons
+document.getElementById('prev-btn').addEventListener('click', () => showPage(pageNum - 1));
+document.getElementById('next-btn').addEventListener('click', () => showPage(pageNum + 1));
+window.addEventListener('popstate', (event) => {
+  if (event.state && event.state.page !== undefined) showPage(event.state.page, false);
+});
+
+// Button handlers
+document.getElementById('set-scale-btn').addEventListener('click', () => {
+  currentAction = 'setScale';
+  points = [];
+  pendingViewport = null;
+  updateStatus('Click two points on the image to set the scale.');
+});
+
+// A viewport is a part of the sheet (a detail) drawn at its own scale
+document.getElementById('viewport-btn').addEventListener('click', () => {
+  currentAction = 'viewport';
+  points = [];
+  pendingViewport = null;
+  updateStatus('Click two opposite corners of the viewport.');
+});
+
+// Room detection: every click finds the closed region of the drawing around it
+document.getElementById('detect-room-btn').addEventListener('click', () => {
+  currentAction = 'room';
+  points = [];
+  updateStatus('Click inside a room to detect it.');
+});
+
+async function detectRoom(x, y) {
+  updateStatus('Detecting room...');
+  try {
+    const response = await fetch('/api/detect_room', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'},
+      body: JSON.stringify({point: [x, y], page_num: pageNum})
+    });
+    const result = await response.json();
+    if (!result.success) {
+      updateStatus(result.error);
+      return;
+    }
+    detectedRoom = result.room;
+    updateStatus(detectedRoom && !document.getElementById('polygon-btn').disabled
+      ? `${result.message} Press Enter to measure it as a polygon.` : result.message);
+    redrawCanvas();
+  } catch (error) {
+    console.error('Room detection error:', error);
+    updateStatus('Error detecting room');
+  }
+}
+
+function showScales(result) {
+  scales = result.scales;
+  const state = pageStates.get(pageNum);
+  if (state) {
+    state.scales = result.scales;
+    state.hasScale = result.hasScale;
+  }
+  document.getElementById('reset-scale-btn').disabled = !result.hasScale;
+  setMeasureEnabled(result.hasScale);
+  redrawCanvas();
+}
+
+// Offer the scale found in the drawing's notes or scale bar, if any
+function showDetectedScale(state) {
+  const button = document.getElementById('detected-scale-btn');
+  button.hidden = !state.detectedScale;
+  if (state.detectedScale) button.textContent = `Use ${state.detectedScale.label}`;
+}
+
+document.getElementById('detected-scale-btn').addEventListener('click', async () => {
+  try {
+    const response = await fetch('/api/apply_detected_scale', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'},
+      body: JSON.stringify({page_num: pageNum})
+    });
+    const result = await response.json();
+    if (result.success) showScales(result);
+    updateStatus(result.success ? result.message : result.error);
+  } catch (error) {
+    console.error('Error applying detected scale:', error);
+  }
+});
+
+document.getElementById('reset-scale-btn').addEventListener('click', async () => {
+  if (confirm('Are you sure you want to reset the scale? This will not remove existing annotations.')) {
+    try {
+      const response = await fetch('/api/reset_scale', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({page_num: pageNum})
+      });
+      const result = await response.json();
+      if (result.success) {
+        updateStatus(result.message);
+        // Remove scale reference from display
+        annotations = annotations.filter(a => a.type !== 'scale_reference');
+        showScales(result);
+      }
+    } catch (error) {
+      console.error('Error resetting scale:', error);
+    }
+  }
+});
+
+document.getElementById('measure-btn').addEventListener('click', () => {
+  currentAction = 'measure';
+  points = [];
+  updateStatus('Click two points to create a measurement rectangle.');
+});
+
+// Polylines (wall runs) and polygons (floors) are one measurement however many corners they have
+for (const action of Object.keys(SHAPE_ACTIONS)) {
+  document.getElementById(`${action}-btn`).addEventListener('click', () => {
+    currentAction = action;
+    points = [];
+    detectedRoom = null;
+    redrawCanvas();
+    updateStatus(`Click the ${action}'s points, then press Enter. Backspace removes the last point.`);
+  });
+}
+
+function setMeasureEnabled(enabled) {
+  for (const id of MEASURE_BUTTONS) document.getElementById(id).disabled = !enabled;
+}
+
+// Length (and area, if closed) of a path in PDF points
+function pathMeasures(path, closed) {
+  let length = 0;
+  let area = 0;
+  const n = path.length;
+  for (let i = 0; i < n; i++) {
+    if (!closed && i === n - 1) break;
+    const [x1, y1] = path[i];
+    const [x2, y2] = path[(i + 1) % n];
+    length += Math.hypot(x2 - x1, y2 - y1);
+    area += x1 * y2 - x2 * y1;
+  }
+  return {length, area: closed ? Math.abs(area) / 2 : 0};
+}
+
+function finishShape() {
+  if (points.length < SHAPE_ACTIONS[currentAction]) {
+    updateStatus(`A ${currentAction} needs at least ${SHAPE_ACTIONS[currentAction]} points.`);
+    return;
+  }
+  const {length, area} = pathMeasures(points, currentAction === 'polygon');
+  document.getElementById('pixel-length-display').textContent = currentAction === 'polygon'
+    ? `${points.length} points: area ${area.toFixed(2)} pt², perimeter ${length.toFixed(2)} pt`
+    : `${points.length} points: length ${length.toFixed(2)} pt`;
+  document.getElementById('original-length-display').textContent = '';
+  showModal('measure-modal');
+}
+
+document.getElementById('clear-btn').addEventListener('click', async () => {
+  if (confirm('Clear all annotations on this page?')) {
+    try {
+      const response = await fetch('/api/clear_annotations', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({page_num: pageNum})
+      });
+      const result = await response.json();
+      if (result.success) {
+        updateStatus(result.message);
+        // Keep only scale reference in annotations
+        annotations = annotations.filter(a => a.type === 'scale_reference');
+        redrawCanvas();
+      }
+    } catch (error) {
+      console.error('Error clearing annotations:', error);
+    }
+  }
+});
+
+// Exports run as background jobs; poll the job until it is finished
+async function waitForJob(result, label, unit) {
+  const statusUrl = result.status_url;
+  while (result.success && result.state !== 'done') {
+    if (result.total) updateStatus(`${label}... (${result.done}/${result.total} ${unit})`);
+    await new Promise(resolve => setTimeout(resolve, 1000));
+    result = await (await fetch(statusUrl)).json();
+  }
+  return result;
+}
+
+document.getElementById('save-pdf-btn').addEventListener('click', async () => {
+  updateStatus('Saving PDF...');
+  try {
+    const response = await fetch('/api/save_pdf', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'}
+    });
+    const result = await waitForJob(await response.json(), 'Saving PDF', 'pages');
+    if (result.success) {
+      updateStatus('PDF saved. Downloading...');
+      // Trigger download
+      window.location.href = result.download_url;
+    } else {
+      updateStatus('Error saving PDF: ' + result.error);
+    }
+  } catch (error) {
+    console.error('Error saving PDF:', error);
+    updateStatus('Error saving PDF');
+  }
+});
+
+document.getElementById('save-excel-btn').addEventListener('click', async () => {
+  updateStatus('Exporting data to Excel...');
+  try {
+    const response = await fetch('/api/save_excel', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'}
+    });
+    const result = await waitForJob(await response.json(), 'Exporting data to Excel', 'rows');
+    if (result.success) {
+      updateStatus('Data exported. Downloading Excel file...');
+      // Trigger download
+      window.location.href = result.download_url;
+    } else {
+      updateStatus('Error exporting data: ' + (result.error || 'No data to export'));
+    }
+  } catch (error) {
+    console.error('Error exporting data:', error);
+    updateStatus('Error exporting data');
+  }
+});
+
+// Scale modal handlers
+document.getElementById('confirm-scale-btn').addEventListener('click', async () => {
+  const knownDistance = parseFloat(document.getElementById('known-distance').value);
+  if (isNaN(knownDistance) || knownDistance <= 0) {
+    alert('Please enter a valid distance');
+    return;
+  }
+  
+  try {
+    const response = await fetch('/api/set_scale', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'},
+      body: JSON.stringify({
+        page_num: pageNum,
+        points: points,
+        known_distance: knownDistance,
+        viewport: pendingViewport,
+        default: document.getElementById('scale-default').checked
+      })
+    });
+    const result = await response.json();
+    if (result.success) {
+      updateStatus(result.message);
+      
+      // The reference is drawn from the page's scales now
+      if (!pendingViewport) {
+        annotations = annotations.filter(a => a.type !== 'scale_reference');
+      }
+      
+      hideModal('scale-modal');
+      points = [];
+      pendingViewport = null;
+      currentAction = null;
+      showScales(result);
+    } else {
+      updateStatus(result.error);
+    }
+  } catch (error) {
+    console.error('Error setting scale:', error);
+  }
+});
+
+document.getElementById('cancel-scale-btn').addEventListener('click', () => {
+  hideModal('scale-modal');
+  points = [];
+  pendingViewport = null;
+  currentAction = null;
+  redrawCanvas();
+});
+
+// Function to categorize activity type
+function categorizeActivityType(type) {
+// Convert to lowercase for case-insensitive comparison
+const lowercaseType = type.toLowerCase();
+
+// Line-based activities
+const lineActivities = ['wall', 'door', 'window', 'panel'];
+
+// Area-based activities
+const areaActivities = ['floor', 'ceiling', 'pillar'];
+
+if (lineActivities.includes(lowercaseType)) {
+return 'line';
+} else if (areaActivities.includes(lowercaseType)) {
+return 'area';
+}
+
+// Default to area if not recognized
+return 'area';
+}
+
+// Modify the confirm measure button event listener
+document.getElementById('confirm-measure-btn').addEventListener('click', async () => {
+const rectType = document.getElementById('rect-type').value || 'Unknown';
+const rectName = document.getElementById('rect-name').value || `Item ${annotations.length + 1}`;
+
+// Categorize activity type
+const activityCategory = categorizeActivityType(rectType);
+
+try {
+const p1 = points[0];
+const p2 = points[1];
+const width = Math.abs(p2[0] - p1[0]);
+const height = Math.abs(p2[1] - p1[1]);
+const annotationType = currentAction in SHAPE_ACTIONS ? currentAction : 'square';
+
+const response = await fetch('/api/create_annotation', {
+  method: 'POST',
+  headers: {'Content-Type': 'application/json'},
+  body: JSON.stringify({
+    page_num: pageNum,
+    type: annotationType,
+    points: points,
+    label: `${rectName} (${rectType})`,
+    rect_type: rectType,
+    rect_name: rectName,
+    rect_height: activityCategory === 'area' ? height : 0,
+    parent_area: '',
+    replicas: 1,
+    unit: activityCategory === 'line' ? 'running meter' : 'square meter'
+  })
+});
+
+const result = await response.json();
+if (result.success) {
+  updateStatus(result.message);
+  
+  // Modify label to show the real-world measurements computed by the server
+  const [realWidth, realHeight] = result.dimensions;
+  let annotationLabel = `${rectName} (${rectType})`;
+  if (result.unit === 'RMT') {
+    annotationLabel += ` - Length: ${(realWidth.toFixed(2))} running meters`;
+  } else if (annotationType === 'polygon') {
+    annotationLabel += ` - Area: ${(realWidth.toFixed(2))} square meters`;
+  } else {
+    annotationLabel += ` - ${(realWidth.toFixed(2))} x ${(realHeight.toFixed(2))} square meters`;
+  }
+  
+  // Add annotation locally
+  annotations.push({
+    id: result.id,
+    type: annotationType,
+    points: result.points,
+    label: annotationLabel
+  });
+  
+  hideModal('measure-modal');
+  points = [];
+  currentAction = null;
+  detectedRoom = null;
+  redrawCanvas();
+}
+} catch (error) {
+console.error('Error creating annotation:', error);
+updateStatus('Error creating annotation');
+}
+});
+
+// Modify the measurements preview to show different info based on activity type
+document.getElementById('confirm-measure-btn').addEventListener('click', () => {
+if (currentAction !== 'measure') return;
+const rectType = document.getElementById('rect-type').value || 'Unknown';
+const activityCategory = categorizeActivityType(rectType);
+
+const p1 = points[0];
+const p2 = points[1];
+const width = Math.abs(p2[0] - p1[0]);
+const height = Math.abs(p2[1] - p1[1]);
+
+const pixelLengthDisplay = document.getElementById('pixel-length-display');
+const originalLengthDisplay = document.getElementById('original-length-display');
+
+if (activityCategory === 'line') {
+// For line, show total length
+const length = Math.sqrt(width * width + height * height);
+pixelLengthDisplay.textContent = `Total Length: ${length.toFixed(2)} pt`;
+originalLengthDisplay.textContent = 'Length will be in running meters';
+} else {
+// For area, show width and height
+pixelLengthDisplay.textContent = `Dimensions: ${width.toFixed(2)} x ${height.toFixed(2)} pt`;
+originalLengthDisplay.textContent = 'Dimensions will be in square meters';
+}
+});
+
+document.getElementById('cancel-measure-btn').addEventListener('click', () => {
+  hideModal('measure-modal');
+  points = [];
+  currentAction = null;
+  redrawCanvas();
+});
+
+// Snap a point to the nearest drawing vertex/edge within 10 screen pixels
+async function snapPoint(x, y) {
+  try {
+    const params = new URLSearchParams({page_num: pageNum, x: x, y: y, radius: px(10)});
+    const response = await fetch(`/api/snap?${params}`);
+    const result = await response.json();
+    return result.success ? result.snap : null;
+  } catch (error) {
+    console.error('Snap error:', error);
+    return null;
+  }
+}
+
+// Update canvas click handler
+canvas.addEventListener('click', async (event) => {
+  if (!currentAction) return;
+  
+  // Canvas position plus scroll offset, divided by zoom, gives PDF points
+  const rect = canvas.getBoundingClientRect();
+  let x = (event.clientX - rect.left + viewX) / viewZoom;
+  let y = (event.clientY - rect.top + viewY) / viewZoom;
+  
+  if (currentAction === 'room') {
+    detectRoom(x, y);
+    return;
+  }
+  
+  if (document.getElementById('snap-toggle').checked) {
+    const snap = await snapPoint(x, y);
+    if (snap) {
+      [x, y] = snap.point;
+      updateStatus(`Snapped to ${snap.kind}.`);
+    }
+  }
+  
+  // Add point
+  points.push([x, y]);
+  
+  if (currentAction in SHAPE_ACTIONS) {
+    redrawCanvas();
+    return;
+  }
+  
+  // Draw point marker
+  ctx.beginPath();
+  ctx.arc(x, y, px(5), 0, 2 * Math.PI);
+  ctx.fillStyle = 'orange';
+  ctx.fill();
+  
+  if (points.length === 2) {
+    // Two points collected, proceed based on current action
+    if (currentAction === 'viewport') {
+      const name = prompt('Name of this viewport (e.g. Detail A):');
+      const [p1, p2] = points;
+      points = [];
+      if (!name) {
+        currentAction = null;
+        updateStatus('Viewport cancelled.');
+      } else {
+        pendingViewport = {name: name, rect: [p1[0], p1[1], p2[0], p2[1]]};
+        currentAction = 'setScale';
+        updateStatus(`Click two points of a known distance inside ${name}.`);
+      }
+      redrawCanvas();
+    } else if (currentAction === 'setScale') {
+      document.getElementById('scale-default').checked = false;
+      document.getElementById('scale-default').disabled = pendingViewport !== null;
+      showModal('scale-modal');
+    } else if (currentAction === 'measure') {
+      // Show measure modal and pre-populate dimensions
+      const p1 = points[0];
+      const p2 = points[1];
+      const width = Math.abs(p2[0] - p1[0]);
+      const height = Math.abs(p2[1] - p1[1]);
+      
+      // Update modal display
+      document.getElementById('pixel-length-display').textContent = 
+        `Dimensions: ${width.toFixed(2)} x ${height.toFixed(2)} pt`;
+      
+      showModal('measure-modal');
+    }
+  }
+});
+
+// Helper functions
+function updateStatus(message) {
+  document.getElementById('status-bar').textContent = message;
+}
+
+function showModal(modalId) {
+  document.getElementById(modalId).style.display = 'block';
+}
+
+function hideModal(modalId) {
+  document.getElementById(modalId).style.display = 'none';
+}
+
+// Screen pixels -> PDF points at the current zoom (line widths, fonts, markers)
+function px(n) {
+  return n / viewZoom;
+}
+
+function layoutCanvas() {
+  const pageWidth = Math.ceil(pageWidthPt * viewZoom);
+  const pageHeight = Math.ceil(pageHeightPt * viewZoom);
+  spacer.style.width = pageWidth + 'px';
+  spacer.style.height = pageHeight + 'px';
+  viewX = Math.max(0, Math.min(container.scrollLeft - spacer.offsetLeft, pageWidth - 1));
+  viewY = Math.max(0, Math.min(container.scrollTop - spacer.offsetTop, pageHeight - 1));
+  const width = Math.max(1, Math.min(container.clientWidth, pageWidth - viewX));
+  const height = Math.max(1, Math.min(container.clientHeight, pageHeight - viewY));
+  if (canvas.width !== width || canvas.height !== height) {
+    canvas.width = width;
+    canvas.height = height;
+  }
+  canvas.style.left = viewX + 'px';
+  canvas.style.top = viewY + 'px';
+}
+
+function renderZoomFor(zoom) {
+  return RENDER_ZOOMS.find(z => z >= zoom - 1e-6) || RENDER_ZOOMS[RENDER_ZOOMS.length - 1];
+}
+
+function tileUrl(page, zoom, tx, ty) {
+  return `/tile/${docHash}/${page}/${zoom.toFixed(4)}/${tx}/${ty}`;
+}
+
+// Tiles of a render zoom that intersect the viewport, nearest to its centre
+// first so they arrive progressively
+function visibleTiles(zoom) {
+  const ratio = zoom / viewZoom;
+  const maxX = Math.ceil(pageWidthPt * zoom / tileSize) - 1;
+  const maxY = Math.ceil(pageHeightPt * zoom / tileSize) - 1;
+  const x0 = Math.max(0, Math.floor(viewX * ratio / tileSize));
+  const y0 = Math.max(0, Math.floor(viewY * ratio / tileSize));
+  const x1 = Math.min(maxX, Math.floor((viewX + canvas.width - 1) * ratio / tileSize));
+  const y1 = Math.min(maxY, Math.floor((viewY + canvas.height - 1) * ratio / tileSize));
+  const cx = (viewX + canvas.width / 2) * ratio;
+  const cy = (viewY + canvas.height / 2) * ratio;
+  const tiles = [];
+  for (let ty = y0; ty <= y1; ty++) {
+    for (let tx = x0; tx <= x1; tx++) {
+      const dx = (tx + 0.5) * tileSize - cx;
+      const dy = (ty + 0.5) * tileSize - cy;
+      tiles.push({tx, ty, distance: dx * dx + dy * dy});
+    }
+  }
+  return tiles.sort((a, b) => a.distance - b.distance);
+}
+
+function cachedTile(zoom, tx, ty) {
+  const tile = tileCache.get(`${pageNum}/${zoom}/${tx}/${ty}`);
+  return tile && tile.complete && tile.naturalWidth ? tile : null;
+}
+
+function requestTile(zoom, tx, ty, page = pageNum) {
+  const key = `${page}/${zoom}/${tx}/${ty}`;
+  let tile = tileCache.get(key);
+  if (tile) {
+    // Keep the Map in LRU order
+    tileCache.delete(key);
+    tileCache.set(key, tile);
+    return tile;
+  }
+  tile = new Image();
+  tile.onload = scheduleRedraw;
+  tile.src = tileUrl(page, zoom, tx, ty);
+  tileCache.set(key, tile);
+  while (tileCache.size > MAX_CACHED_TILES) {
+    tileCache.delete(tileCache.keys().next().value);
+  }
+  return tile;
+}
+
+function drawTile(tile, zoom, tx, ty) {
+  const step = tileSize / zoom;
+  ctx.drawImage(tile, tx * step, ty * step, tile.naturalWidth / zoom, tile.naturalHeight / zoom);
+}
+
+function drawPage() {
+  ctx.fillStyle = 'white';
+  ctx.fillRect(0, 0, pageWidthPt, pageHeightPt);
+  if (previewImage && previewImage.complete && previewImage.naturalWidth) {
+    ctx.drawImage(previewImage, 0, 0, pageWidthPt, pageHeightPt);
+  }
+  // While the tiles for this zoom load, stretch whatever other levels are cached
+  const target = renderZoomFor(viewZoom);
+  for (const zoom of RENDER_ZOOMS) {
+    if (zoom === target) continue;
+    for (const {tx, ty} of visibleTiles(zoom)) {
+      const tile = cachedTile(zoom, tx, ty);
+      if (tile) drawTile(tile, zoom, tx, ty);
+    }
+  }
+  for (const {tx, ty} of visibleTiles(target)) {
+    const tile = requestTile(target, tx, ty);
+    if (tile.complete && tile.naturalWidth) drawTile(tile, target, tx, ty);
+  }
+}
+
+function scheduleRedraw() {
+  if (redrawPending) return;
+  redrawPending = true;
+  requestAnimationFrame(() => {
+    redrawPending = false;
+    redrawCanvas();
+  });
+}
+
+function redrawCanvas() {
+  // Clear canvas and redraw the visible part of the page
+  layoutCanvas();
+  ctx.setTransform(1, 0, 0, 1, 0, 0);
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+  // Everything below is drawn in PDF points
+  ctx.setTransform(viewZoom, 0, 0, viewZoom, -viewX, -viewY);
+  drawPage();
+  
+  // Viewports and scale references
+  for (const scale of scales) {
+    if (scale.rect) drawViewport(scale.rect, scale.name);
+    if (scale.reference && scale.reference.points) {
+      drawScaleLine(scale.reference.points, scale.reference.label);
+    }
+  }
+  if (pendingViewport) drawViewport(pendingViewport.rect, pendingViewport.name);
+  if (detectedRoom) drawRoom(detectedRoom.polygon);
+  
+  // Draw all annotations
+  for (const anno of annotations) {
+    if (anno.type === 'line') {
+      drawLine(anno.points, anno.label);
+    } else if (anno.type === 'square') {
+      drawRect(anno.points, anno.label);
+    } else if (anno.type === 'polyline' || anno.type === 'polygon') {
+      drawShape(anno.points, anno.label, anno.type === 'polygon');
+    } else if (anno.type === 'scale_reference') {
+      drawScaleLine(anno.points, anno.label);
+    }
+  }
+  
+  // Draw current points if any, joined up while a shape is being drawn
+  if (currentAction in SHAPE_ACTIONS && points.length > 1) {
+    ctx.beginPath();
+    points.forEach(([x, y], i) => i ? ctx.lineTo(x, y) : ctx.moveTo(x, y));
+    ctx.strokeStyle = 'orange';
+    ctx.lineWidth = px(2);
+    ctx.stroke();
+  }
+  for (const point of points) {
+    ctx.beginPath();
+    ctx.arc(point[0], point[1], px(5), 0, 2 * Math.PI);
+    ctx.fillStyle = 'orange';
+    ctx.fill();
+  }
+}
+
+function drawLine(points, label) {
+  if (points.length !== 2) return;
+  
+  const [start, end] = points;
+  
+  // Draw line
+  ctx.beginPath();
+  ctx.moveTo(start[0], start[1]);
+  ctx.lineTo(end[0], end[1]);
+  ctx.strokeStyle = 'red';
+  ctx.lineWidth = px(2);
+  ctx.stroke();
+  
+  // Draw label
+  if (label) {
+    ctx.font = `${px(12)}px Arial`;
+    ctx.fillStyle = 'blue';
+    ctx.fillText(label, start[0], start[1] - px(5));
+  }
+}
+
+function drawScaleLine(points, label) {
+  if (points.length !== 2) return;
+  
+  const [start, end] = points;
+  
+  // Draw dashed line
+  ctx.beginPath();
+  ctx.setLineDash([px(5), px(3)]);
+  ctx.moveTo(start[0], start[1]);
+  ctx.lineTo(end[0], end[1]);
+  ctx.strokeStyle = 'purple';
+  ctx.lineWidth = px(2);
+  ctx.stroke();
+  ctx.setLineDash([]);
+  
+  // Draw endpoints
+  ctx.beginPath();
+  ctx.arc(start[0], start[1], px(4), 0, 2 * Math.PI);
+  ctx.arc(end[0], end[1], px(4), 0, 2 * Math.PI);
+  ctx.fillStyle = 'purple';
+  ctx.fill();
+  
+  // Draw label
+  if (label) {
+    ctx.font = `${px(12)}px Arial`;
+    ctx.fillStyle = 'purple';
+    ctx.fillText(label, (start[0] + end[0]) / 2, (start[1] + end[1]) / 2 - px(8));
+  }
+}
+
+function drawShape(points, label, closed) {
+  if (points.length < 2) return;
+  
+  ctx.beginPath();
+  points.forEach(([x, y], i) => i ? ctx.lineTo(x, y) : ctx.moveTo(x, y));
+  if (closed) ctx.closePath();
+  ctx.strokeStyle = closed ? 'green' : 'red';
+  ctx.lineWidth = px(2);
+  ctx.stroke();
+  
+  // Draw label
+  if (label) {
+    ctx.font = `${px(12)}px Arial`;
+    ctx.fillStyle = 'blue';
+    ctx.fillText(label, points[0][0], points[0][1] - px(5));
+  }
+}
+
+function drawRoom(polygon) {
+  ctx.beginPath();
+  polygon.forEach(([x, y], i) => i ? ctx.lineTo(x, y) : ctx.moveTo(x, y));
+  ctx.closePath();
+  ctx.fillStyle = 'rgba(0, 128, 255, 0.2)';
+  ctx.fill();
+  ctx.strokeStyle = 'rgb(0, 128, 255)';
+  ctx.lineWidth = px(2);
+  ctx.stroke();
+}
+
+function drawViewport(rect, name) {
+  const x = Math.min(rect[0], rect[2]);
+  const y = Math.min(rect[1], rect[3]);
+  ctx.beginPath();
+  ctx.setLineDash([px(8), px(4)]);
+  ctx.rect(x, y, Math.abs(rect[2] - rect[0]), Math.abs(rect[3] - rect[1]));
+  ctx.strokeStyle = 'purple';
+  ctx.lineWidth = px(1);
+  ctx.stroke();
+  ctx.setLineDash([]);
+  ctx.font = `${px(12)}px Arial`;
+  ctx.fillStyle = 'purple';
+  ctx.fillText(name, x + px(4), y + px(14));
+}
+
+function drawRect(points, label) {
+  if (points.length !== 2) return;
+  
+  const [p1, p2] = points;
+  
+  // Calculate dimensions
+  const x = Math.min(p1[0], p2[0]);
+  const y = Math.min(p1[1], p2[1]);
+  const width = Math.abs(p2[0] - p1[0]);
+  const height = Math.abs(p2[1] - p1[1]);
+  
+  // Draw rectangle
+  ctx.beginPath();
+  ctx.rect(x, y, width, height);
+  ctx.strokeStyle = 'green';
+  ctx.lineWidth = px(2);
+  ctx.stroke();
+  
+  // Draw label
+  if (label) {
+    ctx.font = `${px(12)}px Arial`;
+    ctx.fillStyle = 'blue';
+    ctx.fillText(label, x, y - px(5));
+  }
+}
+
+// Load page image: low-res preview first, tiles follow as they come into view
+function loadPageImage() {
+  previewImage = previewFor(PAGE);
+  container.addEventListener('scroll', scheduleRedraw);
+  window.addEventListener('resize', scheduleRedraw);
+  history.replaceState({page: pageNum}, '', PAGE.url);
+  showDetectedScale(PAGE);
+  redrawCanvas();
+  updateStatus("Page loaded. Ready for annotations.");
+  whenIdle(prefetchAdjacent);
+}
+
+function previewFor(state) {
+  let image = previewImages.get(state.pageNum);
+  if (!image) {
+    image = new Image();
+    image.onload = () => { if (state.pageNum === pageNum) scheduleRedraw(); };
+    image.src = state.previewUrl;
+    previewImages.set(state.pageNum, image);
+  }
+  return image;
+}
+
+async function fetchPageState(page, prefetch) {
+  const response = await fetch(`/api/page_state/${page}${prefetch ? '?prefetch=1' : ''}`);
+  const result = await response.json();
+  if (!result.success) throw new Error(result.error);
+  pageStates.set(result.pageNum, result);
+  while (pageStates.size > MAX_CACHED_PAGES) {
+    const oldest = pageStates.keys().next().value;
+    pageStates.delete(oldest);
+    previewImages.delete(oldest);
+  }
+  return result;
+}
+
+// Switch pages in place. A prefetched page is drawn straight away; the server
+// is told in the background, for reloads. Edits don't wait for that: every
+// mutating request names the page it is for.
+async function showPage(page, pushHistory = true) {
+  if (page < 0 || page >= totalPages || page === pageNum) return;
+  const cached = pageStates.get(page);
+  if (cached) {
+    // Most recently used last
+    pageStates.delete(page);
+    pageStates.set(page, cached);
+  }
+  const visit = fetchPageState(page, false);
+  let state = cached;
+  if (!state) {
+    updateStatus(`Loading page ${page + 1}...`);
+    try {
+      state = await visit;
+    } catch (error) {
+      console.error('Error loading page:', error);
+      updateStatus('Error loading page');
+      return;
+    }
+  } else {
+    visit.catch(error => console.error('Error switching page:', error));
+  }
+
+  // Keep this page's annotations (they may have changed) for coming back
+  const leaving = pageStates.get(pageNum);
+  if (leaving) {
+    leaving.annotations = annotations;
+    leaving.scales = scales;
+  }
+  pageNum = state.pageNum;
+  pageWidthPt = state.pageSize[0];
+  pageHeightPt = state.pageSize[1];
+  annotations = state.annotations;
+  scales = state.scales;
+  previewImage = previewFor(state);
+  points = [];
+  currentAction = null;
+  pendingViewport = null;
+  detectedRoom = null;
+
+  document.title = `PDF Measurement Annotation - Page ${pageNum + 1}`;
+  document.getElementById('page-label').textContent = `Page ${pageNum + 1} of ${totalPages}`;
+  document.getElementById('prev-btn').disabled = pageNum === 0;
+  document.getElementById('next-btn').disabled = pageNum === totalPages - 1;
+  document.getElementById('reset-scale-btn').disabled = !state.hasScale;
+  setMeasureEnabled(state.hasScale);
+  showDetectedScale(state);
+  if (pushHistory) history.pushState({page: pageNum}, '', state.url);
+
+  layoutCanvas();
+  container.scrollLeft = 0;
+  container.scrollTop = 0;
+  redrawCanvas();
+  updateStatus(`Page ${pageNum + 1} of ${totalPages}.`);
+  whenIdle(prefetchAdjacent);
+}
+
+function whenIdle(callback) {
+  if (window.requestIdleCallback) {
+    requestIdleCallback(callback, {timeout: 2000});
+  } else {
+    setTimeout(callback, 200);
+  }
+}
+
+// Fetch the neighbouring pages' state, preview and first screen of tiles
+async function prefetchAdjacent() {
+  const current = pageNum;
+  for (const page of [current + 1, current - 1]) {
+    if (page < 0 || page >= totalPages || current !== pageNum) continue;
+    try {
+      const state = pageStates.get(page) || await fetchPageState(page, true);
+      previewFor(state);
+      const zoom = renderZoomFor(viewZoom);
+      const ratio = zoom / viewZoom;
+      const maxX = Math.min(Math.ceil(state.pageSize[0] * zoom / tileSize),
+                            Math.ceil(container.clientWidth * ratio / tileSize)) - 1;
+      const maxY = Math.min(Math.ceil(state.pageSize[1] * zoom / tileSize),
+                            Math.ceil(container.clientHeight * ratio / tileSize)) - 1;
+      for (let ty = 0; ty <= maxY; ty++) {
+        for (let tx = 0; tx <= maxX; tx++) {
+          requestTile(zoom, tx, ty, page);
+        }
+      }
+    } catch (error) {
+      console.error(`Error prefetching page ${page + 1}:`, error);
+    }
+  }
+}
+
+// Keyboard shortcuts
+document.addEventListener('keydown', (event) => {
+  const typing = event.target.tagName === 'INPUT';
+  if (event.key === 'Enter' && !typing) {
+    // Finish the shape being drawn, or measure the detected room as a polygon
+    if (currentAction === 'room' && detectedRoom && !document.getElementById('polygon-btn').disabled) {
+      currentAction = 'polygon';
+      points = detectedRoom.polygon.map(point => [...point]);
+    }
+    if (currentAction in SHAPE_ACTIONS) finishShape();
+  } else if (event.key === 'Backspace' && !typing && currentAction in SHAPE_ACTIONS && points.length) {
+    event.preventDefault();
+    points.pop();
+    redrawCanvas();
+  } else if (event.key === 'Escape') {
+    // Cancel current action
+    if (currentAction) {
+      currentAction = null;
+      points = [];
+      pendingViewport = null;
+      detectedRoom = null;
+      redrawCanvas();
+      updateStatus('Action cancelled.');
+    }
+    // Close any open modal
+    hideModal('scale-modal');
+    hideModal('measure-modal');
+  }
+});
+
+// Show how many pages are pre-rendered until all of them are
+async function pollPrerenderStatus() {
+  try {
+    const response = await fetch('/api/prerender/status');
+    const result = await response.json();
+    if (!result.success) return;
+    const ready = result.ready.length;
+    const label = document.getElementById('prerender-status');
+    label.textContent = ready < result.total ? `(${ready}/${result.total} pages ready)` : '';
+    if (ready < result.total && (result.pending > 0 || result.running.length > 0)) {
+      setTimeout(pollPrerenderStatus, 2000);
+    }
+  } catch (error) {
+    console.error('Error fetching pre-render status:', error);
+  }
+}
+
+// Initialize
+loadPageImage();
+pollPrerenderStatus();
@@ -0,0 +1,75 @@
+import importlib
+import os
+import sys
+
+import fitz  # PyMuPDF
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_pdf(path, pages=1, width=1200, height=800, lines=(), rotation=0, text=()):
+    """Write a PDF with ``lines`` ((x0, y0, x1, y1) in unrotated page points)
+    and ``text`` ((x, y, string)) drawn on every page."""
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page(width=width, height=height)
+        if lines:
+            shape = page.new_shape()
+            for x0, y0, x1, y1 in lines:
+                shape.draw_line((x0, y0), (x1, y1))
+            shape.finish(color=(0, 0, 0), width=1)
+            shape.commit()
+        for x, y, string in text:
+            page.insert_text((x, y), string, fontsize=10)
+        page.set_rotation(rotation)
+    doc.save(path)
+    doc.close()
+    return path
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """The Flask app, with its uploads, caches and databases in a temp directory."""
+    root = tmp_path_factory.mktemp('app')
+    # Absolute, since background threads may still use them after the session
+    paths = {
+        'RENDER_CACHE_DIR': 'cache/renders', 'GEOMETRY_DIR': 'cache/geometry', 'SNAP_DIR': 'cache/snap',
+        'EXPORT_DIR': 'cache/exports', 'OCR_DIR': 'cache/ocr', 'JOB_STORE_PATH': 'data/jobs.db',
+        'ARTIFACT_STORE_PATH': 'data/artifacts.db',
+    }
+    for name, path in paths.items():
+        os.environ[name] = str(root / path)
+    os.makedirs(root / 'data')
+    os.environ['PROJECT_STORE_URL'] = f"sqlite:///{root / 'data' / 'projects.db'}"
+    for name in ('PRERENDER_WORKERS', 'EXPORT_WORKERS', 'SCALE_DETECTION_WORKERS', 'OCR_WORKERS'):
+        os.environ[name] = '1'
+    cwd = os.getcwd()
+    # Uploads go to a folder relative to the working directory
+    os.chdir(root)
+    module = importlib.import_module('app2upgrade')
+    yield module
+    module.prerender_pool.shutdown()
+    module.jobs.shutdown()
+    module.scale_detector.shutdown()
+    module.ocr_engine.shutdown()
+    module.pdf_exporter.shutdown()
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def upload(client, tmp_path):
+    """Upload a PDF through the home page; returns the new project's ID."""
+    def upload(path):
+        with open(path, 'rb') as f:
+            response = client.post('/', data={'pdf_file': (f, os.path.basename(path))},
+                                   content_type='multipart/form-data')
+        assert response.status_code == 302
+        with client.session_transaction() as sess:
+            return sess['project_id']
+    return upload
@@ -0,0 +1,56 @@
+import time
+
+from conftest import make_pdf
+
+
+def wait_for(check, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        value = check()
+        if value:
+            return value
+        time.sleep(0.05)
+    raise AssertionError("Timed out")
+
+
+def detected_scales(app_module, project):
+    geometry = app_module.geometry_store.get(project['content_hash'], project['pdf_path'])
+    return [geometry.page(page_num).get('detected_scale') for page_num in range(len(geometry))]
+
+
+def test_scans_are_ocrd_once_the_engine_is_there(app_module, upload, tmp_path, monkeypatch):
+    # No text layer on either page: both are scans
+    path = make_pdf(tmp_path / 'scan.pdf', pages=2, width=1111, lines=[(100, 100, 500, 100)])
+    engine = app_module.ocr_engine
+    monkeypatch.setattr(engine, 'available', lambda: False)
+    project = app_module.project_store.get_project(upload(path))
+    first = wait_for(lambda: all(detected_scales(app_module, project)) and detected_scales(app_module, project))
+    assert [(result['has_text'], result['ocr']) for result in first] == [(False, False), (False, False)]
+
+    # The engine turns up (after a restart, say); opening the document again OCRs the scans
+    ocr_runs = []
+
+    def run(pdf_path, page_nums, progress=None):
+        ocr_runs.append(list(page_nums))
+        scale = {'scale': 0.01, 'ratio': 100, 'source': 'ocr', 'label': '1:100', 'confidence': 0.8}
+        return {page_num: {'scale': scale} for page_num in page_nums if page_num == 0}
+    monkeypatch.setattr(engine, 'available', lambda: True)
+    monkeypatch.setattr(engine, 'run', run)
+    upload(path)
+    second = wait_for(lambda: detected_scales(app_module, project)[0]['ocr'] and detected_scales(app_module, project))
+    assert ocr_runs == [[0, 1]]
+    assert second[0]['scale'] == 0.01 and second[0]['has_text'] is False
+    # OCR failed on page 1, so it's tried again next time; page 0 isn't
+    assert second[1]['ocr'] is False
+    geometry = app_module.geometry_store.get(project['content_hash'], project['pdf_path'])
+    job_id = app_module.detect_scales(project, geometry)
+    wait_for(lambda: app_module.jobs.get(job_id)['state'] == 'done')
+    assert ocr_runs == [[0, 1], [1]]
+
+
+def test_detected_documents_are_left_alone(app_module, upload, tmp_path):
+    path = make_pdf(tmp_path / 'text.pdf', width=1113, text=[(100, 100, 'SCALE 1:100')])
+    project = app_module.project_store.get_project(upload(path))
+    wait_for(lambda: all(detected_scales(app_module, project)))
+    geometry = app_module.geometry_store.get(project['content_hash'], project['pdf_path'])
+    assert app_module.detect_scales(project, geometry) is None
@@ -0,0 +1,67 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import jobs
+from jobs import JobManager
+
+
+@pytest.fixture
+def sleeper():
+    process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+    yield process
+    process.kill()
+    process.wait()
+
+
+def set_process(path, job_id, pid, token):
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE jobs SET pid = ?, process_token = ? WHERE id = ?", (pid, token, job_id))
+
+
+def test_jobs_of_an_earlier_process_with_our_pid_are_interrupted(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    current = JobManager(path).track('prerender', 'doc')
+    earlier = JobManager(path).track('prerender', 'doc')
+    # A restarted container hands this process the pid of the one that wrote the row
+    set_process(path, earlier, os.getpid(), 'earlier-run')
+
+    manager = JobManager(path)
+    assert manager.get(current)['state'] == 'running'
+    assert manager.get(earlier)['state'] == 'failed' and manager.get(earlier)['error'] == 'Interrupted'
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/stat'), reason="needs /proc to tell runs of a pid apart")
+def test_reused_pid_of_another_process_is_not_tracking(tmp_path, sleeper):
+    path = str(tmp_path / 'jobs.db')
+    manager = JobManager(path)
+    live = manager.track('prerender', 'live')
+    reused = manager.track('prerender', 'reused')
+    set_process(path, live, sleeper.pid, jobs._process_token(sleeper.pid))
+    set_process(path, reused, sleeper.pid, 'earlier-run')
+    assert manager.tracked_elsewhere('prerender', 'live') == live
+    assert manager.tracked_elsewhere('prerender', 'reused') is None
+
+    manager = JobManager(path)
+    assert manager.get(live)['state'] == 'running'
+    assert manager.get(reused)['state'] == 'failed'
+
+
+def test_table_without_process_tokens_is_migrated(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "CREATE TABLE jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, lane TEXT NOT NULL, project_id TEXT, "
+            "job_key TEXT, state TEXT NOT NULL, done INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0, "
+            "result TEXT, error TEXT, cancel_requested INTEGER NOT NULL DEFAULT 0, pid INTEGER, "
+            "created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+        )
+        conn.execute("INSERT INTO jobs (id, kind, lane, state, pid, created_at) "
+                     "VALUES ('old', 'pdf_export', 'bulk', 'running', ?, 0)", (os.getpid(),))
+    manager = JobManager(path)
+    # Written before tokens existed, so by an earlier run of this pid
+    assert manager.get('old')['state'] == 'failed'
+    assert manager.get(manager.track('prerender', 'doc'))['process_token'] == jobs.PROCESS_TOKEN
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from excel_export import quantity
+from measurements import (AREA_UNIT, LINE_UNIT, measure_annotations, row_dimensions, shape_array,
+                          shape_measures)
+
+# An L: a 400 x 300 block on top of a 1000 x 300 one
+L_SHAPE = [[100, 100], [500, 100], [500, 400], [1100, 400], [1100, 700], [100, 700]]
+
+
+def test_polygon_area_and_perimeter():
+    lengths, areas = shape_measures([np.array(L_SHAPE, dtype=float)], np.array([True]))
+    assert areas[0] == pytest.approx(400 * 300 + 1000 * 300)
+    assert lengths[0] == pytest.approx(2 * (1000 + 600))
+
+
+def test_polygon_area_ignores_winding_order():
+    square = [[0, 0], [10, 0], [10, 10], [0, 10]]
+    _, areas = shape_measures([np.array(square, float), np.array(square[::-1], float)], np.array([True, True]))
+    assert areas.tolist() == [100.0, 100.0]
+
+
+def test_polyline_is_open():
+    lengths, areas = shape_measures([np.array([[0, 0], [3, 4], [3, 10]], float)], np.array([False]))
+    assert lengths[0] == pytest.approx(11.0)
+    assert areas[0] == 0.0
+
+
+def test_mixed_batch():
+    shapes = [np.array([[0, 0], [4, 0], [4, 3]], float), np.array([[0, 0], [3, 4]], float),
+              np.array(L_SHAPE, float)]
+    lengths, areas = shape_measures(shapes, np.array([True, False, True]))
+    assert lengths.tolist() == pytest.approx([12.0, 5.0, 3200.0])
+    assert areas.tolist() == pytest.approx([6.0, 0.0, 420000.0])
+
+
+@pytest.mark.parametrize('annotation_type, points', [
+    ('polygon', [[0, 0], [1, 1]]),
+    ('polyline', [[0, 0]]),
+    ('polygon', []),
+    ('polygon', [[0, 0], [1, 1], [2]]),
+    ('polyline', [[0, 0], [1, float('nan')]]),
+    ('polyline', 'abc'),
+])
+def test_degenerate_shapes_are_rejected(annotation_type, points):
+    with pytest.raises(ValueError):
+        shape_array(points, annotation_type)
+
+
+def test_shape_points_are_rounded():
+    assert shape_array([[0.123456, 1], [2, 3.999]], 'polyline').tolist() == [[0.12, 1.0], [2.0, 4.0]]
+
+
+def test_collinear_polygon_has_no_area():
+    lengths, areas = shape_measures([np.array([[0, 0], [5, 0], [10, 0]], float)], np.array([True]))
+    assert areas[0] == 0.0
+    assert lengths[0] == pytest.approx(20.0)
+
+
+def test_scale_applies_to_lengths_and_squared_to_areas():
+    types = ['polygon', 'polyline', 'polygon', 'square']
+    points = [L_SHAPE, [[0, 0], [3, 4]], L_SHAPE, [[0, 0], [10, 20]]]
+    # The third polygon is a wall run: its perimeter is a running length
+    line_mask = [False, False, True, False]
+    widths, heights, units = measure_annotations(types, points, line_mask, np.array([0.05, 2.0, 0.05, 0.5]))
+    assert widths.tolist() == pytest.approx([420000 * 0.05 ** 2, 10.0, 3200 * 0.05, 5.0])
+    assert heights.tolist() == pytest.approx([3200 * 0.05, 0.0, 0.0, 10.0])
+    assert units.tolist() == [AREA_UNIT, LINE_UNIT, LINE_UNIT, AREA_UNIT]
+
+
+def test_row_columns():
+    # (length, width, area): lengths stay in metres, areas get their own column
+    assert row_dimensions('polygon', 1050.0, 160.0, AREA_UNIT) == (160.0, None, 1050.0)
+    assert row_dimensions('polygon', 160.0, 0.0, LINE_UNIT) == (160.0, 0.0, None)
+    assert row_dimensions('polyline', 50.0, 0.0, LINE_UNIT) == (50.0, 0.0, None)
+    assert row_dimensions('square', 5.0, 10.0, AREA_UNIT) == (5.0, 10.0, 50.0)
+
+
+def test_quantity():
+    assert quantity(160.0, None, 1050.0, 2, AREA_UNIT) == 2100.0
+    assert quantity(5.0, 10.0, 50.0, 1, AREA_UNIT) == 50.0
+    assert quantity(50.0, 0.0, None, 3, LINE_UNIT) == 150.0
+    # Rows written before the area column
+    assert quantity(5.0, 10.0, None, 1, AREA_UNIT) == 50.0
+    assert quantity(None, None, None, 1, AREA_UNIT) is None
@@ -0,0 +1,71 @@
+from conftest import make_pdf
+
+
+def test_annotation_lands_on_the_page_it_names(app_module, client, upload, tmp_path):
+    project_id = upload(make_pdf(tmp_path / 'two.pdf', pages=2))
+    store = app_module.project_store
+    assert store.get_project(project_id)['current_page'] == 0
+
+    # The viewer flipped to page 2 from its cache; the server hasn't heard yet
+    response = client.post('/api/create_annotation', json={
+        'page_num': 1, 'type': 'square', 'points': [[10, 10], [110, 60]], 'rect_type': 'floor',
+    })
+    assert response.get_json()['success']
+    assert store.list_annotations(project_id, 1)[0]['points'] == [[10, 10], [110, 60]]
+    assert store.list_annotations(project_id, 0) == []
+
+    # Undo and clear act on the named page too
+    assert client.post('/api/undo_annotation', json={'page_num': 0}).get_json()['success'] is False
+    assert client.post('/api/undo_annotation', json={'page_num': 1}).get_json()['success']
+    assert store.list_annotations(project_id, 1) == []
+
+
+def test_scale_is_set_on_the_page_it_names(app_module, client, upload, tmp_path):
+    project_id = upload(make_pdf(tmp_path / 'two.pdf', pages=2))
+    response = client.post('/api/set_scale', json={
+        'page_num': 1, 'points': [[0, 0], [100, 0]], 'known_distance': 5,
+    })
+    assert response.get_json()['success']
+    assert [scale['page_num'] for scale in app_module.project_store.list_scales(project_id)] == [1]
+
+
+def test_unknown_page_is_rejected(client, upload, tmp_path):
+    upload(make_pdf(tmp_path / 'one.pdf'))
+    for url, body in (('/api/create_annotation', {'type': 'square', 'points': [[0, 0], [1, 1]]}),
+                      ('/api/clear_annotations', {}),
+                      ('/api/undo_annotation', {}),
+                      ('/api/detect_room', {'point': [1, 1]})):
+        response = client.post(url, json=dict(body, page_num=5))
+        assert response.status_code == 404, url
+
+
+def test_annotation_fields_must_be_plain_values(app_module, client, upload, tmp_path):
+    project_id = upload(make_pdf(tmp_path / 'one.pdf'))
+    square = {'type': 'square', 'points': [[10, 10], [110, 60]]}
+    for field, value in (('label', {'text': 'A'}), ('rect_name', ['Room']), ('parent_area', 3),
+                         ('replicas', 'two'), ('replicas', True), ('type', ['square'])):
+        response = client.post('/api/create_annotation', json=dict(square, **{field: value}))
+        assert response.status_code == 400, (field, value)
+        assert response.get_json()['error'] == f"Invalid {field}"
+
+    # In a batch only the bad item is turned away
+    response = client.post('/api/annotations/batch', json={'annotations': [
+        dict(square, label='A'),
+        dict(square, label=['B']),
+        dict(square, replicas=float('inf')),
+        dict(square, rect_name='Kitchen', replicas=2),
+    ]})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert (body['created'], body['failed']) == (2, 2)
+    assert [result.get('error') for result in body['results']] == [None, "Invalid label", "Invalid replicas", None]
+    assert [a['label'] for a in app_module.project_store.list_annotations(project_id, 0)] == ['A', '']
+
+
+def test_zoom_must_be_finite(app_module, client, upload, tmp_path):
+    project_id = upload(make_pdf(tmp_path / 'one.pdf'))
+    for zoom in ('nan', 'inf', '-inf', 'big', [2]):
+        response = client.post('/api/adjust_zoom', json={'zoom': zoom})
+        assert response.status_code == 400, zoom
+    assert client.post('/api/adjust_zoom', json={'zoom': '100'}).get_json()['zoom_level'] == app_module.MAX_ZOOM
+    assert app_module.project_store.get_project(project_id)['zoom_level'] == app_module.MAX_ZOOM
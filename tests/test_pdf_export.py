@@ -0,0 +1,190 @@
+import os
+
+import fitz  # PyMuPDF
+import pytest
+
+from conftest import make_pdf
+from page_geometry import PageGeometryIndex
+from pdf_export import PdfExporter
+
+PAGES = 20
+
+
+def make_source(path):
+    """A drawing set with what a merge of per-range PDFs used to drop: page
+    labels, a hidden layer, a form field, an embedded file and an outline."""
+    doc = fitz.open()
+    walls = doc.add_ocg('Walls', on=False)
+    for page_num in range(PAGES):
+        page = doc.new_page(width=842, height=595)
+        page.insert_text((50, 50), f"Sheet {page_num + 1}")
+        page.draw_rect(fitz.Rect(100, 100, 400, 300), color=(0, 0, 0), oc=walls)
+    widget = fitz.Widget()
+    widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+    widget.field_name = 'checked_by'
+    widget.rect = fitz.Rect(700, 550, 800, 570)
+    doc[0].add_widget(widget)
+    doc.set_page_labels([{'startpage': 0, 'prefix': 'A-', 'style': 'D', 'firstpagenum': 101}])
+    doc.set_toc([[1, 'Plans', 1], [1, 'Sections', 11]])
+    doc.set_metadata({'title': 'Block C'})
+    doc.embfile_add('schedule.csv', b'room,area\n')
+    doc.save(path)
+    doc.close()
+    return str(path)
+
+
+def annotations(page_nums, label='R'):
+    return {
+        page_num: [
+            {'type': 'line', 'points': [[60, 80], [200, 80 + page_num]], 'label': f"{label}{page_num}"},
+            {'type': 'square', 'points': [[300, 300], [350, 380]]},
+            {'type': 'polygon', 'points': [[500, 100], [600, 100], [550, 180]], 'label': 'P'},
+        ]
+        for page_num in page_nums
+    }
+
+
+@pytest.fixture(scope='module')
+def source(tmp_path_factory):
+    path = make_source(tmp_path_factory.mktemp('source') / 'set.pdf')
+    return path, PageGeometryIndex.build(path)
+
+
+def export(tmp_path, source, annotations, max_workers, name):
+    path, geometry = source
+    exporter = PdfExporter(str(tmp_path / name), max_workers=max_workers, parallel_min_pages=16, min_chunk_pages=8)
+    try:
+        return exporter.export('project', 'hash', path, annotations, geometry)
+    finally:
+        exporter.shutdown()
+
+
+def page_summary(page):
+    return page.get_text(), [(d['rect'], d.get('color')) for d in page.get_drawings()]
+
+
+def test_parallel_export_matches_serial(tmp_path, source):
+    drawn = annotations([0, 1, 5, 8, 9, 17, 19])
+    serial_path, serial_stats = export(tmp_path, source, drawn, 1, 'serial')
+    parallel_path, parallel_stats = export(tmp_path, source, drawn, 2, 'parallel')
+    assert serial_stats['mode'] == 'full'
+    assert parallel_stats['mode'] == 'parallel' and parallel_stats['parts'] == 3
+
+    with fitz.open(serial_path) as serial, fitz.open(parallel_path) as parallel:
+        for doc in (serial, parallel):
+            assert doc.get_page_labels() == [{'startpage': 0, 'prefix': 'A-', 'style': 'D', 'firstpagenum': 101}]
+            assert [ocg['name'] for ocg in doc.get_ocgs().values()] == ['Walls']
+            assert doc.get_layer()['off'] == list(doc.get_ocgs())
+            assert doc.is_form_pdf == 1
+            assert doc.embfile_names() == ['schedule.csv']
+            assert doc.get_toc() == [[1, 'Plans', 1], [1, 'Sections', 11]]
+            assert doc.metadata['title'] == 'Block C'
+        assert len(serial) == len(parallel) == PAGES
+        for page_num in range(PAGES):
+            assert page_summary(serial[page_num]) == page_summary(parallel[page_num])
+        assert 'R5' in parallel[5].get_text()
+
+
+def test_parallel_export_adds_label_font(tmp_path):
+    # No text on the source pages: the labels' font has to come along with the layer
+    path = make_pdf(tmp_path / 'plain.pdf', pages=PAGES, lines=[(100, 100, 500, 100)])
+    plain = (path, PageGeometryIndex.build(path))
+    drawn = annotations([3, 12])
+    serial_path, _ = export(tmp_path, plain, drawn, 1, 'serial')
+    parallel_path, _ = export(tmp_path, plain, drawn, 2, 'parallel')
+    with fitz.open(serial_path) as serial, fitz.open(parallel_path) as parallel:
+        for page_num in range(PAGES):
+            assert page_summary(serial[page_num]) == page_summary(parallel[page_num])
+        assert parallel[12].get_text().split() == ['R12', 'P']
+        assert [font[3] for font in parallel[12].get_fonts()] == ['Helvetica']
+
+
+def summaries(path):
+    with fitz.open(path) as doc:
+        return [page_summary(page) for page in doc]
+
+
+@pytest.mark.parametrize('parallel, first_mode', [(False, 'full'), (True, 'parallel')])
+def test_reexport_redraws_changed_pages(tmp_path, source, parallel, first_mode):
+    source_path, geometry = source
+    exporter = PdfExporter(str(tmp_path / 'exports'), max_workers=2, min_chunk_pages=8,
+                           parallel_min_pages=16 if parallel else PAGES + 1)
+
+    exports = []
+
+    def reexport(drawn):
+        path, stats = exporter.export('project', 'hash', source_path, drawn, geometry)
+        exports.append(stats['mode'])
+        # Whatever route got it there, the export matches a fresh one of the same annotations
+        fresh_path, fresh_stats = export(tmp_path, source, drawn, 1, f"fresh-{len(exports)}")
+        assert fresh_stats['mode'] == 'full'
+        assert summaries(path) == summaries(fresh_path)
+        return path, stats
+
+    def baked_contents(path, page_num):
+        with fitz.open(path) as doc:
+            return doc[page_num].get_contents()
+
+    with fitz.open(source_path) as doc:
+        originals = [page.get_contents() for page in doc]
+    try:
+        drawn = annotations([2, 5, 12])
+        path, stats = reexport(drawn)
+        assert stats['mode'] == first_mode
+        assert exporter._load_state('project')['pages'][5]['base'] == originals[5]
+        assert baked_contents(path, 5) != originals[5]
+
+        # Nothing changed: the file is left alone
+        mtime = os.stat(path).st_mtime_ns
+        assert reexport(drawn)[1] == {'pages_drawn': 0, 'pages_reused': 3, 'mode': 'unchanged'}
+        assert os.stat(path).st_mtime_ns == mtime
+
+        # Edit a page: only that page is redrawn, on top of its original contents
+        drawn[5] = [dict(drawn[5][0], label='Edited')] + drawn[5][1:]
+        stats = reexport(drawn)[1]
+        assert stats == {'pages_drawn': 1, 'pages_reused': 2, 'mode': 'incremental'}
+        with fitz.open(path) as doc:
+            assert 'Edited' in doc[5].get_text() and 'R5' not in doc[5].get_text()
+            assert doc[5].get_contents()[:len(originals[5])] == originals[5]
+
+        # Undo the last annotation on it
+        drawn[5] = drawn[5][:-1]
+        assert reexport(drawn)[1]['mode'] == 'incremental'
+        with fitz.open(path) as doc:
+            assert 'P' not in doc[5].get_text().split()
+
+        # Clear it: the page goes back to exactly the source's /Contents
+        del drawn[5]
+        stats = reexport(drawn)[1]
+        assert stats == {'pages_drawn': 0, 'pages_reused': 2, 'mode': 'incremental'}
+        assert baked_contents(path, 5) == originals[5]
+        assert 5 not in exporter._load_state('project')['pages']
+        with fitz.open(path) as doc, fitz.open(source_path) as original:
+            assert doc[5].read_contents() == original[5].read_contents()
+
+        # Draw it again after clearing
+        drawn[5] = annotations([5], label='Again')[5]
+        assert reexport(drawn)[1]['pages_drawn'] == 1
+        assert exporter._load_state('project')['pages'][5]['base'] == originals[5]
+    finally:
+        exporter.shutdown()
+
+
+def test_reexport_compacts_grown_file(tmp_path, source):
+    source_path, geometry = source
+    exporter = PdfExporter(str(tmp_path / 'exports'), compact_ratio=1.0, max_workers=1)
+    try:
+        drawn = annotations([1])
+        exporter.export('project', 'hash', source_path, drawn, geometry)
+        full_size = exporter._load_state('project')['full_size']
+        drawn[1] = annotations([1], label='Edited')[1]
+        # The first update still fits; the next one would leave the file past its full size
+        path, stats = exporter.export('project', 'hash', source_path, drawn, geometry)
+        assert stats['mode'] == 'incremental' and os.path.getsize(path) > full_size
+        drawn[1] = annotations([1], label='Again')[1]
+        path, stats = exporter.export('project', 'hash', source_path, drawn, geometry)
+        assert stats['mode'] == 'full'
+        assert os.path.getsize(path) == exporter._load_state('project')['full_size']
+        assert 'Again1' in summaries(path)[1][0]
+    finally:
+        exporter.shutdown()
@@ -0,0 +1,119 @@
+import os
+import time
+import uuid
+
+import pytest
+
+from conftest import make_pdf
+from prerender import PrerenderPool
+from render_cache import RenderCache
+
+
+@pytest.fixture
+def submitted(app_module, monkeypatch):
+    """Documents handed to the pre-render pool (which isn't actually asked)."""
+    calls = []
+    monkeypatch.setattr(app_module.prerender_pool, 'submit', lambda doc_hash, *args, **kwargs: calls.append(doc_hash))
+    monkeypatch.setattr(app_module.jobs, 'track', lambda *args, **kwargs: None)
+    return calls
+
+
+def project(page_count=2):
+    # A document of its own, so the session's render cache and job table don't leak between tests
+    return {'id': 'project-1', 'content_hash': uuid.uuid4().hex * 2, 'pdf_path': 'doc.pdf', 'page_count': page_count,
+            'zoom_level': 1.5}
+
+
+def mark_ready(app_module, doc, *page_nums):
+    zoom = app_module.render_zoom_for(1.5)
+    for page_num in page_nums:
+        key = app_module.render_cache.ready_key(doc['content_hash'], page_num, zoom, app_module.renderer.name,
+                                                app_module.app.config['TILE_SIZE'])
+        app_module.render_cache.put(key, b'')
+
+
+def mark_previews(app_module, doc):
+    for page_num in range(doc['page_count']):
+        key = app_module.render_cache.page_key(doc['content_hash'], page_num, app_module.app.config['PREVIEW_ZOOM'],
+                                               app_module.app.config['RENDER_FORMAT'], app_module.renderer.name)
+        app_module.render_cache.put(key, b'png')
+
+
+def running_job(app_module, doc, pid):
+    with app_module.jobs._connect() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, kind, lane, job_key, state, pid, created_at) "
+            "VALUES (?, 'prerender', 'tracked', ?, 'running', ?, ?)",
+            (uuid.uuid4().hex, doc['content_hash'], pid, time.time()),
+        )
+
+
+def test_new_document_is_submitted(app_module, submitted):
+    doc = project()
+    app_module.prerender_project(doc)
+    assert submitted == [doc['content_hash']]
+
+
+def test_rendered_document_is_not_submitted_again(app_module, submitted):
+    doc = project()
+    mark_ready(app_module, doc, 0, 1)
+    app_module.prerender_project(doc)
+    assert submitted == [doc['content_hash']]
+    mark_previews(app_module, doc)
+    app_module.prerender_project(doc)
+    assert submitted == [doc['content_hash']]
+
+
+def test_tiles_only_matter_near_the_page(app_module, submitted):
+    # Window of 3: pages 0-3 need their tiles when page 0 is viewed, pages 7-13 for page 10
+    doc = project(page_count=20)
+    mark_previews(app_module, doc)
+    mark_ready(app_module, doc, 0, 1, 2, 3)
+    app_module.prerender_project(doc, 0)
+    assert submitted == []
+    app_module.prerender_project(doc, 10)
+    assert submitted == [doc['content_hash']]
+
+
+def test_document_another_worker_renders(app_module, submitted):
+    doc = project()
+    # A worker that died mid-render doesn't count
+    running_job(app_module, doc, 2 ** 22 + 1)
+    app_module.prerender_project(doc)
+    assert submitted == [doc['content_hash']]
+    running_job(app_module, doc, os.getppid())
+    app_module.prerender_project(doc)
+    assert submitted == [doc['content_hash']]
+
+
+def wait_idle(pool, doc_hash, pages):
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        status = pool.status(doc_hash)
+        if len(status['ready']) == pages and not status['pending'] and not status['running']:
+            return status
+        time.sleep(0.05)
+    raise AssertionError("Pre-rendering didn't finish")
+
+
+def test_pool_tiles_pages_near_the_focus(tmp_path):
+    path = str(make_pdf(tmp_path / 'set.pdf', pages=8, width=600, height=400))
+    cache = RenderCache(str(tmp_path / 'renders'))
+    pool = PrerenderPool(cache, max_workers=1, tile_size=256, tile_window=1)
+    doc_hash = 'cd' * 32
+
+    def tiled():
+        return [page_num for page_num in range(8)
+                if cache.contains(cache.ready_key(doc_hash, page_num, 1.0, 'pymupdf', 256))]
+
+    try:
+        pool.submit(doc_hash, path, 8, 1.0, owner='project-1', focus_page=0)
+        wait_idle(pool, doc_hash, 8)
+        assert all(cache.contains(cache.page_key(doc_hash, page_num, 0.5, 'png', 'pymupdf')) for page_num in range(8))
+        assert tiled() == [0, 1]
+        # Moving on to page 6 tiles the pages around it
+        assert pool.focus(doc_hash, 6)
+        wait_idle(pool, doc_hash, 8)
+        assert tiled() == [0, 1, 5, 6, 7]
+    finally:
+        pool.shutdown()
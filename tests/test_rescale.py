@@ -0,0 +1,59 @@
+import sqlite3
+
+from conftest import make_pdf
+from project_store import SQLiteProjectStore
+
+
+def test_cleared_measurements_are_rescaled(client, upload, tmp_path):
+    upload(make_pdf(tmp_path / 'plan.pdf'))
+    client.post('/api/set_scale', json={'page_num': 0, 'points': [[0, 0], [100, 0]], 'known_distance': 1})
+    client.post('/api/create_annotation', json={
+        'page_num': 0, 'type': 'square', 'points': [[0, 0], [200, 100]], 'rect_type': 'floor',
+    })
+    # Clearing the page removes the drawing but keeps the row in the data set
+    client.post('/api/clear_annotations', json={'page_num': 0})
+    response = client.post('/api/set_scale', json={'page_num': 0, 'points': [[0, 0], [100, 0]], 'known_distance': 2})
+    assert response.get_json()['rescaled'] == 1
+
+    rows = client.get('/api/get_data_preview').get_json()['data']
+    assert [row[2:6] for row in rows] == [[4.0, 2.0, 0, 8.0]]
+
+
+OLD_MEASUREMENTS = """
+CREATE TABLE measurements (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_id TEXT NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+    annotation_id INTEGER REFERENCES annotations(id) ON DELETE SET NULL,
+    page_num INTEGER NOT NULL,
+    name TEXT,
+    parent_area TEXT,
+    length REAL,
+    width REAL,
+    height REAL,
+    replicas INTEGER,
+    unit TEXT,
+    area_type TEXT
+);
+"""
+
+
+def test_old_measurement_rows_get_their_geometry(tmp_path):
+    path = str(tmp_path / 'projects.db')
+    store = SQLiteProjectStore(path)
+    document_id = store.upsert_document('abc', '/tmp/x.pdf', 'x.pdf', [{'width': 100, 'height': 100, 'rotation': 0}])
+    project_id = store.create_project(document_id)
+    store.add_annotation(project_id, 0, {'type': 'square', 'points': [[0, 0], [10, 20]]},
+                         ['A', '', 10, 20, 0, 200, 1, 'Sqmt', 'floor'])
+    store._connect().close()
+
+    # Rebuild the table as it was before it kept geometry and areas
+    with sqlite3.connect(path) as conn:
+        rows = conn.execute("SELECT id, project_id, annotation_id, page_num, name, parent_area, length, width, "
+                            "height, replicas, unit, area_type FROM measurements").fetchall()
+        conn.execute("DROP TABLE measurements")
+        conn.executescript(OLD_MEASUREMENTS)
+        conn.executemany(f"INSERT INTO measurements VALUES ({', '.join('?' * 12)})", rows)
+
+    migrated = SQLiteProjectStore(path)
+    assert migrated.page_measurements(project_id, 0) == [(rows[0][0], 'square', [[0, 0], [10, 20]], 'Sqmt')]
+    assert migrated.list_measurements(project_id) == [['A', '', 10, 20, 0, 200, 1, 'Sqmt', 'floor']]
@@ -0,0 +1,106 @@
+import fitz  # PyMuPDF
+import numpy as np
+import pytest
+
+from conftest import make_pdf
+from rooms import PlanarGraph, _link, _UnionFind, find_room, find_room_in_index, room_dimensions
+from snapping import SegmentIndex, extract_segments
+
+
+def rectangle(x0, y0, x1, y1):
+    return [(x0, y0, x1, y0), (x1, y0, x1, y1), (x1, y1, x0, y1), (x0, y1, x0, y0)]
+
+
+# Two rooms side by side, 400 x 300 and 600 x 300, with a dimension line
+# sticking out of the plan and a table inside the left room
+PLAN = (rectangle(100, 100, 1100, 400)
+        + [(500, 100, 500, 400), (100, 450, 1100, 450), (200, 200, 250, 200)]
+        + rectangle(300, 250, 350, 300))
+
+
+def test_rectangle_room():
+    room = find_room(PLAN, 800, 250)
+    assert room['area'] == pytest.approx(600 * 300)
+    assert room['perimeter'] == pytest.approx(2 * (600 + 300))
+    assert sorted(map(tuple, room['polygon'])) == [(500, 100), (500, 400), (1100, 100), (1100, 400)]
+
+
+def test_islands_do_not_count_against_the_room():
+    # The table is furniture, not a hole in the floor
+    room = find_room(PLAN, 150, 150)
+    assert room['area'] == pytest.approx(400 * 300)
+
+
+@pytest.mark.parametrize('x, y', [
+    (50, 50),     # outside the drawing altogether
+    (800, 425),   # between the walls and the dimension line: open at both ends
+    (800, 600),   # below everything but inside the page
+])
+def test_click_outside_every_room(x, y):
+    assert find_room(PLAN, x, y) is None
+
+
+def test_click_inside_a_table_finds_the_table():
+    room = find_room(PLAN, 325, 275)
+    assert room['area'] == pytest.approx(50 * 50)
+
+
+def test_wall_gap_within_tolerance_is_closed():
+    # The right-hand wall stops 0.3 pt short of the bottom one
+    segments = rectangle(0, 0, 200, 100)[:1] + [(200, 0, 200, 99.7), (200, 100, 0, 100), (0, 100, 0, 0)]
+    room = find_room(segments, 100, 50, tolerance=0.5)
+    assert room['area'] == pytest.approx(200 * 100, rel=1e-2)
+
+
+def test_door_opening_wider_than_tolerance_is_open():
+    segments = [(0, 0, 200, 0), (200, 0, 200, 100), (200, 100, 120, 100), (80, 100, 0, 100), (0, 100, 0, 0)]
+    assert find_room(segments, 100, 50, tolerance=0.5) is None
+
+
+def test_room_dimensions_scale():
+    room = find_room(PLAN, 800, 250)
+    area, perimeter = room_dimensions(room, 0.01)
+    assert area == pytest.approx(18.0)
+    assert perimeter == pytest.approx(18.0)
+
+
+@pytest.mark.parametrize('rotation', [0, 90, 180, 270])
+def test_rotated_page(tmp_path, rotation):
+    path = make_pdf(tmp_path / f'rot{rotation}.pdf', lines=PLAN, rotation=rotation)
+    with fitz.open(path) as doc:
+        page = doc[0]
+        index = SegmentIndex(extract_segments(page))
+        # Where the viewer shows a point of the right-hand room
+        click = fitz.Point(800, 250) * page.rotation_matrix
+    room = find_room_in_index(index, click.x, click.y)
+    assert room['area'] == pytest.approx(600 * 300)
+    assert room['perimeter'] == pytest.approx(1800)
+
+
+def test_link_labels_components():
+    # 0-1-2 and 3-4 joined, 5 alone; labels are each component's smallest item
+    labels = _link(6, np.array([2, 0, 4]), np.array([1, 1, 3]))
+    assert labels.tolist() == [0, 0, 0, 3, 3, 5]
+
+
+def test_union_find_roots():
+    union_find = _UnionFind(5)
+    union_find.union(4, 2)
+    union_find.union(2, 0)
+    assert union_find.roots().tolist() == [0, 1, 0, 3, 0]
+
+
+def test_crossing_walls_are_split_and_dead_ends_pruned():
+    # A plus sign inside a square: four rooms; the stub sticking out is pruned
+    segments = rectangle(0, 0, 100, 100) + [(50, 0, 50, 100), (0, 50, 100, 50), (100, 20, 130, 20)]
+    graph = PlanarGraph(segments)
+    # The stub splits the right-hand wall at (100, 20), but its loose end has no edge left
+    assert len(graph.vertices) == 11
+    assert len(graph.edges) == 13
+    stub_end = graph.vertices.tolist().index([130, 20])
+    assert stub_end not in graph.edges
+    assert graph.border.sum() == 0
+    cycle = graph.face_at(25, 25)
+    assert sorted(map(tuple, graph.vertices[graph.src[cycle]].tolist())) == [(0, 0), (0, 50), (50, 0), (50, 50)]
+    # The outside of the plan has no wall to its right
+    assert graph.face_at(150, 25) is None
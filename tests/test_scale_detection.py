@@ -0,0 +1,186 @@
+import fitz  # PyMuPDF
+import numpy as np
+import pytest
+
+from conftest import make_pdf
+from scale_detection import POINT_M, combine, detect_page_scale, find_scale_bars, parse_scale_notes
+
+# A 1200 x 800 pt page: about A3 (423 mm on the long side)
+WIDTH, HEIGHT = 1200, 800
+BOX = (900, 700, 1000, 712)
+
+
+def notes(*texts):
+    return parse_scale_notes([(text, BOX) for text in texts], WIDTH, HEIGHT)
+
+
+@pytest.mark.parametrize('text, ratio, label', [
+    ('1:100', 100, '1:100'),
+    ('1 : 50', 50, '1 : 50'),
+    ('SCALE 1:100', 100, '1:100'),
+    # Uncommon ratios only count next to the word SCALE
+    ('SCALE 1:37', 37, '1:37'),
+    ('SCALE: 1/200', 200, 'SCALE: 1/200'),
+    ('SCALE 1/4" = 1\'-0"', 48, '1/4" = 1\'-0"'),
+    ('3/16" = 1\'-0"', 64, '3/16" = 1\'-0"'),
+    ('1 1/2" = 1\'-0"', 8, '1 1/2" = 1\'-0"'),
+    ('1" = 20\'', 240, '1" = 20\''),
+    ('1 inch = 10 feet', 120, '1 inch = 10 feet'),
+    ('1/8" = 1\'-6"', 144, '1/8" = 1\'-6"'),
+])
+def test_scale_notes(text, ratio, label):
+    found = notes(text)
+    assert len(found) == 1
+    assert found[0]['ratio'] == pytest.approx(ratio)
+    assert found[0]['scale'] == pytest.approx(ratio * POINT_M)
+    assert found[0]['label'] == label
+
+
+@pytest.mark.parametrize('text', [
+    '11:30',               # a time
+    '21:100',              # not a 1:n ratio
+    '1:37',                # uncommon ratio, no SCALE nearby
+    '1:2:3',               # an aspect ratio
+    'REV 1.1:50',
+    'DATE 2024/1:5',
+    '1/4" WALL',           # a dimension, not an equation
+    'SCALE 1/4',           # 1/n needs at least two digits
+    '0" = 1\'-0"',
+    'NOT TO SCALE',
+])
+def test_not_scale_notes(text):
+    assert notes(text) == []
+
+
+def test_keyword_raises_confidence():
+    assert notes('1:100')[0]['confidence'] == 0.5
+    assert notes('SCALE 1:100')[0]['confidence'] == 0.85
+    # The keyword on its own line nearby counts too; far away it doesn't
+    near = parse_scale_notes([('SCALE', (900, 680, 940, 692)), ('1:37', BOX)], WIDTH, HEIGHT)
+    far = parse_scale_notes([('SCALE', (100, 100, 140, 112)), ('1:37', BOX)], WIDTH, HEIGHT)
+    assert [n['ratio'] for n in near] == [37]
+    assert far == []
+
+
+def test_sheet_size_corrects_ratio():
+    # Drawn at 1:50 on A1 (841 mm), printed on this A3-sized page
+    found = notes('1:50 @ A1')
+    assert found[0]['label'] == '1:50 @ A1'
+    assert found[0]['ratio'] == pytest.approx(50 * 841 / (WIDTH / 72 * 25.4))
+    # On its own sheet size the ratio stands
+    a3 = parse_scale_notes([('1:50 AT A3', BOX)], 1190.55, 841.89)
+    assert a3[0]['ratio'] == 50
+    assert a3[0]['label'] == '1:50 @ A3'
+
+
+def test_several_notes_on_one_line():
+    assert [n['ratio'] for n in notes('PLAN 1:100  DETAIL 1:20')] == [100, 20]
+
+
+def candidate(ratio, confidence=0.85, bbox=BOX):
+    return {'ratio': ratio, 'scale': ratio * POINT_M, 'label': f'1:{ratio}', 'bbox': list(bbox),
+            'confidence': confidence}
+
+
+@pytest.mark.parametrize('note_ratios, bar_ratios, nts, source, ratio, confidence', [
+    ([], [], False, None, None, 0.0),
+    ([100], [], False, 'text', 100, 0.85),
+    ([], [100], False, 'bar', 100, 0.85),
+    # A bar confirming the note
+    ([100], [100.5], False, 'text+bar', 100, 0.97),
+    # Disagreeing: the bar wins, with less confidence
+    ([100], [50], False, 'bar', 50, 0.6),
+    # Several scales on the sheet
+    ([100, 20], [], False, 'text', 100, 0.5),
+    ([100], [], True, 'text', 100, 0.3),
+])
+def test_combine(note_ratios, bar_ratios, nts, source, ratio, confidence):
+    result = combine([candidate(r) for r in note_ratios], [candidate(r) for r in bar_ratios], WIDTH, HEIGHT, nts)
+    assert result['source'] == source
+    assert result['ratio'] == ratio
+    assert result['confidence'] == confidence
+    assert result['nts'] == nts
+    assert result['candidates'] == len(note_ratios) + len(bar_ratios)
+
+
+def test_combine_prefers_confident_then_title_block():
+    confident = candidate(50, confidence=0.85, bbox=(0, 0, 50, 12))
+    corner = candidate(100, confidence=0.5, bbox=(1100, 780, 1190, 792))
+    assert combine([corner, confident], [], WIDTH, HEIGHT)['ratio'] == 50
+    corner['confidence'] = 0.85
+    assert combine([confident, corner], [], WIDTH, HEIGHT)['ratio'] == 100
+
+
+def bar_labels(values, x0=100, step=50, y=715, unit=None):
+    """Label text centred under ``x0 + i * step``, like a drawn scale bar."""
+    text = []
+    for i, value in enumerate(values):
+        centre = x0 + i * step
+        text.append((centre - fitz.get_text_length(value, fontsize=10) / 2, y, value))
+    if unit:
+        text.append((x0 + (len(values) - 1) * step + 15, y, unit))
+    return text
+
+
+BAR = [(100, 700, 200, 700), (200, 700, 300, 700)]
+
+
+def page_scale(tmp_path, lines=(), text=()):
+    path = make_pdf(tmp_path / 'page.pdf', width=WIDTH, height=HEIGHT, lines=lines, text=text)
+    with fitz.open(path) as doc:
+        return detect_page_scale(doc[0])
+
+
+def test_scale_bar_on_page(tmp_path):
+    # 0, 5, 10 m every 100 pt: 20 pt per metre
+    result = page_scale(tmp_path, lines=BAR, text=bar_labels(['0', '5', '10'], step=100, unit='m'))
+    assert result['source'] == 'bar'
+    assert result['scale'] == pytest.approx(0.05, rel=0.01)
+    assert result['confidence'] == 0.9
+    assert result['label'] == 'bar 0-10 m'
+    assert result['has_text']
+
+
+def test_scale_bar_unit_on_labels(tmp_path):
+    result = page_scale(tmp_path, lines=BAR, text=bar_labels(['0', '10ft', '20ft', '30ft'], step=200 / 3))
+    assert result['scale'] == pytest.approx(30 * 0.3048 / 200, rel=0.01)
+
+
+def test_scale_bar_without_unit_is_less_sure(tmp_path):
+    result = page_scale(tmp_path, lines=BAR, text=bar_labels(['0', '5', '10'], step=100))
+    assert result['scale'] == pytest.approx(0.05, rel=0.01)
+    assert result['confidence'] == 0.6
+
+
+def test_scale_bar_confirms_note(tmp_path):
+    # 20 pt per metre is 1:1417.3; a note saying so agrees with the bar
+    ratio = 0.05 / POINT_M
+    text = bar_labels(['0', '5', '10'], step=100, unit='m') + [(900, 760, f'SCALE 1:{ratio:.1f}')]
+    result = page_scale(tmp_path, lines=BAR, text=text)
+    assert result['source'] == 'text+bar'
+
+
+@pytest.mark.parametrize('lines, values, step', [
+    ((), ['0', '5', '10'], 100),                        # labels without a drawn bar
+    (BAR[:1], ['0', '5', '10'], 100),                   # bar covering half the labels
+    (BAR, ['0', '5', '20'], 100),                       # labels not spaced linearly
+    (BAR, ['1', '5', '10'], 100),                       # doesn't start at 0
+    (BAR, ['0', '5'], 200),                             # too few labels
+])
+def test_not_scale_bars(tmp_path, lines, values, step):
+    result = page_scale(tmp_path, lines=lines, text=bar_labels(values, step=step, unit='m'))
+    assert result['scale'] is None
+
+
+def test_labels_on_separate_baselines_are_not_a_bar():
+    boxes = np.array([[95, 705, 105, 717], [195, 745, 205, 757], [290, 705, 310, 717]], dtype=np.float64)
+    segments = np.array([[100, 700, 300, 700]], dtype=np.float64)
+    assert find_scale_bars(boxes, ['0', '5', '10'], segments) == []
+    boxes[1, [1, 3]] = [705, 717]
+    assert len(find_scale_bars(boxes, ['0', '5', '10'], segments)) == 1
+
+
+def test_blank_page(tmp_path):
+    result = page_scale(tmp_path, lines=BAR)
+    assert result['scale'] is None
+    assert not result['has_text']
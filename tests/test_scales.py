@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from scales import ScaleMap, normalize_rect
+
+
+def scale(scale_id, page_num, value, rect=None, name=''):
+    return {'id': scale_id, 'page_num': page_num, 'name': name, 'rect': rect, 'scale': value,
+            'source': 'reference', 'reference': None}
+
+
+# Page 0: a page scale, a plan viewport and a detail nested inside it.
+# Page 1: only a viewport. Page 2: nothing.
+SCALES = [
+    scale(1, 0, 0.1),
+    scale(2, 0, 0.05, rect=[0, 0, 600, 400], name='Plan'),
+    scale(3, 0, 0.01, rect=[400, 200, 500, 300], name='Detail A'),
+    scale(4, 1, 0.2, rect=[0, 0, 100, 100], name='Section'),
+]
+
+
+def lookup(scale_map, page_num, *points):
+    values, ids = scale_map.lookup([page_num], np.array([points], dtype=np.float64))
+    return float(values[0]), int(ids[0])
+
+
+def test_smallest_enclosing_viewport_wins():
+    scale_map = ScaleMap(SCALES)
+    assert lookup(scale_map, 0, (420, 220), (480, 280)) == (0.01, 3)
+    # Reaching out of the detail falls back to the plan it sits in
+    assert lookup(scale_map, 0, (420, 220), (550, 280)) == (0.05, 2)
+
+
+def test_viewport_order_does_not_matter():
+    assert lookup(ScaleMap(SCALES[::-1]), 0, (420, 220), (480, 280)) == (0.01, 3)
+
+
+def test_viewport_edge_counts_as_inside():
+    scale_map = ScaleMap(SCALES)
+    assert lookup(scale_map, 0, (400, 200), (500, 300)) == (0.01, 3)
+    assert lookup(scale_map, 0, (0, 0), (600, 400)) == (0.05, 2)
+    assert lookup(scale_map, 0, (0, 0), (600.01, 400)) == (0.1, 1)
+
+
+def test_page_scale_then_default():
+    scale_map = ScaleMap(SCALES, default=0.5)
+    assert lookup(scale_map, 0, (700, 500), (800, 600)) == (0.1, 1)
+    # Page 1 has a viewport but no page scale
+    assert lookup(scale_map, 1, (10, 10), (50, 50)) == (0.2, 4)
+    assert lookup(scale_map, 1, (200, 200), (300, 300)) == (0.5, -1)
+    assert lookup(scale_map, 2, (10, 10), (50, 50)) == (0.5, -1)
+
+
+def test_no_scale_is_nan():
+    value, scale_id = lookup(ScaleMap(SCALES), 2, (10, 10), (50, 50))
+    assert np.isnan(value) and scale_id == -1
+
+
+def test_viewports_belong_to_their_page():
+    # Page 3 has no scales, even where page 0's viewports would cover the points
+    value, _ = lookup(ScaleMap(SCALES), 3, (420, 220), (480, 280))
+    assert np.isnan(value)
+
+
+def test_batch_lookup_with_rejected_rows():
+    scale_map = ScaleMap(SCALES, default=0.5)
+    points = np.array([[[420, 220], [480, 280]], [[np.nan, np.nan], [np.nan, np.nan]], [[10, 10], [20, 20]]])
+    values, ids = scale_map.lookup([0, 0, 1], points)
+    # NaN points are outside every viewport and take the page scale
+    assert values.tolist() == [0.01, 0.1, 0.2]
+    assert ids.tolist() == [3, 1, 4]
+
+
+def test_has_scale_and_describe():
+    scale_map = ScaleMap(SCALES)
+    assert scale_map.has_scale(0) and scale_map.has_scale(1) and not scale_map.has_scale(2)
+    assert ScaleMap([], default=0.5).has_scale(2)
+    assert [scale_map.describe(i) for i in (-1, 1, 3)] == ['document', 'page', 'Detail A']
+
+
+def test_normalize_rect():
+    assert normalize_rect([500, 300, 400, 200]) == [400, 200, 500, 300]
+
+
+@pytest.mark.parametrize('scales', [[], SCALES[:1]])
+def test_without_viewports(scales):
+    values, ids = ScaleMap(scales, default=0.5).lookup([0, 2], np.zeros((2, 2, 2)))
+    assert values.tolist() == ([0.5, 0.5] if not scales else [0.1, 0.5])
@@ -0,0 +1,8 @@
+from conftest import make_pdf
+
+
+def test_tiles_are_cached_for_good(app_module, client, upload, tmp_path):
+    project = app_module.project_store.get_project(upload(make_pdf(tmp_path / 'plan.pdf', width=1101)))
+    response = client.get(f"/tile/{project['content_hash']}/0/1.0/0/0")
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'max-age=31536000, private, immutable'
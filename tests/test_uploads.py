@@ -0,0 +1,184 @@
+import hashlib
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from uploads import ChunkedUploads, UploadError, upload_path
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def uploads(tmp_path):
+    return ChunkedUploads(str(tmp_path / 'partial'), max_bytes=len(DATA) * 2)
+
+
+def send(uploads, upload_id, start, end):
+    return uploads.write(upload_id, start, end - start, io.BytesIO(DATA[start:end]))
+
+
+def test_chunks_in_order(uploads, tmp_path):
+    upload_id = uploads.create('plan.pdf', len(DATA))
+    for start in range(0, len(DATA), 4096):
+        assert send(uploads, upload_id, start, min(start + 4096, len(DATA))) == min(start + 4096, len(DATA))
+    content_hash, path, duplicate, filename = uploads.finish(upload_id, str(tmp_path))
+    assert content_hash == hashlib.sha256(DATA).hexdigest()
+    assert path == upload_path(str(tmp_path), content_hash)
+    assert (duplicate, filename) == (False, 'plan.pdf')
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert uploads.status(upload_id) is None
+    assert not os.path.exists(uploads.part_path(upload_id))
+
+
+@pytest.mark.parametrize('start, end, message', [
+    (100, 200, 'Expected a chunk starting at byte 0'),   # out of order: skips ahead
+    (0, len(DATA) + 1, 'Chunk runs past the end of the file'),
+])
+def test_offset_validation(uploads, start, end, message):
+    upload_id = uploads.create('plan.pdf', len(DATA))
+    with pytest.raises(UploadError, match=message) as error:
+        uploads.write(upload_id, start, end - start, io.BytesIO(b'x' * (end - start)))
+    assert error.value.offset == 0
+    assert uploads.status(upload_id)['offset'] == 0
+
+
+def test_duplicate_chunk_is_refused(uploads, tmp_path):
+    upload_id = uploads.create('plan.pdf', len(DATA))
+    send(uploads, upload_id, 0, 4096)
+    # A retry of a chunk that did arrive (the response was lost) tells the client where to go on
+    with pytest.raises(UploadError) as error:
+        send(uploads, upload_id, 0, 4096)
+    assert error.value.offset == 4096
+    # An earlier chunk arriving late is refused the same way
+    send(uploads, upload_id, 4096, 8192)
+    with pytest.raises(UploadError) as error:
+        send(uploads, upload_id, 4096, 8192)
+    assert error.value.offset == 8192
+    send(uploads, upload_id, 8192, len(DATA))
+    assert uploads.finish(upload_id, str(tmp_path))[0] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_unknown_upload(uploads, tmp_path):
+    with pytest.raises(UploadError) as error:
+        send(uploads, 'f' * 32, 0, 10)
+    assert error.value.offset is None
+    with pytest.raises(UploadError):
+        uploads.finish('../../etc/passwd', str(tmp_path))
+    assert uploads.status('not-an-id') is None
+
+
+@pytest.mark.parametrize('restart', [False, True])
+def test_resume_after_interruption(uploads, tmp_path, restart):
+    upload_id = uploads.create('plan.pdf', len(DATA))
+    send(uploads, upload_id, 0, 4096)
+    # The connection drops 1000 bytes into the next chunk: what arrived is kept
+    assert uploads.write(upload_id, 4096, 4096, io.BytesIO(DATA[4096:5096])) == 5096
+    if restart:
+        # Another worker (or a restarted one) hashes the part file to catch up
+        uploads = ChunkedUploads(uploads.directory, uploads.max_bytes)
+    assert uploads.status(upload_id)['offset'] == 5096
+    send(uploads, upload_id, 5096, len(DATA))
+    assert uploads.finish(upload_id, str(tmp_path))[0] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_finish_incomplete_upload(uploads, tmp_path):
+    upload_id = uploads.create('plan.pdf', len(DATA))
+    send(uploads, upload_id, 0, 4096)
+    with pytest.raises(UploadError, match='Upload incomplete') as error:
+        uploads.finish(upload_id, str(tmp_path))
+    assert error.value.offset == 4096
+    assert uploads.status(upload_id)['offset'] == 4096
+
+
+def test_hash_follows_part_file(uploads, tmp_path):
+    upload_id = uploads.create('plan.pdf', len(DATA))
+    send(uploads, upload_id, 0, len(DATA))
+    # Bytes changed on disk behind the running digest: a fresh worker hashes what is really there
+    with open(uploads.part_path(upload_id), 'r+b') as f:
+        f.write(b'changed')
+    fresh = ChunkedUploads(uploads.directory, uploads.max_bytes)
+    expected = hashlib.sha256(b'changed' + DATA[7:]).hexdigest()
+    assert fresh.finish(upload_id, str(tmp_path))[0] == expected
+
+
+def test_duplicate_upload(uploads, tmp_path):
+    for _ in range(2):
+        upload_id = uploads.create('plan.pdf', len(DATA))
+        send(uploads, upload_id, 0, len(DATA))
+        content_hash, path, duplicate, _ = uploads.finish(upload_id, str(tmp_path))
+    assert duplicate
+    assert not os.path.exists(uploads.part_path(upload_id))
+
+
+@pytest.mark.parametrize('size', [0, len(DATA) * 2 + 1])
+def test_create_checks_size(uploads, size):
+    with pytest.raises(UploadError):
+        uploads.create('plan.pdf', size)
+
+
+def test_quota_sweep_spares_unfinished_upload(app_module, client, monkeypatch):
+    data = b'%PDF-' + b'x' * 95
+    response = client.post('/api/uploads', json={'filename': 'plan.pdf', 'size': len(data)})
+    upload_id = response.get_json()['upload_id']
+    client.put(f'/api/uploads/{upload_id}', data=data[:50], headers={'Content-Range': f'bytes 0-49/{len(data)}'})
+    part_path = app_module.chunked_uploads.part_path(upload_id)
+
+    monkeypatch.setattr(app_module.artifacts, 'quota_bytes', 0)
+    app_module.artifacts.sweep()
+    assert os.path.getsize(part_path) == 50
+    response = client.put(f'/api/uploads/{upload_id}', data=data[50:],
+                          headers={'Content-Range': f'bytes 50-99/{len(data)}'})
+    assert response.get_json()['complete']
+
+    # Once the upload is stored the part file and its reference are gone
+    client.post(f'/api/uploads/{upload_id}/complete')
+    assert not os.path.exists(part_path)
+    refs = app_module.artifacts._connect().execute(
+        "SELECT COUNT(*) FROM artifact_refs WHERE holder = ?", (f'upload:{upload_id}',)).fetchone()[0]
+    assert refs == 0
+
+
+class _SlowStream:
+    """Hands out its data only once ``go`` is set, after saying it started."""
+
+    def __init__(self, data, started, go):
+        self.stream = io.BytesIO(data)
+        self.started, self.go = started, go
+
+    def read(self, size):
+        self.started.set()
+        self.go.wait(5)
+        return self.stream.read(size)
+
+
+def test_racing_writers(uploads):
+    # Two workers (two instances) get the same chunk, e.g. a client retry
+    upload_id = uploads.create('plan.pdf', len(DATA))
+    other = ChunkedUploads(uploads.directory, uploads.max_bytes)
+    started, go = threading.Event(), threading.Event()
+    outcomes = {}
+
+    def write(name, worker, stream):
+        try:
+            outcomes[name] = worker.write(upload_id, 0, 4096, stream)
+        except UploadError as e:
+            outcomes[name] = e
+
+    first = threading.Thread(target=write, args=('first', uploads, _SlowStream(DATA[:4096], started, go)))
+    first.start()
+    assert started.wait(5)
+    second = threading.Thread(target=write, args=('second', other, io.BytesIO(DATA[:4096])))
+    second.start()
+    # Give the second writer time to get past its offset check, if nothing stops it
+    time.sleep(0.2)
+    go.set()
+    first.join(5)
+    second.join(5)
+
+    assert outcomes['first'] == 4096
+    assert isinstance(outcomes['second'], UploadError) and outcomes['second'].offset == 4096
+    assert os.path.getsize(uploads.part_path(upload_id)) == 4096
@@ -0,0 +1,206 @@
+"""Content-addressed storage for uploaded PDFs.
+
+An upload is streamed to a temporary file in the upload folder while its
+SHA-256 is computed, then moved to ``<sha256>.pdf``. Re-uploading a drawing
+set therefore stores nothing new, and everything keyed by the content hash
+(rendered pages, page geometry, snap indexes) is already warm.
+
+Very large files can instead be sent in chunks with ``ChunkedUploads``, which
+survives dropped connections and restarts.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def upload_path(directory, content_hash):
+    return os.path.join(directory, f"{content_hash}.pdf")
+
+
+def store_upload(stream, directory, chunk_size=CHUNK_SIZE):
+    """Copy ``stream`` into ``directory`` under its content hash.
+
+    Returns ``(content_hash, path, duplicate)``; ``duplicate`` is True when an
+    identical file was already stored and the new copy was dropped.
+    """
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.upload')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                digest.update(chunk)
+                f.write(chunk)
+        content_hash = digest.hexdigest()
+        path = upload_path(directory, content_hash)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return content_hash, path, True
+        # Two workers storing the same file at once write identical bytes; either wins
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return content_hash, path, False
+
+
+class UploadError(Exception):
+    """A chunk that can't be accepted; ``offset`` is where the client should resume."""
+
+    def __init__(self, message, offset=None):
+        super().__init__(message)
+        self.offset = offset
+
+
+class ChunkedUploads:
+    """Resumable uploads assembled from byte ranges.
+
+    Each upload is a ``<id>.part`` file plus a ``<id>.json`` record of its
+    name and size under ``directory``. Chunks must arrive in order: the part
+    file's size is the offset the next chunk has to start at, so a client
+    that lost its connection asks for the offset and carries on from there.
+    The SHA-256 is updated as chunks are written; a worker that didn't see
+    the earlier chunks (another gunicorn worker, or after a restart) catches
+    up by hashing the part file once. Writes and ``finish`` hold an flock on
+    the part file, so two workers handling overlapping chunks (a client
+    retrying) can't both append.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._digests = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def part_path(self, upload_id):
+        return os.path.join(self.directory, f"{upload_id}.part")
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.directory, f"{upload_id}.json")
+
+    def _upload_lock(self, upload_id):
+        with self._lock:
+            return self._locks.setdefault(upload_id, threading.Lock())
+
+    def create(self, filename, size):
+        if size <= 0:
+            raise UploadError("Empty file")
+        if size > self.max_bytes:
+            raise UploadError(f"File is larger than {self.max_bytes // (1024 * 1024)} MB")
+        upload_id = uuid.uuid4().hex
+        open(self.part_path(upload_id), 'wb').close()
+        with open(self._meta_path(upload_id), 'w') as f:
+            json.dump({'filename': filename, 'size': size}, f)
+        return upload_id
+
+    def status(self, upload_id):
+        """``{'id', 'filename', 'size', 'offset'}``, or None for an unknown upload."""
+        if not _valid_id(upload_id):
+            return None
+        try:
+            with open(self._meta_path(upload_id)) as f:
+                meta = json.load(f)
+            offset = os.path.getsize(self.part_path(upload_id))
+        except (OSError, ValueError):
+            return None
+        return {'id': upload_id, 'filename': meta['filename'], 'size': meta['size'], 'offset': offset}
+
+    def _digest(self, upload_id, offset):
+        cached = self._digests.get(upload_id)
+        if cached is not None and cached[0] == offset:
+            return cached[1]
+        digest = hashlib.sha256()
+        with open(self.part_path(upload_id), 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest
+
+    @contextmanager
+    def _exclusive(self, upload_id):
+        """Hold an upload against other threads and other processes (gunicorn
+        workers): an exclusive flock on its part file. Yields the part file,
+        open for appending."""
+        with self._upload_lock(upload_id):
+            if not _valid_id(upload_id):
+                raise UploadError("Unknown upload")
+            try:
+                # No O_CREAT: a finished or discarded upload mustn't come back
+                fd = os.open(self.part_path(upload_id), os.O_WRONLY | os.O_APPEND)
+            except FileNotFoundError:
+                raise UploadError("Unknown upload") from None
+            with os.fdopen(fd, 'ab') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                yield f
+
+    def write(self, upload_id, start, length, stream):
+        """Append ``length`` bytes read from ``stream`` at ``start``. Returns
+        the new offset; a short read (dropped connection) keeps what arrived."""
+        with self._exclusive(upload_id) as f:
+            status = self.status(upload_id)
+            if status is None:
+                raise UploadError("Unknown upload")
+            offset = status['offset']
+            if start != offset:
+                raise UploadError(f"Expected a chunk starting at byte {offset}", offset)
+            if offset + length > status['size']:
+                raise UploadError("Chunk runs past the end of the file", offset)
+
+            digest = self._digest(upload_id, offset)
+            self._digests.pop(upload_id, None)
+            remaining = length
+            while remaining:
+                chunk = stream.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                digest.update(chunk)
+                remaining -= len(chunk)
+                offset += len(chunk)
+            f.flush()
+            self._digests[upload_id] = (offset, digest)
+            return offset
+
+    def finish(self, upload_id, upload_dir):
+        """Move a complete upload into ``upload_dir`` under its content hash.
+        Returns ``(content_hash, path, duplicate, filename)``."""
+        with self._exclusive(upload_id):
+            status = self.status(upload_id)
+            if status is None:
+                raise UploadError("Unknown upload")
+            if status['offset'] != status['size']:
+                raise UploadError(f"Upload incomplete ({status['offset']} of {status['size']} bytes)",
+                                  status['offset'])
+            content_hash = self._digest(upload_id, status['offset']).hexdigest()
+            path = upload_path(upload_dir, content_hash)
+            duplicate = os.path.exists(path)
+            if duplicate:
+                os.remove(self.part_path(upload_id))
+            else:
+                os.replace(self.part_path(upload_id), path)
+            self.discard(upload_id)
+        return content_hash, path, duplicate, status['filename']
+
+    def discard(self, upload_id):
+        """Forget an upload (and delete its part file if it is still there)."""
+        for path in (self.part_path(upload_id), self._meta_path(upload_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._digests.pop(upload_id, None)
+            self._locks.pop(upload_id, None)
+
+
+def _valid_id(upload_id):
+    # IDs end up in file names
+    return len(upload_id) == 32 and all(c in '0123456789abcdef' for c in upload_id)